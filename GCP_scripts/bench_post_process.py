@@ -0,0 +1,151 @@
+#!/bin/python
+
+# Throughput benchmark of the post_process rule engine on synthetic
+# TextLoggerV2 traces.
+
+import argparse
+import gzip
+import os
+import random
+import tempfile
+import time
+
+from trace_rules import POST_PROCESS_RULES, compile_rules
+from shmem_index import IntervalIndex
+from trace_io import iter_buffers, open_sink
+from lock_addrs import RECORDS_PER_OP
+
+SHMEM_RANGES = [(0x7f0000000000, 0x7f0000100000), (0x7f0000200000, 0x7f0000300000)]
+PRIVATE_BASE = 0x5600000000
+INDICATORS = [0x401000, 0x401100, 0x401200, 0x401300]
+INDICATORSADDR2VAL = {a: i for i, a in enumerate(INDICATORS)}
+
+
+def synthetic_trace_lines(num_lines, seed=0, warmup=0.0):
+    """
+    Build TextLoggerV2 lines with a rough mix of a kvs run: mostly '@'
+    computation records, some '#' comm edges and '!' markers, a barrier
+    delimited profile window and balanced spinlock/spinunlock pairs.
+    The first warmup fraction of the lines comes before the window opens.
+    Returns (lines, number of spinlock records).
+    """
+    rnd = random.Random(seed)
+    lines = ['^ 3^0x1\n']
+    lock_records = 0
+    barrier_at = int(num_lines * warmup)
+    while len(lines) < num_lines - 1:
+        if barrier_at is not None and len(lines) >= barrier_at:
+            lines.append('^ 5^0xdead\n')
+            barrier_at = None
+            continue
+        r = rnd.random()
+        if r < 0.80:
+            if rnd.random() < 0.5:
+                b, e = SHMEM_RANGES[rnd.randrange(len(SHMEM_RANGES))]
+                addr = rnd.randrange(b, e - 8)
+            else:
+                addr = PRIVATE_BASE + rnd.randrange(1 << 20)
+            kind = '$' if rnd.random() < 0.3 else '*'
+            lines.append('@ %d,%d,%d,%d %s %#x %#x \n' % (rnd.randrange(8), 0, kind == '*', kind == '$',
+                                                          kind, addr, addr + 7))
+        elif r < 0.85:
+            lines.append('@ %d,0,0,0 \n' % rnd.randrange(1, 16))
+        elif r < 0.90:
+            addr = SHMEM_RANGES[0][0] + rnd.randrange(1 << 16)
+            lines.append('# %d %d %#x %#x \n' % (rnd.randrange(1, 9), rnd.randrange(1 << 20), addr, addr + 7))
+        elif r < 0.98:
+            # stgen emits a marker every 4096 instructions
+            lines.append('! 4096\n')
+        else:
+            lines.append('^ 9^%#x\n' % INDICATORS[rnd.randrange(len(INDICATORS))])
+            lines.append('@ 1,0,1,0 * %#x %#x \n' % (SHMEM_RANGES[0][0], SHMEM_RANGES[0][0] + 3))
+            lines.append('^ 10^%#x\n' % INDICATORS[rnd.randrange(len(INDICATORS))])
+            lock_records += 2
+    lines.append('^ 5^0xdead\n')
+    return lines, lock_records
+
+
+def bench_filter(lines, lock_records, repeat, block_size=0):
+    compiled = compile_rules(POST_PROCESS_RULES, IntervalIndex(SHMEM_RANGES))
+    nbytes = sum(len(l) for l in lines)
+    best = None
+    for _ in range(repeat):
+        trace_filter = compiled.new_filter(INDICATORSADDR2VAL, [0] * -(-lock_records // RECORDS_PER_OP))
+        t = time.perf_counter()
+        kept = 0
+        if block_size:
+            for i in range(0, len(lines), block_size):
+                kept += len(trace_filter.filter_block(lines[i:i + block_size]))
+        else:
+            for line in lines:
+                if trace_filter(line) is not None:
+                    kept += 1
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best, nbytes, kept
+
+
+def bench_buffer(lines, lock_records, repeat):
+    compiled = compile_rules(POST_PROCESS_RULES, IntervalIndex(SHMEM_RANGES))
+    data = bytearray(''.join(lines).encode())
+    best = None
+    for _ in range(repeat):
+        trace_filter = compiled.new_filter(INDICATORSADDR2VAL, [0] * -(-lock_records // RECORDS_PER_OP))
+        kept = []
+        t = time.perf_counter()
+        trace_filter.filter_buffer(data, 0, len(data), kept.append)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def bench_gz(lines, lock_records, workdir, level=6, threads=1, binary=False):
+    path = os.path.join(workdir, 'sigil.events.out-1.gz')
+    with gzip.open(path, 'wt') as f:
+        f.writelines(lines)
+    compiled = compile_rules(POST_PROCESS_RULES, IntervalIndex(SHMEM_RANGES))
+    trace_filter = compiled.new_filter(INDICATORSADDR2VAL, [0] * -(-lock_records // RECORDS_PER_OP))
+    t = time.perf_counter()
+    if binary:
+        with open_sink(path + '.tmp', level, threads, text=False) as temp_file:
+            for buf, end in iter_buffers(path):
+                trace_filter.filter_buffer(buf, 0, end, temp_file.write)
+        return time.perf_counter() - t
+    with gzip.open(path, 'rt') as gz_file, open_sink(path + '.tmp', level, threads) as temp_file:
+        while True:
+            block = gz_file.readlines(1 << 20)
+            if not block:
+                break
+            temp_file.writelines(trace_filter.filter_block(block))
+    return time.perf_counter() - t
+
+
+def report(name, seconds, num_lines, nbytes):
+    print('%-16s %8.3f s  %10.0f lines/s  %8.1f MB/s' % (name, seconds, num_lines / seconds,
+                                                         nbytes / seconds / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Benchmark the post_process '
+                                                  'rule engine on synthetic traces'))
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--warmup', type=float, default=0.3,
+                        help='fraction of the trace before the profiled window')
+    args = parser.parse_args()
+
+    lines, lock_records = synthetic_trace_lines(args.lines, warmup=args.warmup)
+    t, nbytes, kept = bench_filter(lines, lock_records, args.repeat)
+    print('%d lines, %.1f MB, %d kept' % (len(lines), nbytes / 1e6, kept))
+    report('filter', t, len(lines), nbytes)
+    t, _, _ = bench_filter(lines, lock_records, args.repeat, block_size=16384)
+    report('filter_block', t, len(lines), nbytes)
+    report('filter_buffer', bench_buffer(lines, lock_records, args.repeat), len(lines), nbytes)
+    with tempfile.TemporaryDirectory() as workdir:
+        report('gz end-to-end', bench_gz(lines, lock_records, workdir, args.level), len(lines), nbytes)
+        report('gz %d threads' % args.threads,
+               bench_gz(lines, lock_records, workdir, args.level, args.threads), len(lines), nbytes)
+        report('gz bytes mode',
+               bench_gz(lines, lock_records, workdir, args.level, args.threads, binary=True), len(lines), nbytes)
@@ -0,0 +1,65 @@
+"""
+Bounded process pool for per-trace-file work.
+
+All trace files of all directories go into one queue instead of one process
+per directory, so a run with 16 nodes x 8 threads keeps every core busy and
+small sweeps don't oversubscribe the machine.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# CPUs each job of the running pool may keep busy itself, set in its workers
+JOB_CPUS = None
+
+
+def set_job_cpus(cpus):
+    global JOB_CPUS
+    JOB_CPUS = cpus
+
+
+def job_cpus():
+    """
+    The CPUs a job may use for threads or processes of its own: its share of
+    the machine inside run_file_jobs, all of it elsewhere.
+    """
+    return JOB_CPUS or os.cpu_count() or 1
+
+
+def run_file_jobs(jobs, max_workers=None):
+    """
+    Run fn(*args) for every (path, fn, args) job on a pool sized to the CPU
+    count. The largest input files are scheduled first so a huge thread trace
+    doesn't start last. The first failing job cancels the pending ones and its
+    exception is re-raised with the offending path.
+    Returns the results in completion order.
+    """
+    if not jobs:
+        return []
+    sized = sorted(((os.path.getsize(path), path, fn, args) for path, fn, args in jobs),
+                   key=lambda j: j[0], reverse=True)
+    total_bytes = sum(j[0] for j in sized) or 1
+    max_workers = min(max_workers or os.cpu_count() or 1, len(sized))
+
+    results = []
+    done_bytes = 0
+    start = time.time()
+    pool = ProcessPoolExecutor(max_workers=max_workers, initializer=set_job_cpus,
+                               initargs=(max(1, (os.cpu_count() or 1) // max_workers),))
+    try:
+        futures = {pool.submit(fn, *args): (size, path) for size, path, fn, args in sized}
+        for n, fut in enumerate(as_completed(futures), 1):
+            size, path = futures[fut]
+            try:
+                results.append(fut.result())
+            except Exception as e:
+                raise RuntimeError('failed processing %s' % path) from e
+            done_bytes += size
+            print('[%d/%d] %5.1f%% %6.0fs %s' % (n, len(sized), 100.0 * done_bytes / total_bytes,
+                                                time.time() - start, path))
+    except BaseException:
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    pool.shutdown(wait=True)
+    return results
@@ -1,7 +1,31 @@
 import os
-import shutil
+import re
 import gzip
-import multiprocessing
+import shutil
+import contextlib
+
+from file_pool import run_file_jobs, job_cpus
+from trace_io import iter_buffers, open_sink, map_chunks
+
+COMP_CODE = ord('@')
+MARKER_CODE = ord('!')
+# last digit but one of the '! <lock addr><0|1><indicator>' records from post_process
+LOCK_CODE = ord('0')
+UNLOCK_CODE = ord('1')
+
+# gzip level and deflate threads of the generated traces, see trace_io.open_sink;
+# fewer when the sinks of a job share fewer CPUs, see file_pool.job_cpus
+COMPRESS_LEVEL = 6
+COMPRESS_THREADS = 4
+
+# traces of at least this many (compressed) bytes are cut into chunks derived
+# on SPLIT_WORKERS processes, see trace_io.map_chunks; None takes the job's
+# share of the CPUs, so the pools of concurrent jobs don't multiply
+SPLIT_MIN_SIZE = 256 << 20
+SPLIT_WORKERS = None
+
+# the '!' records scan_buffer looks at: no '4096' anywhere in the line
+LOCK_RECORD_RE = re.compile(rb'^!(?![^\n]*4096)[^\n]*\n', re.M)
 
 root_path = '/home/yanpeng/GCP_gem5/prism/GCP_scripts/result/'
 
@@ -35,7 +59,19 @@ from_lock_type = 'pthread_rwlock_prefer_w'
 # lock_types = ['mcs', ]
 # lock_types = ['cohort_rw_spin_mutex', ]
 
-def process_directory(directory):
+# derived lock types, written next to the from_lock_type run in one read of
+# its traces: elide_locks drops lock operations and remaps the unlock records
+# to lock_base_addr + 4096 * idx, hot_bucket turns test_mem accesses into '! 9999'
+variants = {
+    'gcp': {'elide_locks': True, 'hot_bucket': True},
+    # 'gcplock': {'elide_locks': True, 'hot_bucket': False},
+    # 'gcphot': {'elide_locks': False, 'hot_bucket': True},
+}
+
+def directory_jobs(from_directory, variant_options=None):
+    # the module's variants, read per call like pipeline.variant_directories does
+    if variant_options is None:
+        variant_options = variants
     # Backup the directory
     # parent_dir = os.path.dirname(directory)
     # backup_dir = parent_dir + '/' + os.path.basename(directory) + "_backup"
@@ -47,11 +83,32 @@ def process_directory(directory):
     #     print(f"Backup of '{directory}' created at '{backup_dir}'")
     
     # Process .gz files in the directory
-    os.system('mkdir -p %s' % directory)
-    
-    from_directory = directory.replace('gcp', from_lock_type)
-    # print(from_directory)
-    # return
+    directories = {name: from_directory.replace(from_lock_type, name) for name in variant_options}
+    for directory in directories.values():
+        os.system('mkdir -p %s' % directory)
+
+    lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr = read_gcp_addrs(from_directory)
+
+    jobs = []
+    for root, dirs, files in os.walk(from_directory):
+        for file in files:
+            if file.endswith('.gz'):
+                from_gz_file_path = os.path.join(root, file)
+                targets = [(from_gz_file_path.replace(from_lock_type, name), options)
+                           for name, options in variant_options.items()]
+                jobs.append((from_gz_file_path, process_gz_file,
+                             (from_gz_file_path, targets, lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr)))
+            elif file.endswith('.out'):
+                from_out_file_path = os.path.join(root, file)
+                for name in variant_options:
+                    out_file_path = from_out_file_path.replace(from_lock_type, name)
+                    os.system('cp %s %s' % (from_out_file_path, out_file_path))
+    return jobs
+
+def read_gcp_addrs(from_directory):
+    """
+    (lock base, hot bucket begin, hot bucket end) from the mem_meta.txt of a run.
+    """
     lock_base_addr = 0
     hot_bucket_begin_addr = 0
     hot_bucket_end_addr = 0
@@ -68,64 +125,167 @@ def process_directory(directory):
                 hot_bucket_begin_addr = int(hot_bucket_begin_addr, 16)
                 hot_bucket_end_addr = parts[1]
                 hot_bucket_end_addr = int(hot_bucket_end_addr, 16)
-                        
-    for root, dirs, files in os.walk(from_directory):
-        for file in files:
-            if file.endswith('.gz'):
-                from_gz_file_path = os.path.join(root, file)
-                gz_file_path = from_gz_file_path.replace(from_lock_type, 'gcp')
-                # print(from_gz_file_path, gz_file_path)
-                process_gz_file(from_gz_file_path, gz_file_path, lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr)
-            elif file.endswith('.out'):
-                from_out_file_path = os.path.join(root, file)
-                out_file_path = from_out_file_path.replace(from_lock_type, 'gcp')
-                os.system('cp %s %s' % (from_out_file_path, out_file_path))
-
-def process_gz_file(from_gz_file_path, gz_file_path, lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr):
-    in_lock_op = False
-    with gzip.open(from_gz_file_path, 'rt') as from_gz_file, gzip.open(gz_file_path, 'wt') as gz_file:
-        for line in from_gz_file:
-            modified_line = line
-            if '!' in line and '4096' not in line:
-                rwlock_code = line[-3]
-                if rwlock_code == '0':
-                    in_lock_op = True
-                elif rwlock_code == '1':
-                    in_lock_op = False
-                    modified_line = line[:-3] + '2' + line[-2:]
-                    rwlock_code = int(modified_line[2:])
-                    lock_acc_addr = rwlock_code // 100
-                    rwlock_indicator = rwlock_code % 100
-                    lock_acc_addr = lock_base_addr + 4096 * lock_acc_addr
-                    modified_line = '! ' + str(lock_acc_addr * 100 + rwlock_indicator) + '\n'
-                else:
-                    assert False
-            if in_lock_op == True:
-                modified_line = None
-            elif '@' in line:
-                parts = line.strip().split()
-                mem_acc_addr = int(parts[3][2:], 16)
-                if mem_acc_addr >= hot_bucket_begin_addr \
-                    and mem_acc_addr < hot_bucket_end_addr:
-                    modified_line = '! 9999\n'
-            if modified_line is not None:
-                gz_file.write(modified_line)
-        
-    # Replace the original file with the modified temp file
-    print(f"Generated '{gz_file_path}'")
-
-def main(directories):
+
+    return lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr
+
+def scan_buffer(buf, end, lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr):
+    """
+    Find the lines of buf[:end] a variant may rewrite, once for all variants.
+    Returns a bytes copy of the buffer and (pos, next, code, replacement)
+    per such line: LOCK_CODE and UNLOCK_CODE for the lock records of
+    post_process, the unlock ones with their remapped record, and COMP_CODE
+    for computations on the hot bucket.
+    """
+    with memoryview(buf) as region:
+        buf = region[:end].tobytes()
+    lines = []
+    add = lines.append
+    find = buf.find
+    pos = 0
+    while pos < end:
+        nxt = find(b'\n', pos, end) + 1 or end
+        code = buf[pos]
+        if code == MARKER_CODE and find(b'4096', pos, nxt) == -1:
+            rwlock_code = buf[nxt - 3]
+            if rwlock_code == LOCK_CODE:
+                add((pos, nxt, LOCK_CODE, None))
+            elif rwlock_code == UNLOCK_CODE:
+                rwlock_code = int(buf[pos + 2:nxt - 3] + b'2' + buf[nxt - 2:nxt])
+                lock_acc_addr = rwlock_code // 100
+                rwlock_indicator = rwlock_code % 100
+                lock_acc_addr = lock_base_addr + 4096 * lock_acc_addr
+                add((pos, nxt, UNLOCK_CODE, b'! %d\n' % (lock_acc_addr * 100 + rwlock_indicator)))
+            else:
+                assert False
+        elif code == COMP_CODE:
+            parts = buf[pos:nxt].split()
+            mem_acc_addr = int(parts[3], 16)
+            if mem_acc_addr >= hot_bucket_begin_addr \
+                and mem_acc_addr < hot_bucket_end_addr:
+                add((pos, nxt, COMP_CODE, b'! 9999\n'))
+        pos = nxt
+    return buf, lines
+
+class GcpTransform:
+    """
+    Rewrite a post-processed trace into one variant a buffer at a time, from
+    the lines scan_buffer found; the lock state carries over between buffers.
+    """
+
+    def __init__(self, elide_locks=True, hot_bucket=True):
+        self.elide_locks = elide_locks
+        self.hot_bucket = hot_bucket
+        self.in_lock_op = False
+
+    def transform(self, buf, end, lines):
+        # bytes mode: runs of unchanged lines are copied as slices of the buffer
+        mv = memoryview(buf)
+        out = bytearray()
+        emit = out.extend
+        in_lock_op = self.in_lock_op
+        run = 0  # first line of the current run of unchanged lines
+        for pos, nxt, code, modified_line in lines:
+            if code == COMP_CODE:
+                if not self.hot_bucket or in_lock_op:
+                    continue
+            elif not self.elide_locks:
+                continue
+            elif code == LOCK_CODE:
+                # everything up to the unlock record is dropped
+                if not in_lock_op and run < pos:
+                    emit(mv[run:pos])
+                in_lock_op = True
+                continue
+            elif in_lock_op:
+                in_lock_op = False
+                run = pos
+            if run < pos:
+                emit(mv[run:pos])
+            emit(modified_line)
+            run = nxt
+        if not in_lock_op and run < end:
+            emit(mv[run:end])
+        self.in_lock_op = in_lock_op
+        return out
+
+class TraceDeriver:
+    """
+    All variants of one trace from a single read of it.
+    """
+
+    def __init__(self, options, lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr):
+        self.addrs = (lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr)
+        self.transforms = [GcpTransform(**o) for o in options]
+
+    def derive(self, buf, end):
+        buf, lines = scan_buffer(buf, end, *self.addrs)
+        return [t.transform(buf, end, lines) for t in self.transforms]
+
+def in_lock_op_after(buf, end, in_lock_op):
+    # the lock state a GcpTransform is left in by the whole lines of buf[:end]
+    last = None
+    for last in LOCK_RECORD_RE.finditer(buf, 0, end):
+        pass
+    if last is not None:
+        code = buf[last.end() - 3]
+        if code == LOCK_CODE:
+            return True
+        if code == UNLOCK_CODE:
+            return False
+    return in_lock_op
+
+def derive_chunk(data, options, addrs, in_lock_op, level):
+    deriver = TraceDeriver(options, *addrs)
+    for transform in deriver.transforms:
+        transform.in_lock_op = in_lock_op and transform.elide_locks
+    return [gzip.compress(out, level, mtime=0) for out in deriver.derive(data, len(data))]
+
+def process_gz_file(from_gz_file_path, targets, lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr):
+    """
+    Write the (gz file path, variant options) targets of one trace. Every
+    sink deflates on its own threads, so the variants compress in parallel
+    on the CPUs of the job.
+    Large traces are cut into chunks derived on SPLIT_WORKERS processes,
+    each starting in the lock state the chunks before it ended in.
+    """
+    options = [options for _, options in targets]
+    addrs = (lock_base_addr, hot_bucket_begin_addr, hot_bucket_end_addr)
+    workers = SPLIT_WORKERS or job_cpus()
+    if workers > 1 and os.path.getsize(from_gz_file_path) >= SPLIT_MIN_SIZE:
+        in_lock_op = False
+
+        def split(data):
+            nonlocal in_lock_op
+            state = in_lock_op
+            in_lock_op = in_lock_op_after(data, len(data), in_lock_op)
+            return options, addrs, state, COMPRESS_LEVEL
+
+        map_chunks(from_gz_file_path, [p for p, _ in targets], split, derive_chunk, workers)
+        for gz_file_path, _ in targets:
+            print(f"Generated '{gz_file_path}'")
+        return
+
+    deriver = TraceDeriver(options, *addrs)
+    # the sinks share the job's CPUs
+    threads = max(1, min(COMPRESS_THREADS, job_cpus() // len(targets)))
+    with contextlib.ExitStack() as stack:
+        writes = [stack.enter_context(open_sink(gz_file_path, COMPRESS_LEVEL, threads, text=False)).write
+                  for gz_file_path, _ in targets]
+        for buf, end in iter_buffers(from_gz_file_path):
+            for write, out in zip(writes, deriver.derive(buf, end)):
+                write(out)
+
+    for gz_file_path, _ in targets:
+        print(f"Generated '{gz_file_path}'")
+
+def main(directories, max_workers=None):
     # print(directories)
     # return
-    ps = []
+    # one queue of trace files across all directories
+    jobs = []
     for directory in directories:
-        p = multiprocessing.Process(target=process_directory, args=(directory,))
-        ps.append(p)
-        p.start()
-    for p in ps:
-        p.join()
-        # process_directory(directory)
-        # print(f"Finished processing directory: {directory}")
+        jobs += directory_jobs(directory)
+    run_file_jobs(jobs, max_workers)
 
 if __name__ == "__main__":
     directories = []  # Update this list with your directories
@@ -134,7 +294,7 @@ if __name__ == "__main__":
             for num_nodes in num_nodess:
                 for num_threads_per_nodes in num_threads_per_nodess:
                     directories.append(root_path + '_'.join((app, workload,
-                                    'gcp',
+                                    from_lock_type,
                                     str(num_nodes),
                                     str(num_threads_per_nodes))))
     main(directories)
@@ -0,0 +1,155 @@
+"""
+Binary sidecar of the lock_acc_addr/<tid> files of a run.
+
+The _lock_acc_addr printer writes the lock index of every lock operation of
+a thread as one decimal line. lock_acc_addr/<tid>.bin holds the same as
+
+    8 bytes    MAGIC
+    8 bytes    number of lock operations, little-endian
+    8 bytes    per lock operation, little-endian int64
+
+and is mapped read-only instead of parsed. run.py writes it right after the
+printer step:
+
+    $ python lock_addrs.py result/<run id> ...
+"""
+
+import os
+import sys
+
+import numpy as np
+
+MAGIC = b'LOCKACC1'
+HEADER_SIZE = 16
+DTYPE = np.dtype('<i8')
+
+LOCK_ACC_ADDR_DIR = 'lock_acc_addr'
+
+# spinlock records of one lock operation: lock begin, lock end, unlock begin, unlock end
+RECORDS_PER_OP = 4
+
+
+def trace_tid(gz_file_path):
+    name = os.path.basename(gz_file_path)
+    return name[name.find('sigil.events.out-') + 17:name.find('.gz')]
+
+
+def text_path(directory, tid):
+    return '%s/%s/%s' % (directory, LOCK_ACC_ADDR_DIR, tid)
+
+
+def sidecar_path(directory, tid):
+    return text_path(directory, tid) + '.bin'
+
+
+def read_text(path):
+    with open(path, 'rb') as file:
+        return np.array([int(v) for v in file.read().split()], dtype=DTYPE)
+
+
+def write_sidecar(path, addrs):
+    addrs = np.asarray(addrs, dtype=DTYPE)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(len(addrs).to_bytes(8, 'little'))
+        file.write(addrs.tobytes())
+    os.replace(temp_path, path)
+
+
+def read_sidecar(path):
+    """
+    Map a sidecar, checking its count against its size so that a truncated
+    file fails before any trace is read.
+    """
+    with open(path, 'rb') as file:
+        header = file.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[:8] != MAGIC:
+        raise ValueError('%s: not a lock_acc_addr sidecar' % path)
+    count = int.from_bytes(header[8:], 'little')
+    size = os.path.getsize(path)
+    if size != HEADER_SIZE + count * DTYPE.itemsize:
+        raise ValueError('%s: %d lock operations in the header but %d bytes of them'
+                         % (path, count, size - HEADER_SIZE))
+    if count == 0:
+        return np.empty(0, dtype=DTYPE)
+    return np.memmap(path, dtype=DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def is_fresh(sidecar, text):
+    return os.path.exists(sidecar) and (not os.path.exists(text)
+                                        or os.path.getmtime(sidecar) >= os.path.getmtime(text))
+
+
+def load_lock_acc_addrs(directory, tid):
+    """
+    The lock index of every lock operation of a thread, in trace order, or
+    None if the run has no lock_acc_addr file for it. A missing or stale
+    sidecar is written from the text file on the way.
+    """
+    text, sidecar = text_path(directory, tid), sidecar_path(directory, tid)
+    if not is_fresh(sidecar, text):
+        if not os.path.exists(text):
+            return None
+        write_sidecar(sidecar, read_text(text))
+    return read_sidecar(sidecar)
+
+
+def convert_directory(directory):
+    """
+    Write the missing or stale sidecars of a run, returns how many.
+    """
+    written = 0
+    for name in sorted(os.listdir(directory + '/' + LOCK_ACC_ADDR_DIR)):
+        if not name.isdigit():
+            continue
+        text, sidecar = text_path(directory, name), sidecar_path(directory, name)
+        if not is_fresh(sidecar, text):
+            write_sidecar(sidecar, read_text(text))
+            written += 1
+    return written
+
+
+class LockAddrCursor:
+    """
+    Hands the lock of the current lock operation to each of its
+    RECORDS_PER_OP spinlock records in O(1). Fails at the first record past
+    the last lock operation, not at the end of the trace.
+    """
+
+    __slots__ = ('addrs', 'records', 'total', 'name')
+
+    def __init__(self, addrs, name=None):
+        self.addrs = addrs
+        self.records = 0
+        self.total = len(addrs) * RECORDS_PER_OP
+        self.name = name
+
+    def next(self):
+        op = self.records // RECORDS_PER_OP
+        self.skip()
+        return int(self.addrs[op])
+
+    def peek(self):
+        """
+        (lock, record of its lock operation) of the next record, without
+        taking it.
+        """
+        if self.records >= self.total:
+            raise ValueError('%s: more lock records than the %d lock operations in lock_acc_addr'
+                             % (self.name or 'trace', len(self.addrs)))
+        return int(self.addrs[self.records // RECORDS_PER_OP]), self.records % RECORDS_PER_OP
+
+    def skip(self, records=1):
+        if self.records + records > self.total:
+            raise ValueError('%s: more lock records than the %d lock operations in lock_acc_addr'
+                             % (self.name or 'trace', len(self.addrs)))
+        self.records += records
+
+    def remaining(self):
+        return self.total - self.records
+
+
+if __name__ == '__main__':
+    for directory in sys.argv[1:]:
+        print('%s: %d lock_acc_addr sidecars written' % (directory, convert_directory(directory)))
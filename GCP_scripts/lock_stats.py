@@ -0,0 +1,361 @@
+#!/bin/python
+
+# Lock contention and critical section statistics of the runs of the lock
+# micro benchmark.
+#
+# Every lock operation of the benchmark shows up in a thread trace as four
+# spinlock records, each consuming the same lock_acc_addr/<tid> line:
+#
+#   lock begin    '^ 9^<lock indicator>'     post_process: '! <lock>0<0|1>'
+#   lock end      '^ 10^<lock indicator>'                  '! <lock>1<0|1>'
+#   unlock begin  '^ 9^<unlock indicator>'                 '! <lock>0<2|3>'
+#   unlock end    '^ 10^<unlock indicator>'                '! <lock>1<2|3>'
+#
+# with indicators 0/1 for read/write lock and 2/3 for read/write unlock (mcs
+# runs only use 1 and 3). Raw and post-processed traces both work; in
+# gen_gcp_trace output the '! 9999' and remapped unlock records are skipped,
+# any other '!' line is an error. Per lock the acquisitions are measured in
+# instructions, from the '! 4096' markers, and in memory ops, the address
+# ranges of '@' and '#' records:
+#
+#   acquire   lock begin -> lock end, waiting for the lock
+#   hold      lock end -> unlock begin, the critical section
+#   release   unlock begin -> unlock end
+#
+# Markers come every 4096 instructions, so single acquisitions are coarse
+# but the means are not biased. Each trace is scanned in one pass with numpy
+# over the decompressed buffers; only marker and sync lines are looked at
+# one by one.
+
+import os
+import argparse
+
+import numpy as np
+
+from file_pool import run_file_jobs
+from post_process import load_indicators, indicator_map
+from trace_io import iter_buffers
+from lock_addrs import load_lock_acc_addrs, trace_tid
+
+NEWLINE = ord('\n')
+MARKER_CODE = ord('!')
+SYNC_CODE = ord('^')
+# '$' write, '*' read and '#' comm address ranges
+RANGE_CODES = np.array([ord('$'), ord('*'), ord('#')], dtype=np.uint8)
+
+# instructions per '! 4096' marker
+MARKER_INSTRS = 4096
+PLAIN_MARKER = np.frombuffer(b'! 4096', dtype=np.uint8)
+# gen_gcp_trace's stand-in for a hot bucket access, and the phase of its
+# remapped unlock records '! <lock_base_addr + 4096 * lock>2<indicator>'
+HOT_RECORD = b'9999'
+REMAPPED_UNLOCK = ord('2')
+
+SYNC_BARRIER = 5
+SYNC_SPINLOCK = 9
+SYNC_SPINUNLOCK = 10
+
+# lock operation phases, the '<0|1>' of the post-processed records
+BEGIN = 0
+END = 1
+
+READ_LOCK = 0
+WRITE_LOCK = 1
+
+# per lock columns of a scan, summed over threads except the max_ ones
+SUM_COLUMNS = ('acquisitions', 'writes',
+               'acquire_instrs', 'hold_instrs', 'release_instrs',
+               'acquire_memops', 'hold_memops', 'release_memops')
+MAX_COLUMNS = ('max_acquire_instrs', 'max_hold_instrs')
+
+RANKINGS = {
+    'acquisitions': 'acquisitions',
+    'acquire': 'acquire_instrs',
+    'hold': 'hold_instrs',
+    'memops': 'hold_memops',
+}
+
+root_path = '/home/yanpeng/GCP_gem5/prism/GCP_scripts/result/'
+
+workloads = {
+    'kvs' : ['run_workloada.dat', ],
+}
+
+num_threads_per_nodess = [8, ]
+
+num_nodess = [4, ]
+
+lock_types = [
+            'pthread_rwlock_prefer_w',
+              'percpu',
+              'cohort_rw_spin_mutex',
+              'mcs',
+              ]
+
+
+def read_lock_acc_addrs(directory, gz_file_path):
+    """
+    The lock of every lock operation of a thread, in trace order, or None if
+    the run has no lock_acc_addr file for it.
+    """
+    return load_lock_acc_addrs(directory, trace_tid(gz_file_path))
+
+
+def lock_base_addr(directory):
+    # first address of the lock array, see gen_gcp_trace
+    path = directory + '/mem_meta.txt'
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'locks':
+                    return int(parts[0], 16)
+    return None
+
+
+def line_starts(data):
+    starts = np.flatnonzero(data == NEWLINE) + 1
+    starts = np.concatenate(([0], starts[starts < len(data)]))
+    return starts
+
+
+def scan_trace(gz_file_path, lock_acc_addrs=None, indicatorsaddr2val=None, window=False):
+    """
+    Measure the lock operations of one thread trace. Returns a dict with the
+    per lock columns (SUM_COLUMNS, MAX_COLUMNS and 'lock') plus the number
+    of lock operations that did not form a begin/end/begin/end group.
+    With window set only the acquisitions inside the barrier delimited
+    profile window (see post_process) count.
+    """
+    phases, indicators, locks, instrs, memops, in_window = [], [], [], [], [], []
+    instr_total = 0
+    memop_total = 0
+    profile_enabled = not window
+    started = False
+    for buf, end in iter_buffers(gz_file_path):
+        data = np.frombuffer(buf, dtype=np.uint8, count=end)
+        starts = line_starts(data)
+        codes = data[starts]
+        lengths = np.diff(np.append(starts, end))
+        # without the newline
+        lengths -= data[starts + lengths - 1] == NEWLINE
+
+        # memory ops and instructions retired per line
+        line_memops = np.add.reduceat(np.isin(data, RANGE_CODES).astype(np.int64), starts)
+        line_instrs = np.zeros(len(starts), dtype=np.int64)
+        markers = np.flatnonzero(codes == MARKER_CODE)
+        plain = np.zeros(len(markers), dtype=bool)
+        fits = lengths[markers] == len(PLAIN_MARKER)
+        plain[fits] = (data[starts[markers[fits]][:, None] + np.arange(len(PLAIN_MARKER))]
+                       == PLAIN_MARKER).all(axis=1)
+        line_instrs[markers[plain]] = MARKER_INSTRS
+        instr_before = instr_total + np.cumsum(line_instrs) - line_instrs
+        memop_before = memop_total + np.cumsum(line_memops) - line_memops
+        instr_total += int(line_instrs.sum())
+        memop_total += int(line_memops.sum())
+
+        # lock records, in line order
+        records = np.sort(np.concatenate((markers[~plain], np.flatnonzero(codes == SYNC_CODE))))
+        for n in records.tolist():
+            s = int(starts[n])
+            line = bytes(buf[s:s + int(lengths[n])])
+            if codes[n] == MARKER_CODE:
+                value = line[2:]
+                if value == HOT_RECORD or (len(value) >= 3 and value[-2] == REMAPPED_UNLOCK):
+                    # no instructions, and the lock operation of an unlock was elided
+                    continue
+                if len(value) < 3 or value[-2] not in b'01':
+                    raise ValueError('%s: %r is neither a marker nor a lock record'
+                                     % (gz_file_path, line))
+                phase, indicator, lock = value[-2] - ord('0'), value[-1] - ord('0'), int(value[:-2])
+            else:
+                sync_type = int(line[2:line.index(b'^', 2)])
+                if sync_type == SYNC_BARRIER:
+                    if window:
+                        profile_enabled = not profile_enabled
+                    continue
+                if sync_type not in (SYNC_SPINLOCK, SYNC_SPINUNLOCK):
+                    continue
+                if sync_type == SYNC_SPINUNLOCK and not started:
+                    # like post_process, unlocks before the first lock are not lock operations
+                    continue
+                if indicatorsaddr2val is None:
+                    raise ValueError('%s: spinlock records but no indicators' % gz_file_path)
+                arg = line[line.index(b'0x') + 2:].split(b'&')[0]
+                phase = BEGIN if sync_type == SYNC_SPINLOCK else END
+                indicator, lock = indicatorsaddr2val[int(arg, 16)], -1
+            started = True
+            phases.append(phase)
+            indicators.append(indicator)
+            locks.append(lock)
+            instrs.append(int(instr_before[n]))
+            memops.append(int(memop_before[n]))
+            in_window.append(profile_enabled)
+
+    groups = len(phases) // 4
+    unpaired = len(phases) - 4 * groups
+    n = 4 * groups
+    phases = np.array(phases[:n], dtype=np.int64).reshape(-1, 4)
+    indicators = np.array(indicators[:n], dtype=np.int64).reshape(-1, 4)
+    instrs = np.array(instrs[:n], dtype=np.int64).reshape(-1, 4)
+    memops = np.array(memops[:n], dtype=np.int64).reshape(-1, 4)
+    in_window = np.array(in_window[:n], dtype=bool).reshape(-1, 4)[:, 0]
+    locks = np.array(locks[:n], dtype=np.int64).reshape(-1, 4)[:, 0]
+    if groups and (locks < 0).any():
+        if lock_acc_addrs is None or len(lock_acc_addrs) != groups:
+            raise ValueError('%s: %d lock operations but %s lock_acc_addr entries'
+                             % (gz_file_path, groups,
+                                'no' if lock_acc_addrs is None else len(lock_acc_addrs)))
+        locks = lock_acc_addrs
+
+    well_formed = ((phases == [BEGIN, END, BEGIN, END]).all(axis=1)
+                   & (indicators[:, 0] == indicators[:, 1])
+                   & (indicators[:, 2] == indicators[:, 3])
+                   & (indicators[:, 2] == indicators[:, 0] + 2))
+    malformed = unpaired + 4 * int((~well_formed).sum())
+    keep = well_formed & in_window
+
+    lock_ids, inverse = np.unique(locks[keep], return_inverse=True)
+    spans_instrs = np.diff(instrs[keep], axis=1)
+    spans_memops = np.diff(memops[keep], axis=1)
+    columns = {
+        'acquisitions': np.ones(len(inverse), dtype=np.int64),
+        'writes': (indicators[keep, 0] == WRITE_LOCK).astype(np.int64),
+        'acquire_instrs': spans_instrs[:, 0],
+        'hold_instrs': spans_instrs[:, 1],
+        'release_instrs': spans_instrs[:, 2],
+        'acquire_memops': spans_memops[:, 0],
+        'hold_memops': spans_memops[:, 1],
+        'release_memops': spans_memops[:, 2],
+    }
+    stats = {'path': gz_file_path, 'lock': lock_ids, 'malformed': malformed}
+    for name in SUM_COLUMNS:
+        stats[name] = np.bincount(inverse, weights=columns[name],
+                                  minlength=len(lock_ids)).astype(np.int64)
+    for name, column in zip(MAX_COLUMNS, ('acquire_instrs', 'hold_instrs')):
+        stats[name] = np.zeros(len(lock_ids), dtype=np.int64)
+        np.maximum.at(stats[name], inverse, columns[column])
+    return stats
+
+
+def merge_stats(stats_list):
+    """
+    Merge the per thread stats of a run by lock, adding a 'threads' column.
+    """
+    lock_ids, inverse = np.unique(np.concatenate([s['lock'] for s in stats_list] or [[]]).astype(np.int64),
+                                  return_inverse=True)
+    merged = {'lock': lock_ids,
+              'malformed': sum(s['malformed'] for s in stats_list),
+              'threads': np.bincount(inverse, minlength=len(lock_ids))}
+    for name in SUM_COLUMNS:
+        values = np.concatenate([s[name] for s in stats_list] or [[]])
+        merged[name] = np.bincount(inverse, weights=values, minlength=len(lock_ids)).astype(np.int64)
+    for name in MAX_COLUMNS:
+        values = np.concatenate([s[name] for s in stats_list] or [[]]).astype(np.int64)
+        merged[name] = np.zeros(len(lock_ids), dtype=np.int64)
+        np.maximum.at(merged[name], inverse, values)
+    merged['num_threads'] = len(stats_list)
+    return merged
+
+
+def directory_jobs(directory, window=False):
+    gz_file_paths = []
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if file.startswith('sigil.events.out-') and file.endswith('.gz'):
+                gz_file_paths.append(os.path.join(root, file))
+    # raw traces need the spinlock indicators, post-processed ones don't
+    indicators = load_indicators(directory, gz_file_paths)
+    indicatorsaddr2val = indicator_map(indicators, directory) if indicators else None
+    return [(gz_file_path, scan_trace,
+             (gz_file_path, read_lock_acc_addrs(directory, gz_file_path), indicatorsaddr2val, window))
+            for gz_file_path in gz_file_paths]
+
+
+def mean(total, count):
+    return total / count if count else 0.0
+
+
+def print_directory(directory, merged, rank='acquisitions', top=10):
+    acquisitions = int(merged['acquisitions'].sum())
+    writes = int(merged['writes'].sum())
+    print('%s: %d acquisitions of %d locks by %d threads, %.1f%% writes, %d malformed lock operations'
+          % (directory, acquisitions, len(merged['lock']), merged['num_threads'],
+             100.0 * mean(writes, acquisitions), merged['malformed']))
+    if not acquisitions:
+        return
+    print('  per acquisition: acquire %.1f instrs %.1f memops, hold %.1f instrs %.1f memops, '
+          'release %.1f instrs %.1f memops'
+          % tuple(mean(int(merged[name].sum()), acquisitions)
+                  for name in ('acquire_instrs', 'acquire_memops', 'hold_instrs', 'hold_memops',
+                               'release_instrs', 'release_memops')))
+    base = lock_base_addr(directory)
+    order = np.argsort(merged[RANKINGS[rank]], kind='stable')[::-1][:top]
+    print('  %6s %14s %8s %7s %7s %12s %12s %10s %12s'
+          % ('lock', 'addr', 'acq', 'write%', 'threads', 'acquire', 'hold', 'hold_mem', 'max_hold'))
+    for i in order.tolist():
+        acq = int(merged['acquisitions'][i])
+        lock = int(merged['lock'][i])
+        print('  %6d %14s %8d %7.1f %7d %12.1f %12.1f %10.1f %12d'
+              % (lock, '%#x' % (base + 4096 * lock) if base is not None else '-', acq,
+                 100.0 * mean(int(merged['writes'][i]), acq), merged['threads'][i],
+                 mean(int(merged['acquire_instrs'][i]), acq), mean(int(merged['hold_instrs'][i]), acq),
+                 mean(int(merged['hold_memops'][i]), acq), merged['max_hold_instrs'][i]))
+
+
+def print_comparison(results):
+    # one line per run, e.g. the lock types of a sweep side by side
+    print('%-60s %10s %7s %10s %10s %10s' % ('run', 'acq', 'write%', 'acquire', 'hold', 'hold_mem'))
+    for directory, merged in results.items():
+        acq = int(merged['acquisitions'].sum())
+        print('%-60s %10d %7.1f %10.1f %10.1f %10.1f'
+              % (os.path.basename(os.path.normpath(directory)), acq,
+                 100.0 * mean(int(merged['writes'].sum()), acq),
+                 mean(int(merged['acquire_instrs'].sum()), acq),
+                 mean(int(merged['hold_instrs'].sum()), acq),
+                 mean(int(merged['hold_memops'].sum()), acq)))
+
+
+def main(directories, max_workers=None, window=False, rank='acquisitions', top=10):
+    # one queue of trace files across all directories
+    jobs = []
+    owner = {}
+    for directory in directories:
+        for job in directory_jobs(directory, window):
+            owner[job[0]] = directory
+            jobs.append(job)
+    per_directory = {directory: [] for directory in directories}
+    for stats in run_file_jobs(jobs, max_workers):
+        per_directory[owner[stats['path']]].append(stats)
+    results = {directory: merge_stats(stats) for directory, stats in per_directory.items()}
+    for directory, merged in results.items():
+        print_directory(directory, merged, rank, top)
+    if len(results) > 1:
+        print_comparison(results)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lock contention statistics of lock benchmark runs')
+    parser.add_argument('directories', nargs='*',
+                        help='run directories, default: the runs configured in this script')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes')
+    parser.add_argument('--window', action='store_true',
+                        help='only count acquisitions inside the barrier delimited profile window')
+    parser.add_argument('--rank', choices=sorted(RANKINGS), default='acquisitions',
+                        help='order of the hot lock ranking')
+    parser.add_argument('--top', type=int, default=10, help='locks listed per run')
+    args = parser.parse_args()
+
+    directories = args.directories
+    if not directories:
+        for app in workloads:
+            for workload in workloads[app]:
+                for lock_type in lock_types:
+                    for num_nodes in num_nodess:
+                        for num_threads_per_nodes in num_threads_per_nodess:
+                            directories.append(root_path + '_'.join((app, workload,
+                                            lock_type,
+                                            str(num_nodes),
+                                            str(num_threads_per_nodes))))
+    main(directories, args.jobs, args.window, args.rank, args.top)
@@ -0,0 +1,186 @@
+"""
+Post-process the traces of a run, and derive their gcp variants, while prism
+is still writing them.
+
+Before prism starts, every expected sigil.events.out-<tid>.gz of the result
+directory is made a FIFO. prism opens it like a regular file and its gzip
+stream is read by one stage process per thread. The stage filters the lines
+with post_process.TraceProcessor and, for runs of gen_gcp_trace's
+from_lock_type, feeds the filtered lines on to gen_gcp_trace.TraceDeriver,
+writing the filtered trace and every variant in the same pass. The raw
+trace never reaches the disk; the filtered one replaces the FIFO once the
+stream ends. The stages share the spinlock indicators of the run through
+post_process.SharedIndicators, so a thread that never spins does not hold
+its trace back until it ends.
+
+Traces of threads beyond the FIFOs are written by prism as regular files and
+get the same stage once prism exited. FIFOs prism never opened are ended and
+removed then. pipeline.done marks a run whose stages all succeeded.
+"""
+
+import os
+import glob
+import stat
+import shutil
+import itertools
+import contextlib
+import multiprocessing
+
+import post_process
+import gen_gcp_trace
+from trace_io import iter_buffers, open_sink
+
+TRACE_FILE = 'sigil.events.out-%d.gz'
+DONE_FILE = 'pipeline.done'
+
+# a stage per thread runs next to prism, so each deflates on its own thread
+COMPRESS_THREADS = 1
+
+
+def variant_directories(directory):
+    """
+    (directory, options) of the gen_gcp_trace variants derived from a run,
+    none unless it is of the one lock type they are derived from.
+    """
+    if gen_gcp_trace.from_lock_type not in directory:
+        return []
+    return [(directory.replace(gen_gcp_trace.from_lock_type, name), options)
+            for name, options in gen_gcp_trace.variants.items()]
+
+
+def process_stream(gz_file_path, directory, variant_dirs=(), shared=None):
+    """
+    Post-process one trace, a FIFO or a regular file, in place and write its
+    variants to the (directory, options) of variant_dirs.
+    """
+    try:
+        filter_stream(gz_file_path, directory, variant_dirs, shared)
+    finally:
+        # the other stages stop waiting on a trace that ended, or failed
+        if shared is not None:
+            shared.end_stream()
+
+
+def filter_stream(gz_file_path, directory, variant_dirs, shared):
+    buffers = iter_buffers(gz_file_path)
+    first = next(buffers, None)
+    if first is None and stat.S_ISFIFO(os.stat(gz_file_path).st_mode):
+        # prism never traced this thread
+        os.remove(gz_file_path)
+        return
+
+    temp_file_path = gz_file_path + '.tmp'
+    with contextlib.ExitStack() as stack:
+        sink = stack.enter_context(open_sink(temp_file_path, post_process.COMPRESS_LEVEL,
+                                             COMPRESS_THREADS, text=False))
+        write = sink.write
+        if variant_dirs:
+            variant_writes = [stack.enter_context(open_sink(d + '/' + os.path.basename(gz_file_path),
+                                                            gen_gcp_trace.COMPRESS_LEVEL,
+                                                            COMPRESS_THREADS, text=False)).write
+                              for d, _ in variant_dirs]
+            deriver = None
+
+            def write(data):
+                nonlocal deriver
+                sink.write(data)
+                if deriver is None:
+                    # the first filtered lines come after mem_meta.txt was written
+                    deriver = gen_gcp_trace.TraceDeriver([options for _, options in variant_dirs],
+                                                         *gen_gcp_trace.read_gcp_addrs(directory))
+                for variant_write, out in zip(variant_writes, deriver.derive(data, len(data))):
+                    variant_write(out)
+
+        processor = post_process.TraceProcessor(gz_file_path, directory, write, shared=shared)
+        for buf, end in itertools.chain([first] if first else [], buffers):
+            processor.feed(buf, end)
+        processor.close()
+    os.replace(temp_file_path, gz_file_path)
+
+
+class Pipeline:
+    """
+    The stage processes of one result directory.
+    """
+
+    def __init__(self, directory, tids):
+        self.directory = directory
+        self.variant_dirs = variant_directories(directory)
+        self.fifos = [directory + '/' + TRACE_FILE % tid for tid in tids]
+        self.stages = []
+        self.drained = False
+        # one count per stage not at its end yet, and one until prism exited
+        self.streams = multiprocessing.Value('i', 1)
+        self.shared = post_process.SharedIndicators(directory, self.streams)
+
+    def start_stage(self, path):
+        with self.streams.get_lock():
+            self.streams.value += 1
+        stage = multiprocessing.Process(target=process_stream,
+                                        args=(path, self.directory, self.variant_dirs, self.shared))
+        stage.start()
+        self.stages.append(stage)
+
+    def start(self):
+        """
+        Make the FIFOs and start their stages, before prism starts.
+        """
+        # traces left by an earlier attempt would be filtered twice
+        for path in glob.glob(self.directory + '/sigil.events.out-*'):
+            os.remove(path)
+        for name in (DONE_FILE, post_process.INDICATORS_FILE):
+            if os.path.exists(self.directory + '/' + name):
+                os.remove(self.directory + '/' + name)
+        for variant_dir, _ in self.variant_dirs:
+            os.makedirs(variant_dir, exist_ok=True)
+        for path in self.fifos:
+            os.mkfifo(path)
+            self.start_stage(path)
+
+    def end_unopened(self):
+        # a writer that opens and closes right away ends the stream of a
+        # FIFO prism never opened; FIFOs already drained are regular files
+        for path in self.fifos:
+            try:
+                if not stat.S_ISFIFO(os.stat(path).st_mode):
+                    continue
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                # gone, or its stage has not opened it yet
+                continue
+            os.close(fd)
+
+    def poll(self):
+        """
+        Once prism exited: True when every stage is done.
+        """
+        if not self.drained:
+            self.drained = True
+            for path in sorted(glob.glob(self.directory + '/sigil.events.out-*.gz')):
+                if path not in self.fifos:
+                    self.start_stage(path)
+            # no more traces to come
+            self.shared.end_stream()
+        self.end_unopened()
+        return not any(stage.is_alive() for stage in self.stages)
+
+    def finish(self):
+        """
+        Copy the .out files of prism next to the variant traces and mark the
+        run done. Returns the number of failed stages.
+        """
+        for stage in self.stages:
+            stage.join()
+        failed = sum(1 for stage in self.stages if stage.exitcode != 0)
+        for variant_dir, _ in self.variant_dirs:
+            for path in glob.glob(self.directory + '/*.out'):
+                shutil.copy(path, variant_dir)
+        if not failed:
+            open(self.directory + '/' + DONE_FILE, 'w').close()
+        return failed
+
+    def kill(self):
+        for stage in self.stages:
+            if stage.is_alive():
+                stage.terminate()
+                stage.join()
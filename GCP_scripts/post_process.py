@@ -1,56 +1,46 @@
 import os
 import shutil
+import re
 import gzip
-import multiprocessing
+import time
+import tempfile
 
-def in_shmem_ranges(addr, shmem_ranges):
-    for (b, e) in shmem_ranges:
-        if addr >= b and addr < e:
-            return True
-    return False
+import numpy as np
 
-def process_line(line, profile_enabled, shmem_ranges, indicatorsaddr2val, start_convert_spinlock_to_indicator, lock_acc_addrs, preserve_futex):
-    """
-    Modify or delete a line.
-    Return the modified line, or None to delete the line.
-    """
-    # Example: simple modification, uncomment and adjust as needed
-    # modified_line = line.replace("original", "modified")
-    # return modified_line
-    
-    # Example: conditionally delete lines, uncomment and adjust as needed
-    # if "delete_this" in line:
-    #     return None  # Line will be deleted
-    is_barrier = False
-    if '5^' in line:
-        is_barrier = True
-    if '9^' in line:
-        indicator = int(line[line.find('0x') + 2:], 16)
-        line = '! %d0%d\n' % (lock_acc_addrs[0], indicatorsaddr2val[indicator])
-        lock_acc_addrs.pop(0)
-        start_convert_spinlock_to_indicator = True
-    elif '10^' in line:
-        if start_convert_spinlock_to_indicator:
-            indicator = int(line[line.find('0x') + 2:], 16)
-            line = '! %d1%d\n' % (lock_acc_addrs[0], indicatorsaddr2val[indicator])
-            lock_acc_addrs.pop(0)
-        else:
-            line = None
-    elif (not '^' in line) and (not '#' in line) and (not profile_enabled):
-        line = None
-    elif '#' in line and (not preserve_futex):
-        line = None
-    elif ('@' in line):
-        parts = line.strip().split()
-        if len(parts) <= 3:
-            line = None
-        else:
-            addr = int(parts[3][2:], 16)
-            if not in_shmem_ranges(addr, shmem_ranges):
-                line = None
-    return line, is_barrier, start_convert_spinlock_to_indicator  # Return the line unmodified by default
+from file_pool import run_file_jobs, job_cpus
+from trace_rules import POST_PROCESS_RULES, compile_rules
+from shmem_index import load_shmem_index
+from trace_io import iter_buffers, open_sink, map_chunks
+from lock_addrs import load_lock_acc_addrs, trace_tid, RECORDS_PER_OP
+
+# gzip level and deflate threads of the rewritten traces, see trace_io.open_sink;
+# fewer threads when the job's share of the CPUs is smaller, see file_pool.job_cpus
+COMPRESS_LEVEL = 6
+COMPRESS_THREADS = 4
+
+# traces of at least this many (compressed) bytes are cut into chunks filtered
+# on SPLIT_WORKERS processes, see trace_io.map_chunks; None takes the job's
+# share of the CPUs, so the pools of concurrent jobs don't multiply
+SPLIT_MIN_SIZE = 256 << 20
+SPLIT_WORKERS = None
+
+# per-directory cache of the spinlock indicator addresses
+INDICATORS_FILE = 'spinlock_indicators.txt'
 
-def process_directory(directory):
+# raw bytes a TraceProcessor holds back until it can start filtering, a
+# trace that needs more fails instead of growing without bound
+MAX_PENDING = 256 << 20
+
+# seconds between looks for the indicators of the other traces of a run
+POLL_INTERVAL = 0.5
+
+# shared memory regions written by the benchmark, see shmem_index
+MEM_META_FILE = 'mem_meta.txt'
+
+# '^ 9^0x..' spinLock records in a bytes buffer of whole lines
+SPINLOCK_RE = re.compile(rb'^\^ 9\^0x([0-9a-fA-F]+)', re.M)
+
+def directory_jobs(directory, use_sidecar=True):
     # Backup the directory
     # parent_dir = os.path.dirname(directory)
     # backup_dir = parent_dir + '/' + os.path.basename(directory) + "_backup"
@@ -62,48 +52,120 @@ def process_directory(directory):
     #     print(f"Backup of '{directory}' created at '{backup_dir}'")
     
     # Process .gz files in the directory
-    shmem_ranges = []
-    with open(directory + '/mem_meta.txt', 'r') as file:
-        for line in file:
-            parts = line.strip().split()
-            if len(parts) == 3:
-                start_addr, end_addr, name = parts
-                start_addr = int(start_addr, 16)
-                end_addr = int(end_addr, 16)
-                shmem_ranges.append((start_addr, end_addr))
-                        
+    compiled = directory_rules(directory)
+
+    gz_file_paths = []
     for root, dirs, files in os.walk(directory):
         for file in files:
             if file.endswith('.gz'):
-                gz_file_path = os.path.join(root, file)
-                process_gz_file(gz_file_path, shmem_ranges, directory)
+                gz_file_paths.append(os.path.join(root, file))
+
+    # None makes every file buffer until it has seen its own indicators
+    indicators = load_indicators(directory, gz_file_paths) if use_sidecar else None
+    indicatorsaddr2val = indicator_map(indicators, directory) if indicators else None
+    return [(gz_file_path, process_gz_file, (gz_file_path, compiled, directory, indicatorsaddr2val))
+            for gz_file_path in gz_file_paths]
+
+def directory_rules(directory):
+    shmem_index = load_shmem_index(directory)
 
-def process_gz_file(gz_file_path, shmem_ranges, directory):
-    
-    lock_acc_addrs = []
-    with open(directory + '/lock_acc_addr/' + gz_file_path[gz_file_path.find('sigil.events.out-')+17:gz_file_path.find('.gz')], 'r') as file:
-        for line in file:
-            for _ in range(4): # lock begin, lock end, unlock begin, unlock end
-                lock_acc_addrs.append(int(line))
-    
-    profile_enabled = False
-    # Temporary file to store modifications
-    temp_file_path = gz_file_path + ".tmp"
-    is_read_only = (directory.find('workloadc') != -1)
     # preserve_futex = (directory.find('pthread_rwlock_prefer_w') != -1)
     preserve_futex = False
-    
+    rules = tuple(r for r in POST_PROCESS_RULES if not (preserve_futex and r == 'drop_futex'))
+    return compile_rules(rules, shmem_index)
+
+def is_read_only_run(directory):
+    return directory.find('workloadc') != -1
+
+def num_indicators(directory):
+    # read lock, write lock, read unlock, write unlock; workloadc only reads
+    return 2 if is_read_only_run(directory) else 4
+
+def spinlock_indicators(buf, end):
+    return [int(m.group(1), 16) for m in SPINLOCK_RE.finditer(buf, 0, end)]
+
+def scan_indicators(gz_file_path, count):
     indicators = set()
-    # print(gz_file_path)
-    with gzip.open(gz_file_path, 'rt') as gz_file:
-        for line in gz_file:
-            # print(line)
-            if '9^' in line:
-                # print(line)
-                indicators.add(int(line[line.find('0x') + 2:], 16))
-                if len(indicators) >= (2 if is_read_only else 4):
-                    break
-           
+    for buf, end in iter_buffers(gz_file_path):
+        indicators.update(spinlock_indicators(buf, end))
+        if len(indicators) >= count:
+            break
+    return sorted(indicators)
+
+def read_indicators(sidecar):
+    with open(sidecar, 'r') as file:
+        return [int(line, 16) for line in file if line.strip()]
+
+def write_indicators(sidecar, indicators):
+    # written aside and renamed, a concurrent reader sees all of it or nothing
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(sidecar) or '.')
+    with os.fdopen(fd, 'w') as file:
+        file.writelines('%#x\n' % i for i in sorted(indicators))
+    os.replace(temp_path, sidecar)
+
+def load_indicators(directory, gz_file_paths):
+    """
+    All thread traces of a run share the lock code addresses, so the spinlock
+    indicators are discovered once per directory and cached in a sidecar file.
+    Returns None if no trace has enough of them.
+    """
+    sidecar = directory + '/' + INDICATORS_FILE
+    if os.path.exists(sidecar):
+        return read_indicators(sidecar)
+    count = num_indicators(directory)
+    for gz_file_path in sorted(gz_file_paths, key=os.path.getsize, reverse=True):
+        indicators = scan_indicators(gz_file_path, count)
+        if len(indicators) >= count:
+            write_indicators(sidecar, indicators)
+            return indicators
+    return None
+
+class SharedIndicators:
+    """
+    The spinlock indicators of a run whose traces are filtered concurrently,
+    as they are written (see pipeline). The first TraceProcessor to have seen
+    all of them writes the sidecar file, the others pick them up from there.
+    streams is a multiprocessing.Value counting the traces that have not
+    ended yet, one more while the writer may still start some.
+    """
+
+    def __init__(self, directory, streams):
+        self.sidecar = directory + '/' + INDICATORS_FILE
+        self.streams = streams
+        self.ended = False
+
+    def load(self):
+        if not os.path.exists(self.sidecar):
+            return None
+        return read_indicators(self.sidecar)
+
+    def publish(self, indicators):
+        if not os.path.exists(self.sidecar):
+            write_indicators(self.sidecar, indicators)
+
+    def end_stream(self):
+        if self.ended:
+            return
+        self.ended = True
+        with self.streams.get_lock():
+            self.streams.value -= 1
+
+    def wait(self):
+        """
+        At the end of a trace: the indicators once another trace published
+        them, None once every trace ended without.
+        """
+        self.end_stream()
+        while True:
+            # a trace publishes before it ends, so look after the count
+            done = self.streams.value <= 0
+            indicators = self.load()
+            if indicators is not None or done:
+                return indicators
+            time.sleep(POLL_INTERVAL)
+
+def indicator_map(indicators, directory):
+    is_read_only = is_read_only_run(directory)
     indicatorsaddr2val = {}
     indicators = sorted([_ for _ in indicators])
     
@@ -137,37 +199,151 @@ def process_gz_file(gz_file_path, shmem_ranges, directory):
             ru = indicators[1]
             indicatorsaddr2val[rl] = 1
             indicatorsaddr2val[ru] = 3
-                 
-    # print(indicatorsaddr2val)
-
-    # Open the original .gz file and a temporary file for output
-    start_convert_spinlock_to_indicator = False
-    with gzip.open(gz_file_path, 'rt') as gz_file, gzip.open(temp_file_path, 'wt') as temp_file:
-        for line in gz_file:
-            modified_line, is_barrier, s = process_line(line, profile_enabled, shmem_ranges, indicatorsaddr2val, start_convert_spinlock_to_indicator, lock_acc_addrs, preserve_futex)
-            start_convert_spinlock_to_indicator = s
-            if is_barrier:
-                profile_enabled = not profile_enabled
-            # Write the modified line to temp file if not deleted
-            if modified_line is not None:
-                temp_file.write(modified_line)
-    
-    assert(len(lock_acc_addrs) == 0)
-    
+    return indicatorsaddr2val
+
+class TraceProcessor:
+    """
+    Filter one trace fed a buffer of whole lines at a time. Lines are held
+    back until the indicator map is known, from the caller or from enough
+    spinlock indicators seen in the trace itself, and the rules are compiled.
+    Without compiled rules they are compiled once mem_meta.txt exists: a
+    trace prism is still writing can start before the benchmark wrote it.
+    With shared SharedIndicators the indicators of the whole run are used as
+    soon as any of its traces has seen them all, this trace's own only if
+    none has by its end. At most MAX_PENDING bytes are held back.
+    """
+
+    def __init__(self, gz_file_path, directory, write, compiled=None, indicatorsaddr2val=None,
+                 shared=None):
+        self.gz_file_path = gz_file_path
+        self.directory = directory
+        self.write = write
+        self.compiled = compiled
+        self.indicatorsaddr2val = indicatorsaddr2val
+        self.shared = shared
+        self.lock_acc_addrs = load_lock_acc_addrs(directory, trace_tid(gz_file_path))
+        if self.lock_acc_addrs is None:
+            raise FileNotFoundError('%s: no lock_acc_addr file' % gz_file_path)
+        self.count = num_indicators(directory)
+        self.indicators = set()
+        self.pending = bytearray()
+        self.trace_filter = None
+        self.try_start()
+
+    def try_start(self, eof=False):
+        if self.compiled is None and (eof or os.path.exists(self.directory + '/' + MEM_META_FILE)):
+            self.compiled = directory_rules(self.directory)
+        if self.compiled is None or self.indicatorsaddr2val is None:
+            return
+        self.trace_filter = self.compiled.new_filter(self.indicatorsaddr2val, self.lock_acc_addrs,
+                                                     self.gz_file_path)
+        self.trace_filter.filter_buffer(self.pending, 0, len(self.pending), self.write)
+        self.pending = None
+
+    def feed(self, buf, end):
+        if self.trace_filter is not None:
+            self.trace_filter.filter_buffer(buf, 0, end, self.write)
+            return
+        with memoryview(buf) as mv:
+            self.pending += mv[:end]
+        if self.indicatorsaddr2val is None:
+            self.indicators.update(spinlock_indicators(buf, end))
+            if len(self.indicators) >= self.count:
+                self.indicatorsaddr2val = indicator_map(self.indicators, self.directory)
+                if self.shared is not None:
+                    self.shared.publish(self.indicators)
+            elif self.shared is not None:
+                indicators = self.shared.load()
+                if indicators is not None:
+                    self.indicatorsaddr2val = indicator_map(indicators, self.directory)
+        self.try_start()
+        if self.trace_filter is None and len(self.pending) > MAX_PENDING:
+            waiting = 'spinlock indicators' if self.indicatorsaddr2val is None else MEM_META_FILE
+            raise ValueError('%s: more than %d bytes held back waiting for the %s'
+                             % (self.gz_file_path, MAX_PENDING, waiting))
+
+    def close(self):
+        if self.trace_filter is None:
+            if self.indicatorsaddr2val is None and self.shared is not None:
+                indicators = self.shared.wait()
+                if indicators is not None:
+                    self.indicatorsaddr2val = indicator_map(indicators, self.directory)
+            if self.indicatorsaddr2val is None:
+                if self.indicators:
+                    raise ValueError('%s: found %d of %d spinlock indicators'
+                                     % (self.gz_file_path, len(self.indicators), self.count))
+                # no spinlocks in this trace
+                self.indicatorsaddr2val = {}
+            self.try_start(eof=True)
+        check_lock_records(self.trace_filter, self.gz_file_path, self.lock_acc_addrs)
+
+def check_lock_records(trace_filter, gz_file_path, lock_acc_addrs):
+    remaining = trace_filter.remaining_lock_acc_addrs()
+    if remaining:
+        raise ValueError('%s: %d lock records short of the %d lock operations in lock_acc_addr'
+                         % (gz_file_path, remaining, len(lock_acc_addrs)))
+
+def filter_chunk(data, compiled, indicatorsaddr2val, lock_acc_addrs, state, level):
+    trace_filter = compiled.new_filter(indicatorsaddr2val, lock_acc_addrs)
+    trace_filter.set_state(state)
+    out = bytearray()
+    trace_filter.filter_buffer(data, 0, len(data), out.extend)
+    return [gzip.compress(out, level, mtime=0)]
+
+def split_gz_file(gz_file_path, temp_file_path, compiled, directory, indicatorsaddr2val, workers):
+    """
+    Filter one trace on workers processes. Each chunk starts in the
+    state the chunks before it left the filter in, which a scan of their
+    sync records gives, and gets just the lock_acc_addr entries it uses.
+    """
+    lock_acc_addrs = load_lock_acc_addrs(directory, trace_tid(gz_file_path))
+    if lock_acc_addrs is None:
+        raise FileNotFoundError('%s: no lock_acc_addr file' % gz_file_path)
+    scanner = compiled.new_filter(indicatorsaddr2val, lock_acc_addrs, gz_file_path)
+
+    def split(data):
+        profile_enabled, started, records = scanner.get_state()
+        scanner.skip_buffer(data, 0, len(data))
+        first = records // RECORDS_PER_OP
+        last = -(-scanner.lock_acc.records // RECORDS_PER_OP)
+        return (compiled, indicatorsaddr2val, np.array(lock_acc_addrs[first:last]),
+                (profile_enabled, started, records - first * RECORDS_PER_OP), COMPRESS_LEVEL)
+
+    map_chunks(gz_file_path, [temp_file_path], split, filter_chunk, workers)
+    check_lock_records(scanner, gz_file_path, lock_acc_addrs)
+
+def process_gz_file(gz_file_path, compiled, directory, indicatorsaddr2val=None):
+    """
+    Filter one trace in a single decompression pass. Without a known
+    indicator map the leading lines are buffered until enough spinlock
+    indicators have been seen to build it.
+    """
+    # Temporary file to store modifications
+    temp_file_path = gz_file_path + ".tmp"
+
+    workers = SPLIT_WORKERS or job_cpus()
+    if (indicatorsaddr2val is not None and workers > 1
+            and os.path.getsize(gz_file_path) >= SPLIT_MIN_SIZE):
+        split_gz_file(gz_file_path, temp_file_path, compiled, directory, indicatorsaddr2val, workers)
+    else:
+        # Read the original .gz file as bytes into a reused buffer, kept lines are
+        # copied to the temporary file without decoding them
+        with open_sink(temp_file_path, COMPRESS_LEVEL, min(COMPRESS_THREADS, job_cpus()), text=False) as temp_file:
+            processor = TraceProcessor(gz_file_path, directory, temp_file.write, compiled, indicatorsaddr2val)
+            for buf, end in iter_buffers(gz_file_path):
+                processor.feed(buf, end)
+            processor.close()
+
     # Replace the original file with the modified temp file
     os.replace(temp_file_path, gz_file_path)
     print(f"Processed and updated '{gz_file_path}'")
 
-def main(directories):
-    ps = []
+def main(directories, max_workers=None, use_sidecar=True):
+    # one queue of trace files across all directories
+    jobs = []
     for directory in directories:
-        p = multiprocessing.Process(target=process_directory, args=(directory,))
-        ps.append(p)
-        p.start()
-    for p in ps:
-        p.join()
-        # process_directory(directory)
-        # print(f"Finished processing directory: {directory}")
+        jobs += directory_jobs(directory, use_sidecar)
+    run_file_jobs(jobs, max_workers)
 
 root_path = '/home/yanpeng/GCP_gem5/prism/GCP_scripts/result/'
 
@@ -1,101 +1,301 @@
-from os import listdir
-from os.path import isfile, join
+"""
+Experiment sweeps of the lock micro benchmark under prism/stgen.
+
+A sweep is a dict of parameters; every list valued parameter is swept and
+the Cartesian product gives the runs. The parameters come from a YAML file
+(see sweep.yaml) on top of the defaults below:
+
+    $ python run.py sweep.yaml -j 8 --mem-per-job 6
+
+Each run prints its lock_acc_addr files, turns them into binary sidecars
+(lock_addrs.py), then traces the benchmark with prism into its result
+directory. Runs are started as long as CPUs and memory allow
+(--cpus-per-job, --mem-per-job, MemAvailable of the machine).
+A run whose result directory already holds a non-empty sigil.stats.out,
+which prism writes at exit, is complete and skipped, so rerunning a sweep
+after a crash or a failed run only runs what is missing.
+
+With pipeline: true the traces are post-processed, and the gcp traces
+derived, while prism writes them (see pipeline.py); such a run is complete
+once its pipeline.done exists as well.
+"""
+
+import os
+import sys
+import time
+import shlex
+import signal
+import argparse
+import itertools
 import subprocess
+
 import yaml
-import argparse
-import shlex
-import os
 
-running_procs = []
-MAX_PROCS = 1
-total_procs = 0
-
-bin_dir = '/home/yanpeng/mind_internal/mind_linux/test_programs/07_lock_micro_benchmark/bin/'
-workload_dir = '/home/yanpeng/GCP_gem5/workloads/ycsb_workloads/'
-log_dir_dir = 'log/'
-result_dir_dir = 'result/'
-
-# workloads = {
-#     'kvs' : ['run_workloada.dat', 'run_workloadb.dat', 'run_workloadc.dat'],
-#     # 'kc': ['run_workloadl.dat', 'run_workloadh.dat'],
-# }
-workloads = {
-    'kvs' : ['run_workloada.dat', ],
+from pipeline import Pipeline, DONE_FILE
+
+# defaults of every sweep, a config file overrides them
+defaults = {
+    'bin_dir': '/home/yanpeng/mind_internal/mind_linux/test_programs/07_lock_micro_benchmark/bin/',
+    'workload_dir': '/home/yanpeng/GCP_gem5/workloads/ycsb_workloads/',
+    'log_dir_dir': 'log/',
+    'result_dir_dir': 'result/',
+    'prism': '../../../build/bin/prism',
+
+    'app': 'kvs',
+    'workload': ['run_workloada.dat', ],
+    'lock_type': ['pthread_rwlock_prefer_w', 'percpu', 'cohort_rw_spin_mutex', 'mcs'],
+    'num_locks': 80,
+    'num_nodes': 4,
+    'num_threads_per_nodes': 8,
+
+    'warmup_iters': 0,
+    'num_iters': 200,
+    'req_interval': 0,
+    'rmax': 0,
+    'wmax': 0,
+    'prism_rw_batch': 1,  # defaul 100
+
+    # post_process and gen_gcp_trace on the traces while prism writes them
+    'pipeline': False,
+
+    # must name every swept parameter, post_process & co. parse this layout
+    'run_id': '{app}_{workload}_{lock_type}_{num_nodes}_{num_threads_per_nodes}',
 }
-# workloads = {
-#     'kvs' : ['run_workloadb.dat', 'run_workloadc.dat'],
-# }
 
-num_threads_per_nodess = [8, ]
-# num_threads_per_nodess = [8, ]
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MEM_META_FILE = 'mem_meta.txt'
+LOCK_ACC_ADDR_DIR = 'lock_acc_addr/'
+STATS_FILE = 'sigil.stats.out'
+
+# seconds a new run is assumed to still be growing towards --mem-per-job
+MEM_SETTLE = 30
+POLL_INTERVAL = 0.5
+
+
+def load_config(path):
+    config = dict(defaults)
+    if path:
+        with open(path, 'r') as file:
+            config.update(yaml.safe_load(file) or {})
+    unknown = set(config) - set(defaults)
+    if unknown:
+        raise ValueError('unknown sweep parameters: %s' % ', '.join(sorted(unknown)))
+    return config
+
+
+def expand(config):
+    """
+    One parameter dict per run, the product of all list valued parameters
+    in config order. Fails if two runs would share a run id.
+    """
+    swept = [k for k, v in config.items() if isinstance(v, list)]
+    runs = []
+    seen = {}
+    for values in itertools.product(*(config[k] for k in swept)):
+        run = dict(config)
+        run.update(zip(swept, values))
+        run['run_id'] = config['run_id'].format(**run)
+        if run['run_id'] in seen:
+            raise ValueError('runs %s and %s share the run id %s, add the swept parameters to run_id'
+                             % (seen[run['run_id']], values, run['run_id']))
+        seen[run['run_id']] = values
+        runs.append(run)
+    return runs
 
-# num_nodess = [16, ]
-# num_nodess = [16, 8, 4, 2, 1]
-num_nodess = [4, ]
 
-num_lockss = [80, ]
+def benchmark_args(run, mem_file):
+    return [str(a) for a in (run['num_nodes'], run['num_threads_per_nodes'], run['num_locks'],
+                             run['lock_type'], run['log_dir_dir'] + run['run_id'],
+                             run['warmup_iters'], run['num_iters'], run['req_interval'],
+                             mem_file, run['workload_dir'] + run['workload'],
+                             run['rmax'], run['wmax'])]
 
-lock_types = ['pthread_rwlock_prefer_w', 'percpu', 'cohort_rw_spin_mutex', 'mcs',
-            #   'pthread_mutex'
-              ]
-# lock_types = ['pthread_mutex', ]
-# lock_types = ['pthread_rwlock_prefer_w', ]
-# lock_types = ['mcs', ]
-# lock_types = ['percpu', ]
-# lock_types = ['cohort_rw_spin_mutex', ]
 
-warmup_iters = 0
+def result_dir(run):
+    return run['result_dir_dir'] + run['run_id']
 
-num_iters = 200
-# num_iters = 20000
 
-req_interval = 0
-rmax = 0
-wmax = 0
-prism_rw_batch = 1 # defaul 100
+def run_commands(run):
+    """
+    The (argv, cwd, log file) steps of a run.
+    """
+    bin_file = run['bin_dir'] + run['app']
+    res = result_dir(run)
+    lock_acc_addr_printer = ([bin_file + '_lock_acc_addr']
+                             + benchmark_args(run, res + '/' + LOCK_ACC_ADDR_DIR))
+    prism = (shlex.split('%s --backend=stgen -ltextv2 -c %d --executable=%s'
+                         % (run['prism'], run['prism_rw_batch'], bin_file))
+             + benchmark_args(run, MEM_META_FILE))
+    lock_acc_addr_sidecars = [sys.executable, os.path.join(SCRIPT_DIR, 'lock_addrs.py'), res]
+    return [(lock_acc_addr_printer, None, res + '/lock_acc_addr.log'),
+            (lock_acc_addr_sidecars, None, res + '/lock_addrs.log'),
+            (prism, res, res + '/prism.log')]
+
+
+def trace_tids(run):
+    # the main thread and the benchmark threads
+    return range(1, run['num_nodes'] * run['num_threads_per_nodes'] + 2)
+
+
+def is_complete(run):
+    path = result_dir(run) + '/' + STATS_FILE
+    if run['pipeline'] and not os.path.exists(result_dir(run) + '/' + DONE_FILE):
+        return False
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+
+def mem_available():
+    # bytes, None where /proc/meminfo is missing
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Job:
+    """
+    A run going through its steps one subprocess at a time.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.steps = run_commands(run)
+        self.proc = None
+        self.pipeline = None
+        self.log = None
+        self.started = None
+        self.returncode = None
+
+    def start_step(self):
+        argv, cwd, log_path = self.steps.pop(0)
+        self.log = open(log_path, 'w')
+        print(' '.join(shlex.quote(a) for a in argv))
+        if self.run['pipeline'] and not self.steps:
+            # the prism step, its trace files have to be FIFOs first
+            self.pipeline = Pipeline(result_dir(self.run), trace_tids(self.run))
+            self.pipeline.start()
+        self.proc = subprocess.Popen(argv, cwd=cwd, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def start(self):
+        os.makedirs(result_dir(self.run) + '/' + LOCK_ACC_ADDR_DIR, exist_ok=True)
+        self.started = time.time()
+        self.start_step()
+
+    def poll(self):
+        """
+        Advance the job, True once it is done.
+        """
+        returncode = self.proc.poll()
+        if returncode is None:
+            return False
+        if self.pipeline is not None:
+            if not self.pipeline.poll():
+                return False
+            if self.pipeline.finish() and returncode == 0:
+                returncode = 1
+            self.pipeline = None
+        self.log.close()
+        if returncode != 0 or not self.steps:
+            self.returncode = returncode
+            return True
+        self.start_step()
+        return False
+
+    def kill(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        if self.pipeline is not None:
+            self.pipeline.kill()
+
+
+class Scheduler:
+    """
+    Start pending jobs while the CPU and memory budget allows.
+    """
+
+    def __init__(self, max_cpus, cpus_per_job=1, mem_per_job=0):
+        self.max_cpus = max_cpus
+        self.cpus_per_job = cpus_per_job
+        self.mem_per_job = mem_per_job
+        self.running = []
+
+    def can_start(self):
+        if not self.running:
+            return True
+        if (len(self.running) + 1) * self.cpus_per_job > self.max_cpus:
+            return False
+        available = mem_available()
+        if self.mem_per_job and available is not None:
+            # runs that just started haven't allocated their memory yet
+            now = time.time()
+            settling = sum(1 for job in self.running if now - job.started < MEM_SETTLE)
+            if available - settling * self.mem_per_job < self.mem_per_job:
+                return False
+        return True
+
+    def run(self, jobs):
+        """
+        Run all jobs, return the failed ones.
+        """
+        pending = list(jobs)
+        failed = []
+        done = 0
+        try:
+            while pending or self.running:
+                while pending and self.can_start():
+                    job = pending.pop(0)
+                    job.start()
+                    self.running.append(job)
+                for job in [j for j in self.running if j.poll()]:
+                    self.running.remove(job)
+                    done += 1
+                    status = 'finished' if job.returncode == 0 else 'failed (%d)' % job.returncode
+                    print('[%d/%d] %s %s' % (done, len(jobs), status, job.run['run_id']))
+                    if job.returncode != 0:
+                        failed.append(job)
+                time.sleep(POLL_INTERVAL)
+        except BaseException:
+            for job in self.running:
+                job.kill()
+            raise
+        return failed
+
+
+def main(config_path=None, max_cpus=None, cpus_per_job=1, mem_per_job=0, dry_run=False):
+    runs = expand(load_config(config_path))
+    todo = [run for run in runs if not is_complete(run)]
+    print('%d runs, %d complete, %d to run' % (len(runs), len(runs) - len(todo), len(todo)))
+    if dry_run:
+        for run in todo:
+            for argv, cwd, _ in run_commands(run):
+                print(('cd %s && ' % cwd if cwd else '') + ' '.join(shlex.quote(a) for a in argv))
+        return []
+    scheduler = Scheduler(max_cpus or os.cpu_count() or 1, cpus_per_job, mem_per_job)
+    failed = scheduler.run([Job(run) for run in todo])
+    for job in failed:
+        print('failed: %s, see %s' % (job.run['run_id'], job.log.name))
+    return failed
+
 
 if __name__ == "__main__":
-    for app in workloads:
-        for workload in workloads[app]:
-            for lock_type in lock_types:
-                for num_locks in num_lockss:
-                    for num_nodes in num_nodess:
-                        for num_threads_per_nodes in num_threads_per_nodess:
-                            bin_file = bin_dir + app
-                            run_file = workload_dir + workload
-                            run_id = '_'.join((app, workload, lock_type, str(num_nodes), str(num_threads_per_nodes)))
-                            log_dir = log_dir_dir + run_id
-                            result_dir = result_dir_dir + run_id
-                            print(result_dir)
-                            
-                            mem_addr_file = 'mem_meta.txt'
-                            lock_acc_addr_dir = 'lock_acc_addr/'
-                            
-                            os.system('cd %s && mkdir -p %s' % (result_dir, lock_acc_addr_dir))
-                            lock_acc_addr_printer_cmd = ' '.join((bin_file + '_lock_acc_addr', str(num_nodes), str(num_threads_per_nodes), str(num_locks),
-                                        lock_type, log_dir, str(warmup_iters), str(num_iters), str(req_interval),
-                                        result_dir + '/' + lock_acc_addr_dir, run_file, str(rmax), str(wmax)))
-                            # print(lock_acc_addr_printer_cmd)
-                            os.system(lock_acc_addr_printer_cmd)
-                            
-                            os.system('mkdir -p %s' % result_dir)
-                            cmd = '../../../build/bin/prism --backend=stgen -ltextv2 -c %d --executable=' % prism_rw_batch
-                            # cmd = '../../../build/bin/prism --backend=stgen --executable='
-                            gcp_cmd = ' '.join((bin_file, str(num_nodes), str(num_threads_per_nodes), str(num_locks),
-                                        lock_type, log_dir, str(warmup_iters), str(num_iters), str(req_interval),
-                                        mem_addr_file, run_file, str(rmax), str(wmax)))
-                            cmd += gcp_cmd
-                            print(cmd)
-                            cmds = shlex.split(cmd)
-                            
-                            running_procs.append(subprocess.Popen(cmds, cwd=result_dir))
-                            while (len(running_procs) == MAX_PROCS):
-                                for i,p in enumerate(running_procs):
-                                    try:
-                                        p.wait(timeout=1)
-                                        running_procs.pop(i)
-                                        total_procs += 1
-                                        print("finished: %d" % (total_procs))
-                                        break
-                                    except subprocess.TimeoutExpired:
-                                        pass
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Run a sweep of lock benchmark traces')
+    parser.add_argument('config', nargs='?', help='YAML sweep config, default: the defaults of run.py')
+    parser.add_argument('-j', '--max-cpus', type=int, default=None,
+                        help='CPUs to use, default: all')
+    parser.add_argument('--cpus-per-job', type=int, default=1)
+    parser.add_argument('--mem-per-job', type=float, default=0,
+                        help='GB a run needs, runs only start while that much memory is available')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only print the commands to run')
+    args = parser.parse_args()
+
+    # let Ctrl-C and kill stop the running traces too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    failed = main(args.config, args.max_cpus, args.cpus_per_job,
+                  int(args.mem_per_job * (1 << 30)), args.dry_run)
+    sys.exit(1 if failed else 0)
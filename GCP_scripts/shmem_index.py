@@ -0,0 +1,79 @@
+"""
+Sorted, merged interval index over the shared memory regions in mem_meta.txt.
+
+Regions are half-open [begin, end) as written by the benchmark; trace address
+ranges ('$'/'*' pairs) are inclusive [start, end] as written by stgen.
+"""
+
+from bisect import bisect_right
+
+import numpy as np
+
+
+def read_mem_meta(directory):
+    """
+    Return the (begin, end, name) regions listed in <directory>/mem_meta.txt.
+    """
+    regions = []
+    with open(directory + '/mem_meta.txt', 'r') as file:
+        for line in file:
+            parts = line.strip().split()
+            if len(parts) == 3:
+                start_addr, end_addr, name = parts
+                regions.append((int(start_addr, 16), int(end_addr, 16), name))
+    return regions
+
+
+class IntervalIndex:
+
+    def __init__(self, ranges):
+        merged = []
+        for b, e in sorted((b, e) for b, e in ranges if b < e):
+            if merged and b <= merged[-1][1]:
+                if e > merged[-1][1]:
+                    merged[-1][1] = e
+            else:
+                merged.append([b, e])
+        self.begins = [b for b, _ in merged]
+        self.ends = [e for _, e in merged]
+        self.np_begins = np.array(self.begins, dtype=np.uint64)
+        self.np_ends = np.array(self.ends, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.begins)
+
+    def contains(self, addr):
+        i = bisect_right(self.begins, addr) - 1
+        return i >= 0 and addr < self.ends[i]
+
+    def overlaps(self, start, end):
+        """
+        True if the inclusive range [start, end] touches any region.
+        """
+        i = bisect_right(self.begins, end) - 1
+        return i >= 0 and start < self.ends[i]
+
+    def contains_many(self, addrs):
+        """
+        Vectorized contains() over an array of addresses, returns a bool array.
+        """
+        addrs = np.asarray(addrs, dtype=np.uint64)
+        i = np.searchsorted(self.np_begins, addrs, side='right').astype(np.int64) - 1
+        hit = i >= 0
+        hit[hit] = addrs[hit] < self.np_ends[i[hit]]
+        return hit
+
+    def overlaps_many(self, starts, ends):
+        """
+        Vectorized overlaps() over arrays of inclusive ranges, returns a bool array.
+        """
+        starts = np.asarray(starts, dtype=np.uint64)
+        ends = np.asarray(ends, dtype=np.uint64)
+        i = np.searchsorted(self.np_begins, ends, side='right').astype(np.int64) - 1
+        hit = i >= 0
+        hit[hit] = starts[hit] < self.np_ends[i[hit]]
+        return hit
+
+
+def load_shmem_index(directory):
+    return IntervalIndex((b, e) for b, e, _ in read_mem_meta(directory))
@@ -0,0 +1,429 @@
+#!/bin/python
+
+# Phase detection and representative intervals (SimPoint) of the runs of the
+# lock micro benchmark, to replay a fraction of every trace in gem5.
+#
+# Every thread trace is cut into intervals of --interval '! 4096' markers.
+# Per interval a signature is built from
+#   - the op mix, the iops,flops,reads,writes of its '@' lines
+#   - a histogram of the pages of their first address range, hashed into
+#     PAGE_BINS bins
+#   - its sync density: barriers, spinlocks, spinunlocks, post_process lock
+#     records and other '^' lines per event
+# the first two normalized to sum 1. The intervals of a thread that retired
+# instructions are clustered by k-means, k picked by BIC like SimPoint does,
+# and the interval closest to the center of each cluster represents it,
+# weighted by the instructions of the cluster.
+#
+# The reduced trace of a thread keeps its representative intervals whole.
+# Of every other interval only the sync skeleton stays: its '^' lines and
+# lock records, so barriers, locks and lock_acc_addr still line up across
+# threads and the reduced run replays like the full one. Comm edges of the
+# kept intervals are renumbered to the events of the reduced producer
+# traces; an edge to a dropped event points to the last kept one before it.
+#
+# The reduced run is written to <result dir>_simpoint/<run id> with the
+# .out files, mem_meta.txt, lock_acc_addr and simpoints.txt, one line per
+# representative:
+#
+#   <tid> <interval> <cluster> <weight> <first eid> <end eid> <markers>
+
+import os
+import re
+import glob
+import shutil
+import argparse
+from bisect import bisect_right
+
+import numpy as np
+
+from file_pool import run_file_jobs, job_cpus
+from trace_io import iter_buffers, open_sink
+from lock_addrs import trace_tid
+
+NEWLINE = ord('\n')
+MARKER_CODE = ord('!')
+SYNC_CODE = ord('^')
+COMP_CODE = ord('@')
+
+PLAIN_MARKER = np.frombuffer(b'! 4096', dtype=np.uint8)
+# gen_gcp_trace's stand-in for a hot bucket access, not a lock record
+HOT_RECORD = np.frombuffer(b'! 9999', dtype=np.uint8)
+
+# '@ <iops>,<flops>,<reads>,<writes>' and the start of its first range
+COMP_RE = re.compile(rb'^@ (\d+),(\d+),(\d+),(\d+)(?: [$*] 0x([0-9a-fA-F]+))?', re.M)
+SYNC_RE = re.compile(rb'^\^ (\d+)\^', re.M)
+# producer thread and event of a comm edge
+EDGE_RE = re.compile(rb'# (\d+) (\d+) ')
+
+SYNC_BARRIER = 5
+SYNC_SPINLOCK = 9
+SYNC_SPINUNLOCK = 10
+# sync mix columns: barrier, spinlock, spinunlock, lock record, other
+SYNC_COLUMNS = 5
+LOCK_RECORD_COLUMN = 3
+
+PAGE_SHIFT = 12
+PAGE_BINS = 64
+
+# markers per interval, 1000 markers are about 4M instructions
+INTERVAL = 1000
+MAX_K = 10
+# smallest k whose BIC is at least this far from the worst to the best one
+BIC_THRESHOLD = 0.9
+KMEANS_ITERATIONS = 100
+KMEANS_SEEDS = 3
+SEED = 1
+
+# gzip level and deflate threads of the reduced traces, fewer threads when the
+# job's share of the CPUs is smaller, see file_pool.job_cpus
+COMPRESS_LEVEL = 6
+COMPRESS_THREADS = 4
+
+SIMPOINTS_FILE = 'simpoints.txt'
+
+root_path = '/home/yanpeng/GCP_gem5/prism/GCP_scripts/result/'
+
+workloads = {
+    'kvs' : ['run_workloada.dat', ],
+}
+
+num_threads_per_nodess = [8, ]
+
+num_nodess = [4, ]
+
+lock_types = ['gcp', ]
+
+
+def line_starts(data):
+    starts = np.flatnonzero(data == NEWLINE) + 1
+    starts = np.concatenate(([0], starts[starts < len(data)]))
+    return starts
+
+
+def scan_lines(buf, end):
+    """
+    (data, starts, codes, plain marker lines, lock record lines) of the
+    whole lines of buf[:end]; lock records are the '!' lines that are
+    neither markers nor hot bucket records.
+    """
+    data = np.frombuffer(buf, dtype=np.uint8, count=end)
+    starts = line_starts(data)
+    codes = data[starts]
+    lengths = np.diff(np.append(starts, end))
+    lengths -= data[starts + lengths - 1] == NEWLINE
+    markers = np.flatnonzero(codes == MARKER_CODE)
+    plain = np.zeros(len(markers), dtype=bool)
+    hot = np.zeros(len(markers), dtype=bool)
+    fits = lengths[markers] == len(PLAIN_MARKER)
+    head = data[starts[markers[fits]][:, None] + np.arange(len(PLAIN_MARKER))]
+    plain[fits] = (head == PLAIN_MARKER).all(axis=1)
+    hot[fits] = (head == HOT_RECORD).all(axis=1)
+    return data, starts, codes, markers[plain], markers[~plain & ~hot]
+
+
+def grow(array, length):
+    if len(array) >= length:
+        return array
+    out = np.zeros((length,) + array.shape[1:], dtype=array.dtype)
+    out[:len(array)] = array
+    return out
+
+
+def page_bins(addrs):
+    # multiplicative hash of the page number
+    pages = (addrs >> np.uint64(PAGE_SHIFT)) * np.uint64(0x9E3779B97F4A7C15)
+    return ((pages >> np.uint64(32)) % np.uint64(PAGE_BINS)).astype(np.int64)
+
+
+def profile_trace(gz_file_path, interval=INTERVAL):
+    """
+    Per interval of a thread trace: its signature counts, events and
+    markers. Also the event ids of its '^' lines.
+    """
+    ops = np.zeros((0, 4), dtype=np.int64)
+    pages = np.zeros((0, PAGE_BINS), dtype=np.int64)
+    syncs = np.zeros((0, SYNC_COLUMNS), dtype=np.int64)
+    events = np.zeros(0, dtype=np.int64)
+    markers = np.zeros(0, dtype=np.int64)
+    sync_eids = []
+    marker_total = 0
+    eid_total = 0
+    for buf, end in iter_buffers(gz_file_path):
+        data, starts, codes, plain, records = scan_lines(buf, end)
+        is_marker = np.zeros(len(starts), dtype=np.int64)
+        is_marker[plain] = 1
+        line_interval = (marker_total + np.cumsum(is_marker) - is_marker) // interval
+        is_event = (codes != MARKER_CODE).astype(np.int64)
+        line_eid = eid_total + np.cumsum(is_event) - is_event
+        marker_total += len(plain)
+        eid_total += int(is_event.sum())
+        n = int(line_interval[-1]) + 1
+        ops, pages, syncs = grow(ops, n), grow(pages, n), grow(syncs, n)
+        events = grow(events, n)
+        markers = grow(markers, n)
+        events[:n] += np.bincount(line_interval, weights=is_event, minlength=n).astype(np.int64)
+        markers[:n] += np.bincount(line_interval[plain], minlength=n)
+
+        comps = list(COMP_RE.finditer(buf, 0, end))
+        if comps:
+            where = line_interval[np.searchsorted(starts, [m.start() for m in comps])]
+            counts = np.array([m.group(1, 2, 3, 4) for m in comps]).astype(np.int64)
+            for column in range(4):
+                ops[:n, column] += np.bincount(where, weights=counts[:, column], minlength=n).astype(np.int64)
+            addressed = [i for i, m in enumerate(comps) if m[5] is not None]
+            if addressed:
+                addrs = np.array([int(comps[i][5], 16) for i in addressed], dtype=np.uint64)
+                np.add.at(pages, (where[addressed], page_bins(addrs)), 1)
+
+        sync_lines = list(SYNC_RE.finditer(buf, 0, end))
+        if sync_lines:
+            lines = np.searchsorted(starts, [m.start() for m in sync_lines])
+            sync_type = np.array([int(m[1]) for m in sync_lines], dtype=np.int64)
+            column = np.select([sync_type == SYNC_BARRIER, sync_type == SYNC_SPINLOCK,
+                                sync_type == SYNC_SPINUNLOCK], [0, 1, 2], 4)
+            np.add.at(syncs, (line_interval[lines], column), 1)
+            sync_eids.append(line_eid[lines])
+        np.add.at(syncs, (line_interval[records], LOCK_RECORD_COLUMN), 1)
+
+    n = max(len(events), 1)
+    return {'path': gz_file_path, 'ops': grow(ops, n), 'pages': grow(pages, n), 'syncs': grow(syncs, n),
+            'events': grow(events, n), 'markers': grow(markers, n),
+            'sync_eids': np.concatenate(sync_eids) if sync_eids else np.zeros(0, dtype=np.int64)}
+
+
+def signatures(profile):
+    parts = []
+    for name, total in (('ops', None), ('pages', None), ('syncs', profile['events'][:, None])):
+        counts = profile[name].astype(np.float64)
+        if total is None:
+            total = counts.sum(axis=1, keepdims=True)
+        parts.append(np.divide(counts, total, out=np.zeros_like(counts), where=total > 0))
+    return np.hstack(parts)
+
+
+def kmeans(points, k, rng, iterations=KMEANS_ITERATIONS):
+    """
+    k-means++ seeding and Lloyd iterations. Returns labels, centers, SSE.
+    """
+    n = len(points)
+    centers = np.empty((k, points.shape[1]))
+    centers[0] = points[rng.integers(n)]
+    d2 = ((points - centers[0]) ** 2).sum(axis=1)
+    for j in range(1, k):
+        total = d2.sum()
+        centers[j] = points[rng.choice(n, p=d2 / total) if total > 0 else rng.integers(n)]
+        d2 = np.minimum(d2, ((points - centers[j]) ** 2).sum(axis=1))
+    norms = (points ** 2).sum(axis=1)
+    labels = None
+    for _ in range(iterations):
+        dist = norms[:, None] - 2 * points @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+        new = dist.argmin(axis=1)
+        if labels is not None and (new == labels).all():
+            break
+        labels = new
+        for j in range(k):
+            members = labels == j
+            if members.any():
+                centers[j] = points[members].mean(axis=0)
+    sse = float(((points - centers[labels]) ** 2).sum())
+    return labels, centers, sse
+
+
+def bic(points, labels, centers):
+    # Pelleg and Moore's BIC of a spherical Gaussian mixture, as in SimPoint
+    r, m = points.shape
+    k = len(centers)
+    if r <= k:
+        return -np.inf
+    variance = max(float(((points - centers[labels]) ** 2).sum()) / (m * (r - k)), 1e-12)
+    sizes = np.bincount(labels, minlength=k)
+    sizes = sizes[sizes > 0].astype(np.float64)
+    loglik = (sizes * np.log(sizes) - sizes * np.log(r) - sizes * m / 2 * np.log(2 * np.pi * variance)
+              - (sizes - k) / 2).sum()
+    return loglik - (k - 1 + m * k + 1) / 2 * np.log(r)
+
+
+def cluster(points, max_k=MAX_K, seed=SEED):
+    """
+    Labels and centers of the smallest k within BIC_THRESHOLD of the best BIC.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for k in range(1, min(max_k, len(points)) + 1):
+        labels, centers, _ = min((kmeans(points, k, rng) for _ in range(KMEANS_SEEDS)),
+                                 key=lambda result: result[2])
+        results.append((bic(points, labels, centers), labels, centers))
+    scores = np.array([score for score, _, _ in results])
+    finite = scores[np.isfinite(scores)]
+    if not len(finite):
+        return results[0][1], results[0][2]
+    threshold = finite.min() + BIC_THRESHOLD * (finite.max() - finite.min())
+    for score, labels, centers in results:
+        if score >= threshold:
+            return labels, centers
+
+
+def simpoints(profile, max_k=MAX_K, seed=SEED):
+    """
+    (interval, cluster, weight) of the representatives of a thread, weights
+    are the share of the markers of the thread in each cluster.
+    """
+    markers = profile['markers']
+    total = markers.sum()
+    # intervals without markers, e.g. the tail, only keep their skeleton
+    candidates = np.flatnonzero(markers > 0) if total else np.arange(len(markers))
+    points = signatures(profile)[candidates]
+    labels, centers = cluster(points, max_k, seed)
+    out = []
+    for j in np.unique(labels).tolist():
+        members = np.flatnonzero(labels == j)
+        rep = int(candidates[members[((points[members] - centers[j]) ** 2).sum(axis=1).argmin()]])
+        members = candidates[members]
+        weight = markers[members].sum() / total if total else len(members) / len(labels)
+        out.append((rep, j, float(weight)))
+    return sorted(out)
+
+
+class EidMap:
+    """
+    Event ids of a thread trace to those of its reduced trace. An event
+    that was dropped maps to the last kept event before it.
+    """
+
+    def __init__(self, eid_bounds, keep, sync_eids):
+        self.starts = eid_bounds[:-1][keep].tolist()
+        self.ends = eid_bounds[1:][keep].tolist()
+        self.before = np.concatenate(([0], np.cumsum(eid_bounds[1:][keep] - eid_bounds[:-1][keep]))).tolist()
+        # kept sync events outside the kept intervals
+        inside = np.zeros(len(sync_eids), dtype=bool)
+        if len(self.starts):
+            i = np.searchsorted(self.starts, sync_eids, side='right') - 1
+            inside = (i >= 0) & (sync_eids < np.array(self.ends + [0])[i])
+        self.sync = np.sort(sync_eids[~inside]).tolist()
+
+    def __getitem__(self, eid):
+        i = bisect_right(self.starts, eid) - 1
+        kept = 0
+        if i >= 0:
+            kept = self.before[i] + min(eid + 1 - self.starts[i], self.ends[i] - self.starts[i])
+        kept += bisect_right(self.sync, eid)
+        return max(kept - 1, 0)
+
+
+def reduce_trace(gz_file_path, out_file_path, keep, eid_maps, interval=INTERVAL):
+    """
+    Write the reduced trace of a thread: the lines of the keep intervals and
+    the sync skeleton of the others, comm edges renumbered by eid_maps.
+    """
+    def renumber(match):
+        eid_map = eid_maps.get(int(match[1]))
+        if eid_map is None:
+            return match[0]
+        return b'# %s %d ' % (match[1], eid_map[int(match[2])])
+
+    marker_total = 0
+    with open_sink(out_file_path, COMPRESS_LEVEL, min(COMPRESS_THREADS, job_cpus()),
+                   text=False) as sink:
+        for buf, end in iter_buffers(gz_file_path):
+            data, starts, codes, plain, records = scan_lines(buf, end)
+            is_marker = np.zeros(len(starts), dtype=np.int64)
+            is_marker[plain] = 1
+            line_interval = (marker_total + np.cumsum(is_marker) - is_marker) // interval
+            marker_total += len(plain)
+            kept = keep[np.minimum(line_interval, len(keep) - 1)] | (codes == SYNC_CODE)
+            kept[records] = True
+            # runs of kept lines
+            edges = np.diff(np.concatenate(([False], kept, [False])).astype(np.int8))
+            bounds = np.append(starts, end)
+            out = b''.join(buf[bounds[s]:bounds[e]]
+                           for s, e in zip(np.flatnonzero(edges == 1).tolist(),
+                                           np.flatnonzero(edges == -1).tolist()))
+            sink.write(EDGE_RE.sub(renumber, out))
+    return out_file_path
+
+
+def reduced_directory(directory):
+    directory = os.path.normpath(directory)
+    return os.path.dirname(directory) + '_simpoint/' + os.path.basename(directory)
+
+
+def trace_paths(directory):
+    return sorted(glob.glob(directory + '/sigil.events.out-*.gz'))
+
+
+def plan(profiles, max_k=MAX_K, seed=SEED):
+    """
+    Per tid: its representatives, keep mask and EidMap.
+    """
+    plans = {}
+    for profile in profiles:
+        tid = int(trace_tid(profile['path']))
+        points = simpoints(profile, max_k, seed)
+        keep = np.zeros(len(profile['events']), dtype=bool)
+        keep[[rep for rep, _, _ in points]] = True
+        bounds = np.concatenate(([0], np.cumsum(profile['events'])))
+        plans[tid] = {'profile': profile, 'simpoints': points, 'keep': keep, 'bounds': bounds,
+                      'eid_map': EidMap(bounds, keep, profile['sync_eids'])}
+    return plans
+
+
+def write_simpoints(path, plans):
+    with open(path, 'w') as file:
+        file.write('# tid interval cluster weight first_eid end_eid markers\n')
+        for tid in sorted(plans):
+            p = plans[tid]
+            for rep, j, weight in p['simpoints']:
+                file.write('%d %d %d %.6f %d %d %d\n' % (tid, rep, j, weight, p['bounds'][rep],
+                                                        p['bounds'][rep + 1], p['profile']['markers'][rep]))
+
+
+def main(directories, max_workers=None, interval=INTERVAL, max_k=MAX_K, out_directories=None):
+    out_directories = out_directories or [reduced_directory(d) for d in directories]
+    # one queue of trace files across all directories, per pass
+    jobs = [(path, profile_trace, (path, interval)) for d in directories for path in trace_paths(d)]
+    profiles = {p['path']: p for p in run_file_jobs(jobs, max_workers)}
+
+    jobs = []
+    for directory, out_directory in zip(directories, out_directories):
+        plans = plan([profiles[path] for path in trace_paths(directory)], max_k)
+        eid_maps = {tid: p['eid_map'] for tid, p in plans.items()}
+        os.makedirs(out_directory, exist_ok=True)
+        for path in glob.glob(directory + '/*.out') + glob.glob(directory + '/mem_meta.txt'):
+            shutil.copy(path, out_directory)
+        if os.path.isdir(directory + '/lock_acc_addr'):
+            shutil.copytree(directory + '/lock_acc_addr', out_directory + '/lock_acc_addr', dirs_exist_ok=True)
+        write_simpoints(out_directory + '/' + SIMPOINTS_FILE, plans)
+        for tid, p in plans.items():
+            path = p['profile']['path']
+            jobs.append((path, reduce_trace, (path, out_directory + '/' + os.path.basename(path),
+                                              p['keep'], eid_maps, interval)))
+        kept = sum(int(p['keep'].sum()) for p in plans.values())
+        total = sum(len(p['keep']) for p in plans.values())
+        print('%s: %d of %d intervals kept -> %s' % (directory, kept, total, out_directory))
+    run_file_jobs(jobs, max_workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Reduce lock benchmark runs to their representative intervals')
+    parser.add_argument('directories', nargs='*',
+                        help='run directories, default: the runs configured in this script')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes')
+    parser.add_argument('--interval', type=int, default=INTERVAL, help="'! 4096' markers per interval")
+    parser.add_argument('--max-k', type=int, default=MAX_K, help='most clusters per thread')
+    parser.add_argument('-o', '--out', nargs='*', default=None,
+                        help='output directory per run, default: <result dir>_simpoint/<run id>')
+    args = parser.parse_args()
+
+    directories = args.directories
+    if not directories:
+        for app in workloads:
+            for workload in workloads[app]:
+                for lock_type in lock_types:
+                    for num_nodes in num_nodess:
+                        for num_threads_per_nodes in num_threads_per_nodess:
+                            directories.append(root_path + '_'.join((app, workload,
+                                            lock_type,
+                                            str(num_nodes),
+                                            str(num_threads_per_nodes))))
+    main(directories, args.jobs, args.interval, args.max_k, args.out)
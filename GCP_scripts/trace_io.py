@@ -0,0 +1,155 @@
+"""
+Input and output helpers for gzipped TextLoggerV2 traces.
+"""
+
+import gzip
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# uncompressed bytes per gzip member written by ParallelGzipWriter
+MEMBER_SIZE = 4 << 20
+
+# size of the reusable read buffer of iter_buffers
+READ_SIZE = 4 << 20
+
+# uncompressed bytes per chunk of a trace split across processes by map_chunks
+CHUNK_SIZE = 16 << 20
+
+
+def iter_buffers(path, read_size=READ_SIZE):
+    """
+    Read a gzipped trace with readinto() into one reusable bytearray and
+    yield (buf, end) where buf[:end] holds whole lines only. The partial last
+    line is moved to the front of the buffer before the next read, so the
+    contents of buf are only valid until the next iteration.
+    """
+    buf = bytearray(read_size)
+    filled = 0
+    with gzip.open(path, 'rb') as f:
+        while True:
+            with memoryview(buf) as mv:
+                n = f.readinto(mv[filled:])
+            if n == 0:
+                if filled:
+                    # last line without a newline
+                    yield buf, filled
+                return
+            filled += n
+            end = buf.rfind(b'\n', 0, filled) + 1
+            if end == 0:
+                if filled == len(buf):
+                    # a single line longer than the buffer
+                    buf.extend(bytes(len(buf)))
+                continue
+            yield buf, end
+            buf[:filled - end] = buf[end:filled]
+            filled -= end
+
+
+class ParallelGzipWriter:
+    """
+    Write a gzip file as a series of independently deflated members.
+
+    Blocks are compressed on a thread pool (zlib releases the GIL) and
+    written in order. Readers that follow the gzip spec, `gzip -d`, zlib and
+    Python's gzip module, decode the concatenated members as one stream.
+    With encoding set, write() takes str like a file opened in 'wt' mode.
+    Written data is copied right away, so slices of a reused buffer are fine.
+    """
+
+    def __init__(self, path, level=6, threads=4, member_size=MEMBER_SIZE, encoding=None):
+        self.file = open(path, 'wb')
+        self.level = level
+        self.member_size = member_size
+        self.encoding = encoding
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = deque()
+        self.members = 0
+        self.buf = bytearray()
+
+    def write(self, data):
+        if self.encoding is not None:
+            data = data.encode(self.encoding)
+        self.buf += data
+        if len(self.buf) >= self.member_size:
+            self.submit()
+        return len(data)
+
+    def writelines(self, lines):
+        if self.encoding is not None:
+            self.write(''.join(lines))
+        else:
+            self.write(b''.join(lines))
+
+    def submit(self):
+        block = self.buf
+        self.buf = bytearray()
+        self.pending.append(self.pool.submit(gzip.compress, block, self.level, mtime=0))
+        self.members += 1
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            # an empty trace still gets one (empty) member
+            if self.buf or not self.members:
+                self.submit()
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown(wait=True)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sink(path, level=6, threads=4, text=True):
+    """
+    Open a gzip output for a rewritten trace. threads > 1 compresses blocks
+    in parallel as concatenated members, otherwise a plain gzip file is used.
+    """
+    if threads > 1:
+        return ParallelGzipWriter(path, level, threads, encoding='utf-8' if text else None)
+    return gzip.open(path, 'wt' if text else 'wb', compresslevel=level)
+
+
+def map_chunks(path, outputs, split, work, workers, chunk_size=CHUNK_SIZE):
+    """
+    Rewrite one gzipped trace on a pool of worker processes. The trace is
+    read in chunks of whole lines. split(data) is called on every chunk in
+    order: a cheap scan that returns the arguments of work(data, *args) with
+    the state carried into the chunk, and advances that state past it.
+    work runs in a worker and returns one gzip member per output path. The
+    members are written in chunk order, so every output decompresses to
+    what a sequential pass would have written.
+    """
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(output, 'wb')) for output in outputs]
+        pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+        pending = deque()
+        chunks = 0
+
+        def drain(limit):
+            while len(pending) > limit:
+                for file, member in zip(files, pending.popleft().result()):
+                    file.write(member)
+
+        for buf, end in iter_buffers(path, chunk_size):
+            with memoryview(buf) as mv:
+                data = mv[:end].tobytes()
+            pending.append(pool.submit(work, data, *split(data)))
+            chunks += 1
+            drain(2 * workers)
+        drain(0)
+        if not chunks:
+            # an empty trace still gets one (empty) member
+            for file in files:
+                file.write(gzip.compress(b'', mtime=0))
@@ -0,0 +1,312 @@
+"""
+Tokenizer and rule engine for TextLoggerV2 traces.
+
+Every TextLoggerV2 record starts with a one character marker
+(see src/Backends/SynchroTraceGen/TextLoggerV2.cpp):
+
+    @ iops,flops,reads,writes $ 0x.. 0x.. * 0x.. 0x..    computation
+    # tid eid 0x.. 0x..                                 communication
+    ^ type^0x..&0x..                                    synchronization
+    ! N                                                 instruction marker
+
+A line is classified once by its marker and handed to the handler of that
+record kind. The filters applied by post_process are written down as a tuple
+of rule names which compile_rules() turns into one handler per marker, once
+per directory.
+"""
+
+import re
+
+import numpy as np
+
+from lock_addrs import LockAddrCursor
+
+COMP = '@'
+COMM = '#'
+SYNC = '^'
+MARKER = '!'
+
+# the same markers as byte values, for the bytes mode of TraceFilter
+COMP_CODE = ord(COMP)
+COMM_CODE = ord(COMM)
+SYNC_CODE = ord(SYNC)
+
+# stgen sync types, see STGen::EventHandlers::onSync
+SYNC_LOCK = 1
+SYNC_UNLOCK = 2
+SYNC_SPAWN = 3
+SYNC_JOIN = 4
+SYNC_BARRIER = 5
+SYNC_CONDWAIT = 6
+SYNC_CONDSIG = 7
+SYNC_CONDBROAD = 8
+SYNC_SPINLOCK = 9
+SYNC_SPINUNLOCK = 10
+
+# the sync records that carry state from one part of a trace to the next
+STATE_SYNC_RE = re.compile(rb'^\^ (%d|%d|%d)\^' % (SYNC_BARRIER, SYNC_SPINLOCK, SYNC_SPINUNLOCK), re.M)
+
+# rule name -> what it does
+RULES = {
+    'profile_window': "'^ 5^' barriers toggle the profiled window, '@' and '!' records outside it are dropped",
+    'spinlock_indicator': "rewrite '^ 9^'/'^ 10^' into '! <lock addr><0|1><indicator>'",
+    'drop_futex': "drop '#' communication records",
+    'shmem_filter': "keep '@' records with an address range overlapping shared memory",
+}
+
+POST_PROCESS_RULES = (
+    'profile_window',
+    'spinlock_indicator',
+    'drop_futex',
+    'shmem_filter',
+)
+
+
+def sync_type(line):
+    return int(line[2:line.index(SYNC, 2)])
+
+
+def sync_arg(line):
+    # first (and for spinlocks the only) argument
+    end = line.find('&')
+    return int(line[line.find('0x') + 2:end if end != -1 else len(line)], 16)
+
+
+class TraceFilter:
+    """
+    Per-file line filter created by CompiledRules.new_filter().
+    Calling it returns the (possibly rewritten) line, or None to drop it.
+    """
+
+    def __init__(self, compiled, indicatorsaddr2val, lock_acc_addrs, name=None):
+        rules = compiled.rules
+        self.rules = rules
+        self.shmem_index = compiled.shmem_index
+        self.indicatorsaddr2val = indicatorsaddr2val
+        # one lock_acc_addr entry per lock operation, shared by its spinlock records
+        self.lock_acc = None if lock_acc_addrs is None else LockAddrCursor(lock_acc_addrs, name)
+        self.profile_enabled = 'profile_window' not in rules
+        self.start_convert_spinlock_to_indicator = False
+
+        self.handlers = {
+            SYNC: self.on_sync,
+            COMM: self.drop if 'drop_futex' in rules else self.on_comm,
+            COMP: self.on_comp if 'shmem_filter' in rules else self.on_windowed,
+        }
+        self.default = self.on_windowed
+
+    def __call__(self, line):
+        return self.handlers.get(line[0], self.default)(line)
+
+    def drop(self, line):
+        return None
+
+    def on_windowed(self, line):
+        return line if self.profile_enabled else None
+
+    def on_comm(self, line):
+        return line
+
+    def comp_in_shmem(self, parts):
+        # '@ iops,flops,reads,writes' followed by '$|* start end' triples,
+        # parts may be str or bytes
+        overlaps = self.shmem_index.overlaps
+        for k in range(3, len(parts) - 1, 3):
+            if overlaps(int(parts[k], 16), int(parts[k + 1], 16)):
+                return True
+        return False
+
+    def on_comp(self, line):
+        if not self.profile_enabled:
+            return None
+        return line if self.comp_in_shmem(line.split()) else None
+
+    def filter_buffer(self, buf, start, end, write):
+        """
+        bytes mode: filter the whole lines in buf[start:end] and pass the
+        output to write() in one call. Runs of lines kept verbatim are copied
+        as one memoryview slice of buf, only rewritten sync records become new
+        objects. Outside the profiled window everything up to the next sync
+        record is skipped with a single find().
+        """
+        # slicing bytes is cheaper than slicing a bytearray, so work on one
+        # immutable snapshot of the region
+        with memoryview(buf) as region:
+            buf = region[start:end].tobytes()
+        end -= start
+        start = 0
+        drop_comm = self.handlers[COMM] == self.drop
+        shmem_filter = 'shmem_filter' in self.rules
+        comp_in_shmem = self.comp_in_shmem
+        on_sync = self.on_sync
+        profile_enabled = self.profile_enabled
+        find = buf.find
+        run = start  # first line of the current run of verbatim lines
+        pos = start
+        mv = memoryview(buf)
+        out = bytearray()
+        emit = out.extend
+        while pos < end:
+            code = buf[pos]
+            if not profile_enabled and drop_comm and code != SYNC_CODE:
+                # nothing but sync records survive until the window opens
+                nxt = find(b'\n^', pos, end) + 1 or end
+                if run < pos:
+                    emit(mv[run:pos])
+                run = pos = nxt
+                continue
+            nxt = find(b'\n', pos, end) + 1 or end
+            if code == COMP_CODE:
+                if not profile_enabled or (shmem_filter and not comp_in_shmem(buf[pos:nxt].split())):
+                    if run < pos:
+                        emit(mv[run:pos])
+                    run = nxt
+            elif code == SYNC_CODE:
+                line = buf[pos:nxt].decode('ascii')
+                out_line = on_sync(line)
+                profile_enabled = self.profile_enabled
+                if out_line != line:
+                    if run < pos:
+                        emit(mv[run:pos])
+                    if out_line is not None:
+                        emit(out_line.encode('ascii'))
+                    run = nxt
+            elif (drop_comm if code == COMM_CODE else not profile_enabled):
+                if run < pos:
+                    emit(mv[run:pos])
+                run = nxt
+            pos = nxt
+        if run < end:
+            emit(mv[run:end])
+        if out:
+            write(out)
+
+    def filter_block(self, lines):
+        """
+        Filter a block of lines, classifying the address ranges of all '@'
+        records in the block with one vectorized index lookup.
+        Returns the list of kept (possibly rewritten) lines.
+        """
+        handlers = self.handlers
+        default = self.default
+        out = []
+        append = out.append
+        if 'shmem_filter' not in self.rules:
+            for line in lines:
+                line = handlers.get(line[0], default)(line)
+                if line is not None:
+                    append(line)
+            return out
+
+        owners = []
+        starts = []
+        ends = []
+        for n, line in enumerate(lines):
+            if line[0] == COMP:
+                parts = line.split()
+                for k in range(3, len(parts) - 1, 3):
+                    owners.append(n)
+                    starts.append(int(parts[k], 16))
+                    ends.append(int(parts[k + 1], 16))
+        shared = set()
+        if owners:
+            shared = set(np.asarray(owners)[self.shmem_index.overlaps_many(starts, ends)].tolist())
+
+        for n, line in enumerate(lines):
+            if line[0] == COMP:
+                if self.profile_enabled and n in shared:
+                    append(line)
+            else:
+                line = handlers.get(line[0], default)(line)
+                if line is not None:
+                    append(line)
+        return out
+
+    def next_lock_acc_addr(self):
+        return self.lock_acc.next()
+
+    def on_sync(self, line):
+        ty = sync_type(line)
+        if ty == SYNC_BARRIER:
+            if 'profile_window' in self.rules:
+                self.profile_enabled = not self.profile_enabled
+        elif 'spinlock_indicator' not in self.rules:
+            pass
+        elif ty == SYNC_SPINLOCK:
+            indicator = self.indicatorsaddr2val[sync_arg(line)]
+            line = '! %d0%d\n' % (self.next_lock_acc_addr(), indicator)
+            self.start_convert_spinlock_to_indicator = True
+        elif ty == SYNC_SPINUNLOCK:
+            if not self.start_convert_spinlock_to_indicator:
+                return None
+            indicator = self.indicatorsaddr2val[sync_arg(line)]
+            line = '! %d1%d\n' % (self.next_lock_acc_addr(), indicator)
+        return line
+
+    def get_state(self):
+        """
+        What the filtering of the rest of a trace depends on: the profiled
+        window, whether a spinlock was seen, the lock_acc_addr position.
+        """
+        return (self.profile_enabled, self.start_convert_spinlock_to_indicator,
+                None if self.lock_acc is None else self.lock_acc.records)
+
+    def set_state(self, state):
+        self.profile_enabled, self.start_convert_spinlock_to_indicator, records = state
+        if records is not None:
+            self.lock_acc.records = records
+
+    def skip_buffer(self, buf, start, end):
+        """
+        Advance the state over the whole lines in buf[start:end] as
+        filter_buffer would, without filtering them. Only the barrier and
+        spinlock records are looked at, found by one regex scan.
+        """
+        profile_window = 'profile_window' in self.rules
+        spinlock_indicator = 'spinlock_indicator' in self.rules
+        for m in STATE_SYNC_RE.finditer(buf, start, end):
+            ty = int(m.group(1))
+            if ty == SYNC_BARRIER:
+                if profile_window:
+                    self.profile_enabled = not self.profile_enabled
+            elif not spinlock_indicator:
+                pass
+            elif ty == SYNC_SPINLOCK:
+                self.lock_acc.skip()
+                self.start_convert_spinlock_to_indicator = True
+            elif self.start_convert_spinlock_to_indicator:
+                self.lock_acc.skip()
+
+    def remaining_lock_acc_addrs(self):
+        return self.lock_acc.remaining()
+
+
+class CompiledRules:
+    """
+    A validated set of rules bound to the per-directory data they need.
+    Build it once per directory, then call new_filter() for every trace file.
+    """
+
+    def __init__(self, rules, shmem_index):
+        self.rules = frozenset(rules)
+        self.shmem_index = shmem_index
+
+    def needs_indicators(self):
+        return 'spinlock_indicator' in self.rules
+
+    def new_filter(self, indicatorsaddr2val=None, lock_acc_addrs=None, name=None):
+        if self.needs_indicators() and (indicatorsaddr2val is None or lock_acc_addrs is None):
+            raise ValueError("'spinlock_indicator' needs indicators and lock access addresses")
+        return TraceFilter(self, indicatorsaddr2val, lock_acc_addrs, name)
+
+
+def compile_rules(rules, shmem_index=None):
+    """
+    shmem_index is a shmem_index.IntervalIndex, needed by 'shmem_filter'.
+    """
+    unknown = [r for r in rules if r not in RULES]
+    if unknown:
+        raise ValueError('unknown trace rules: %s' % ', '.join(unknown))
+    if 'shmem_filter' in rules and shmem_index is None:
+        raise ValueError("'shmem_filter' needs shared memory ranges")
+    return CompiledRules(rules, shmem_index)
@@ -0,0 +1,440 @@
+#!/bin/python
+
+# Trace driven cache model of a SynchroTraceGen run
+#
+# The '$' (write) and '*' (read) ranges of every comp event, in text v1/v2,
+# compressed or uncompressed capnp traces, are expanded to cache lines and
+# run through
+#   - a private L1 per thread, simulated by its own worker process
+#   - a shared LLC, fed with the L1 misses of all threads interleaved by
+#     event id, as if the threads retired events at the same rate
+# Both are set-associative with LRU or tree PLRU replacement and write-back,
+# write-allocate; the LLC only sees the demand misses of the L1s.
+#
+# With --msi, the cross-thread comm edges give a coherence estimate under
+# MSI: every line version (producer thread and event) read by another thread
+# is one M -> S downgrade of the producer copy, and every newer version of a
+# line a consumer reads again means its shared copy was invalidated.
+
+import os
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from stgen_columns import EV_COMP, EV_MARKER, MEM_NONE, MEM_WRITE
+from stgen_comm import line_eids, text_ranges, compressed_ranges, uncompressed_ranges
+from stgen_events import trace_format, trace_thread, run_trace_paths
+from stgen_trace_input import iter_line_blocks, open_trace
+
+# '$ <start> <end>' or '* <start> <end>', in text v1 and v2 comp lines
+ACCESS_RE = re.compile(rb'([$*]) 0x([0-9a-fA-F]+) 0x([0-9a-fA-F]+)')
+WRITE_MARK = b'$'
+
+LINE_SIZE = 64
+L1_SIZE = 32 << 10
+L1_WAYS = 8
+LLC_SIZE = 8 << 20
+LLC_WAYS = 16
+POLICIES = ('lru', 'plru')
+
+# L1 misses run through the LLC this many at a time
+LLC_BLOCK = 1 << 20
+
+
+def parse_size(text):
+    """
+    Bytes from '32768', '32K', '8M' or '1G'.
+    """
+    text = text.strip().upper().rstrip('B')
+    units = {'K': 10, 'M': 20, 'G': 30}
+    if text and text[-1] in units:
+        return int(text[:-1]) << units[text[-1]]
+    return int(text)
+
+
+def empty_accesses():
+    return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64),
+            np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool))
+
+
+def text_accesses(block, lines):
+    """
+    Return the (eid, start, end, is write) arrays of the ranges of a block of
+    whole text lines, in trace order; lines is its line_eids.
+    """
+    starts, eids, _ = lines
+    matches = list(ACCESS_RE.finditer(block))
+    if not matches:
+        return empty_accesses()
+    positions = np.array([m.start() for m in matches], dtype=np.int64)
+    index = np.searchsorted(starts, positions, side='right') - 1
+    start = np.array([int(m[2], 16) for m in matches], dtype=np.uint64)
+    end = np.array([int(m[3], 16) for m in matches], dtype=np.uint64)
+    is_write = np.array([m[1] == WRITE_MARK for m in matches], dtype=bool)
+    return eids[index], start, end, is_write
+
+
+def compressed_accesses(cols, eids):
+    # the writes of an event come before its reads, as in the text lines
+    events = np.arange(len(cols))
+    owner = np.concatenate((np.repeat(events, np.diff(cols.write_off)),
+                            np.repeat(events, np.diff(cols.read_off))))
+    is_write = np.zeros(len(owner), dtype=bool)
+    is_write[:len(cols.write_start)] = True
+    order = np.argsort(owner, kind='stable')
+    return (eids[owner[order]],
+            np.concatenate((cols.write_start, cols.read_start))[order],
+            np.concatenate((cols.write_end, cols.read_end))[order],
+            is_write[order])
+
+
+def uncompressed_accesses(records, eids):
+    is_mem = (records['kind'] == EV_COMP) & (records['mem'] != MEM_NONE)
+    mem = records[is_mem]
+    return eids[is_mem], mem['start'], mem['end'], mem['mem'] == MEM_WRITE
+
+
+def iter_text_blocks(tracepath, comm=True):
+    eid = 0
+    for block in iter_line_blocks(tracepath):
+        lines = line_eids(block, eid)
+        yield text_accesses(block, lines), text_ranges(block, eid, lines)[0] if comm else None
+        eid += lines[2]
+
+
+def iter_compressed_blocks(tracepath, comm=True):
+    from stgen_capnp_parser_compressed import parse_stgen_trace_compressed_columns
+    eid = 0
+    with open_trace(tracepath) as f:
+        for cols in parse_stgen_trace_compressed_columns(f):
+            eids = eid + np.cumsum(cols.kind != EV_MARKER) - 1
+            eid += int((cols.kind != EV_MARKER).sum())
+            yield compressed_accesses(cols, eids), compressed_ranges(cols, eids) if comm else None
+
+
+def iter_uncompressed_blocks(tracepath, comm=True):
+    from stgen_capnp_parser_uncompressed import parse_stgen_trace_uncompressed_records
+    eid = 0
+    with open_trace(tracepath) as f:
+        for records in parse_stgen_trace_uncompressed_records(f):
+            kind = records['kind']
+            eids = eid + np.cumsum(kind != EV_MARKER) - 1
+            eid += int((kind != EV_MARKER).sum())
+            yield uncompressed_accesses(records, eids), uncompressed_ranges(records, eids) if comm else None
+
+
+# (accesses, comm ranges or None without comm) per block of a trace
+BLOCK_READERS = {
+    'text': iter_text_blocks,
+    'compressed': iter_compressed_blocks,
+    'uncompressed': iter_uncompressed_blocks,
+}
+
+
+def expand_lines(start, end, shift, *columns):
+    """
+    Return the line of every byte range line by line, and the columns
+    repeated to match.
+    """
+    first = (start >> np.uint64(shift)).astype(np.int64)
+    count = np.maximum((end >> np.uint64(shift)).astype(np.int64) - first, 0) + 1
+    lines = np.repeat(first, count) + (np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count))
+    return (lines,) + tuple(np.repeat(c, count) for c in columns)
+
+
+def unique_rows(*columns):
+    """
+    The distinct rows of equal length integer columns, sorted.
+    """
+    if not len(columns[0]):
+        return columns
+    order = np.lexsort(columns[::-1])
+    columns = [c[order] for c in columns]
+    first = np.zeros(len(order), dtype=bool)
+    first[0] = True
+    for c in columns:
+        first[1:] |= c[1:] != c[:-1]
+    return tuple(c[first] for c in columns)
+
+
+class Cache:
+    """
+    A set-associative write-back cache over line numbers.
+
+    access() takes a whole block of accesses at once. They are grouped by
+    set, and round r replays the r-th access of every set touched by the
+    block, so each round is a few array operations over all those sets and
+    every set still sees its accesses in order. An access to the line the
+    previous access of its set used is a hit that only changes the dirty
+    bit and is folded into that access first.
+    """
+
+    def __init__(self, size, ways, line=LINE_SIZE, policy='lru'):
+        num_sets = size // (ways * line)
+        if num_sets < 1 or num_sets & (num_sets - 1) or num_sets * ways * line != size:
+            raise ValueError('%d bytes of %d ways of %d byte lines is not a power of 2 of sets'
+                             % (size, ways, line))
+        if policy not in POLICIES:
+            raise ValueError('unknown replacement policy %r' % policy)
+        if policy == 'plru' and ways & (ways - 1):
+            raise ValueError('plru needs a power of 2 of ways, not %d' % ways)
+        self.size, self.ways, self.line, self.policy = size, ways, line, policy
+        self.num_sets = num_sets
+        self.tags = np.full((num_sets, ways), -1, dtype=np.int64)
+        self.dirty = np.zeros((num_sets, ways), dtype=bool)
+        if policy == 'lru':
+            self.stamp = np.zeros((num_sets, ways), dtype=np.int64)
+            self.clock = 1
+        else:
+            # tree nodes in heap order, a bit points at the half to evict from
+            self.levels = ways.bit_length() - 1
+            self.bits = np.zeros((num_sets, max(ways - 1, 1)), dtype=np.int64)
+        self.accesses = 0
+        self.misses = 0
+        self.writebacks = 0
+
+    def victim(self, sets):
+        if self.policy == 'lru':
+            return self.stamp[sets].argmin(axis=1)
+        node = np.zeros(len(sets), dtype=np.int64)
+        for _ in range(self.levels):
+            node = 2 * node + 1 + self.bits[sets, node]
+        return node - (self.ways - 1)
+
+    def touch(self, sets, ways):
+        if self.policy == 'lru':
+            self.stamp[sets, ways] = self.clock
+            self.clock += 1
+            return
+        node = np.zeros(len(sets), dtype=np.int64)
+        for level in range(self.levels):
+            half = (ways >> (self.levels - 1 - level)) & 1
+            self.bits[sets, node] = 1 - half
+            node = 2 * node + 1 + half
+
+    def step(self, sets, lines, writes):
+        # one access to each of a set of distinct sets
+        rows = self.tags[sets]
+        match = rows == lines[:, None]
+        hit = match.any(axis=1)
+        ways = match.argmax(axis=1)
+        miss = ~hit
+        if miss.any():
+            miss_sets, miss_rows = sets[miss], rows[miss]
+            invalid = miss_rows < 0
+            victims = np.where(invalid.any(axis=1), invalid.argmax(axis=1), self.victim(miss_sets))
+            valid = miss_rows[np.arange(len(victims)), victims] >= 0
+            self.writebacks += int((valid & self.dirty[miss_sets, victims]).sum())
+            self.tags[miss_sets, victims] = lines[miss]
+            self.dirty[miss_sets, victims] = False
+            ways[miss] = victims
+        self.dirty[sets, ways] |= writes
+        self.touch(sets, ways)
+        return hit
+
+    def access(self, lines, writes):
+        """
+        Run a block of line numbers with their is write flags through the
+        cache, returns the hit flag of every access.
+        """
+        n = len(lines)
+        hit = np.ones(n, dtype=bool)
+        if not n:
+            return hit
+        sets = lines & (self.num_sets - 1)
+        order = np.argsort(sets, kind='stable')
+        sorted_sets, sorted_lines = sets[order], lines[order]
+        kept = np.ones(n, dtype=bool)
+        kept[1:] = (sorted_sets[1:] != sorted_sets[:-1]) | (sorted_lines[1:] != sorted_lines[:-1])
+        idx = np.flatnonzero(kept)
+        dirty = np.logical_or.reduceat(writes[order], idx)
+        position, sets, lines = order[idx], sorted_sets[idx], sorted_lines[idx]
+
+        # rank of every kept access within its set
+        first = np.ones(len(sets), dtype=bool)
+        first[1:] = sets[1:] != sets[:-1]
+        set_start = np.flatnonzero(first)
+        counts = np.diff(np.append(set_start, len(sets)))
+        rank = np.arange(len(sets)) - np.repeat(set_start, counts)
+        by_rank = np.argsort(rank, kind='stable')
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(rank))))
+        for r in range(len(bounds) - 1):
+            sel = by_rank[bounds[r]:bounds[r + 1]]
+            hit[position[sel]] = self.step(sets[sel], lines[sel], dirty[sel])
+
+        self.accesses += n
+        self.misses += int(n - hit.sum())
+        return hit
+
+    def counters(self):
+        return {'accesses': self.accesses, 'misses': self.misses, 'writebacks': self.writebacks}
+
+
+class ThreadCache:
+    """
+    The L1 of one thread once its trace ran through it: counters, the
+    (line, eid, is write) of its misses for the LLC and, with msi, the
+    distinct (line, producer thread, producer eid) versions it read from
+    other threads.
+    """
+
+    def __init__(self, thread, l1, misses, versions):
+        self.thread = thread
+        self.l1 = l1
+        self.miss_lines, self.miss_eids, self.miss_writes = misses
+        self.versions = versions
+
+    def invalidations(self):
+        # every version of a line read after the first one replaced an invalidated copy
+        lines = self.versions[0]
+        return len(lines) - len(np.unique(lines))
+
+
+def trace_cache(tracepath, l1=(L1_SIZE, L1_WAYS), line=LINE_SIZE, policy='lru', msi=False):
+    thread = trace_thread(tracepath)
+    cache = Cache(l1[0], l1[1], line, policy)
+    shift = int(line).bit_length() - 1
+    misses = ([], [], [])
+    versions = ([], [], [])
+    for (eids, start, end, is_write), ranges in BLOCK_READERS[trace_format(tracepath)](tracepath, msi):
+        lines, eids, is_write = expand_lines(start, end, shift, eids, is_write)
+        hit = cache.access(lines, is_write)
+        for out, column in zip(misses, (lines, eids, is_write)):
+            out.append(column[~hit])
+        if msi:
+            _, producer, producer_eid, start, end, _ = ranges
+            remote = producer != thread
+            block = unique_rows(*expand_lines(start[remote], end[remote], shift,
+                                              producer[remote], producer_eid[remote]))
+            for out, column in zip(versions, block):
+                out.append(column)
+    misses = tuple(np.concatenate(c) if c else np.zeros(0, dtype=np.int64) for c in misses)
+    versions = tuple(np.concatenate(c) if c else np.zeros(0, dtype=np.int64) for c in versions)
+    return ThreadCache(thread, cache.counters(), misses, unique_rows(*versions))
+
+
+class RunCache:
+    """
+    Per thread L1 and LLC counters of a run, and the MSI estimate.
+    """
+
+    def __init__(self, threads, l1, llc):
+        self.threads = sorted(threads, key=lambda t: t.thread)
+        self.l1 = l1
+        self.llc = llc
+        self.llc_accesses = {}
+        self.llc_misses = {}
+        self.downgrades = None
+        self.invalidations = None
+        self.shared_lines = None
+
+    def run_llc(self):
+        # the L1 misses of every thread in event id order, ties by thread
+        lines = np.concatenate([t.miss_lines for t in self.threads] + [np.zeros(0, dtype=np.int64)])
+        eids = np.concatenate([t.miss_eids for t in self.threads] + [np.zeros(0, dtype=np.int64)])
+        writes = np.concatenate([t.miss_writes for t in self.threads] + [np.zeros(0, dtype=bool)])
+        owner = np.concatenate([np.full(len(t.miss_lines), t.thread, dtype=np.int64) for t in self.threads]
+                               + [np.zeros(0, dtype=np.int64)])
+        order = np.lexsort((owner, eids))
+        hit = np.ones(len(order), dtype=bool)
+        for i in range(0, len(order), LLC_BLOCK):
+            sel = order[i:i + LLC_BLOCK]
+            hit[sel] = self.llc.access(lines[sel], writes[sel])
+        for t in self.threads:
+            mine = owner == t.thread
+            self.llc_accesses[t.thread] = int(mine.sum())
+            self.llc_misses[t.thread] = int((mine & ~hit).sum())
+
+    def run_msi(self):
+        lines, producers, producer_eids = (np.concatenate([t.versions[i] for t in self.threads]
+                                                          + [np.zeros(0, dtype=np.int64)])
+                                           for i in range(3))
+        self.downgrades = len(unique_rows(lines, producers, producer_eids)[0])
+        self.invalidations = sum(t.invalidations() for t in self.threads)
+        self.shared_lines = len(np.unique(lines))
+
+
+def directory_cache(directory, max_workers=None, l1=(L1_SIZE, L1_WAYS), llc=(LLC_SIZE, LLC_WAYS),
+                    line=LINE_SIZE, policy='lru', msi=False):
+    """
+    Return the RunCache of all traces of a run directory.
+    """
+    # largest traces first so a big thread doesn't start last
+    paths = sorted(run_trace_paths(directory), key=os.path.getsize, reverse=True)
+    shared = Cache(llc[0], llc[1], line, policy)
+    n = len(paths)
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        threads = list(pool.map(trace_cache, paths, [l1] * n, [line] * n, [policy] * n, [msi] * n))
+    run = RunCache(threads, l1, shared)
+    run.run_llc()
+    if msi:
+        run.run_msi()
+    return run
+
+
+def rate(part, whole):
+    return 100.0 * part / whole if whole else 0.0
+
+
+def print_cache(run):
+    llc = run.llc
+    print('L1: %d bytes, %d ways per thread' % run.l1)
+    print('LLC: %d bytes, %d ways, %d sets of %d byte lines, %s'
+          % (llc.size, llc.ways, llc.num_sets, llc.line, llc.policy))
+    print('%8s %12s %12s %7s %12s %12s %12s %7s' % ('thread', 'accesses', 'L1 misses', 'miss%', 'writebacks',
+                                                  'LLC access', 'LLC misses', 'miss%'))
+    total = dict.fromkeys(('accesses', 'misses', 'writebacks', 'llc_accesses', 'llc_misses'), 0)
+    for t in run.threads:
+        row = (t.l1['accesses'], t.l1['misses'], t.l1['writebacks'],
+               run.llc_accesses[t.thread], run.llc_misses[t.thread])
+        for key, value in zip(total, row):
+            total[key] += value
+        print('%8d %12d %12d %6.2f%% %12d %12d %12d %6.2f%%'
+              % (t.thread, row[0], row[1], rate(row[1], row[0]), row[2], row[3], row[4], rate(row[4], row[3])))
+    print('%8s %12d %12d %6.2f%% %12d %12d %12d %6.2f%%'
+          % ('total', total['accesses'], total['misses'], rate(total['misses'], total['accesses']),
+             total['writebacks'], total['llc_accesses'], total['llc_misses'],
+             rate(total['llc_misses'], total['llc_accesses'])))
+    print('LLC writebacks: %d' % llc.writebacks)
+    if run.downgrades is not None:
+        print('MSI from comm edges: %d M->S downgrades, %d invalidations over %d shared lines'
+              % (run.downgrades, run.invalidations, run.shared_lines))
+
+
+def save_cache(path, run):
+    threads = np.array([t.thread for t in run.threads], dtype=np.int64)
+    columns = {'threads': threads,
+               'llc_accesses': np.array([run.llc_accesses[t] for t in threads.tolist()], dtype=np.int64),
+               'llc_misses': np.array([run.llc_misses[t] for t in threads.tolist()], dtype=np.int64),
+               'llc_writebacks': run.llc.writebacks}
+    for key in ('accesses', 'misses', 'writebacks'):
+        columns['l1_' + key] = np.array([t.l1[key] for t in run.threads], dtype=np.int64)
+    if run.downgrades is not None:
+        columns.update(downgrades=run.downgrades, invalidations=run.invalidations,
+                       shared_lines=run.shared_lines)
+    np.savez(path, **columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Private L1 and shared LLC hit/miss counts of the '
+                                                  'SynchroTraceGen traces of a run'))
+    parser.add_argument('directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes')
+    parser.add_argument('--line', type=parse_size, default=LINE_SIZE, help='line size in bytes, a power of 2')
+    parser.add_argument('--l1-size', type=parse_size, default=L1_SIZE, help='per thread, e.g. 32K')
+    parser.add_argument('--l1-ways', type=int, default=L1_WAYS)
+    parser.add_argument('--llc-size', type=parse_size, default=LLC_SIZE, help='shared, e.g. 8M')
+    parser.add_argument('--llc-ways', type=int, default=LLC_WAYS)
+    parser.add_argument('--policy', choices=POLICIES, default='lru', help='replacement policy of both levels')
+    parser.add_argument('--msi', action='store_true',
+                        help='also estimate MSI downgrades and invalidations from the comm edges')
+    parser.add_argument('--save', help='also save the counters to this .npz file')
+    args = parser.parse_args()
+
+    run = directory_cache(args.directory, args.jobs, (args.l1_size, args.l1_ways),
+                          (args.llc_size, args.llc_ways), args.line, args.policy, args.msi)
+    print_cache(run)
+    if args.save:
+        save_cache(args.save, run)
@@ -2,7 +2,6 @@
 
 # Sample script to parse a capnproto trace output by SynchroTraceGen
 
-import os
 import argparse
 
 # Import hook magic to load capnproto schemas
@@ -11,6 +10,11 @@ import argparse
 import capnp
 import STEventTraceCompressed_capnp
 
+import numpy as np
+from stgen_columns import (EV_COMP, EV_COMM, EV_SYNC, EV_MARKER, NO_SYNC,
+                           SYNC_TYPE_IDS, CompressedColumns, which, offsets)
+from stgen_trace_input import open_trace
+
 
 def process_comp(comp):
     comp.iops    # IOPs value
@@ -86,21 +90,141 @@ def parse_stgen_trace_compressed(f):
                 process_marker(event.marker)
 
 
+def decode_compressed_columns(message):
+    """
+    Decode one EventStreamCompressed message into CompressedColumns.
+    Every capnp field is visited exactly once here, analyses then work on
+    whole arrays instead of calling into pycapnp per field.
+    """
+    events = message.events
+    kind = []
+    iops = []
+    flops = []
+    reads = []
+    writes = []
+    sync_type = []
+    sync_args = []
+    marker_count = []
+    write_counts = []
+    read_counts = []
+    edge_counts = []
+    edge_addr_counts = []
+    write_start = []
+    write_end = []
+    read_start = []
+    read_end = []
+    edge_thread = []
+    edge_event = []
+    edge_start = []
+    edge_end = []
+
+    for event in events:
+        w = which(event)
+        nwrites = nreads = nedges = 0
+        if w == 'comp':
+            comp = event.comp
+            kind.append(EV_COMP)
+            iops.append(comp.iops)
+            flops.append(comp.flops)
+            reads.append(comp.reads)
+            writes.append(comp.writes)
+            for r in comp.writeAddrs:
+                write_start.append(r.start)
+                write_end.append(r.end)
+                nwrites += 1
+            for r in comp.readAddrs:
+                read_start.append(r.start)
+                read_end.append(r.end)
+                nreads += 1
+            sync_type.append(NO_SYNC)
+            sync_args.append((0, 0))
+            marker_count.append(0)
+        else:
+            iops.append(0)
+            flops.append(0)
+            reads.append(0)
+            writes.append(0)
+            if w == 'comm':
+                kind.append(EV_COMM)
+                for edge in event.comm.edges:
+                    naddrs = 0
+                    for r in edge.addrs:
+                        edge_start.append(r.start)
+                        edge_end.append(r.end)
+                        naddrs += 1
+                    edge_thread.append(edge.producerThread)
+                    edge_event.append(edge.producerEvent)
+                    edge_addr_counts.append(naddrs)
+                    nedges += 1
+                sync_type.append(NO_SYNC)
+                sync_args.append((0, 0))
+                marker_count.append(0)
+            elif w == 'sync':
+                sync = event.sync
+                args = list(sync.args)
+                assert(len(args) < 3)
+                kind.append(EV_SYNC)
+                sync_type.append(SYNC_TYPE_IDS[str(sync.type)])
+                sync_args.append((args + [0, 0])[:2])
+                marker_count.append(0)
+            elif w == 'marker':
+                kind.append(EV_MARKER)
+                sync_type.append(NO_SYNC)
+                sync_args.append((0, 0))
+                marker_count.append(event.marker.count)
+            else:
+                raise Exception('unhandled event')
+        write_counts.append(nwrites)
+        read_counts.append(nreads)
+        edge_counts.append(nedges)
+
+    return CompressedColumns(
+        kind=np.array(kind, dtype=np.uint8),
+        iops=np.array(iops, dtype=np.uint16),
+        flops=np.array(flops, dtype=np.uint16),
+        reads=np.array(reads, dtype=np.uint16),
+        writes=np.array(writes, dtype=np.uint16),
+        sync_type=np.array(sync_type, dtype=np.int8),
+        sync_args=np.array(sync_args, dtype=np.uint64).reshape(-1, 2),
+        marker_count=np.array(marker_count, dtype=np.uint16),
+        write_off=offsets(write_counts),
+        write_start=np.array(write_start, dtype=np.uint64),
+        write_end=np.array(write_end, dtype=np.uint64),
+        read_off=offsets(read_counts),
+        read_start=np.array(read_start, dtype=np.uint64),
+        read_end=np.array(read_end, dtype=np.uint64),
+        edge_off=offsets(edge_counts),
+        edge_thread=np.array(edge_thread, dtype=np.uint16),
+        edge_event=np.array(edge_event, dtype=np.uint32),
+        edge_addr_off=offsets(edge_addr_counts),
+        edge_start=np.array(edge_start, dtype=np.uint64),
+        edge_end=np.array(edge_end, dtype=np.uint64))
+
+
+def parse_stgen_trace_compressed_columns(f):
+    """
+    Yield one CompressedColumns per message of the trace.
+    """
+    for message in (STEventTraceCompressed_capnp.EventStreamCompressed
+                    .read_multiple_packed(f, traversal_limit_in_words=2**63)):
+        yield decode_compressed_columns(message)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=('Sample script to parse '
                                                   'SynchroTraceGen traces'))
     parser.add_argument('tracepath')
+    parser.add_argument('--columnar', action='store_true',
+                        help='decode into numpy columns and print event counts')
     args = parser.parse_args()
 
     tracepath = args.tracepath
-    name, ext = os.path.splitext(tracepath)
-
-    # https://github.com/jparyani/pycapnp/issues/80
-    f = os.popen('cat ' + tracepath + ' | gzip -d') if ext == '.gz' \
-        else open(tracepath, 'r') if ext == '.bin' \
-        else None
-
-    if not f:
-        raise('Unknown file extension')
-
-    parse_stgen_trace_compressed(f)
+    with open_trace(tracepath) as f:
+        if args.columnar:
+            cols = CompressedColumns.concatenate(parse_stgen_trace_compressed_columns(f))
+            counts = np.bincount(cols.kind, minlength=4)
+            print('comp: %d comm: %d sync: %d marker: %d' % tuple(counts))
+            print('write ranges: %d read ranges: %d comm edges: %d'
+                  % (len(cols.write_start), len(cols.read_start), len(cols.edge_thread)))
+        else:
+            parse_stgen_trace_compressed(f)
@@ -4,6 +4,7 @@
 
 import os
 import argparse
+import shutil
 
 # Import hook magic to load capnproto schemas
 # Note that each schema (compressed/uncompressed
@@ -11,6 +12,27 @@ import argparse
 import capnp
 import STEventTraceUncompressed_capnp
 
+import numpy as np
+from stgen_columns import (EV_COMP, EV_COMM, EV_SYNC, EV_MARKER, NO_SYNC,
+                           SYNC_TYPE_IDS, MEM_NONE, MEM_TYPE_IDS, which)
+from stgen_trace_input import open_trace
+
+# One uncompressed event per record. start/end hold the memory range of a
+# comp event (mem != MEM_NONE) or the range of a comm event.
+UNCOMPRESSED_DTYPE = np.dtype([
+    ('kind', np.uint8),
+    ('mem', np.uint8),
+    ('sync_type', np.int8),
+    ('iops', np.uint16),
+    ('flops', np.uint16),
+    ('marker_count', np.uint16),
+    ('producer_thread', np.uint16),
+    ('producer_event', np.uint32),
+    ('start', np.uint64),
+    ('end', np.uint64),
+    ('sync_args', np.uint64, (2,)),
+])
+
 
 def process_comp(comp):
     comp.iops    # IOPs value
@@ -81,21 +103,101 @@ def parse_stgen_trace_uncompressed(f):
                 process_marker(event.marker)
 
 
+def decode_uncompressed_records(message):
+    """
+    Decode one EventStreamUncompressed message into a structured array of
+    UNCOMPRESSED_DTYPE, one record per event.
+    """
+    records = []
+    append = records.append
+    for event in message.events:
+        w = which(event)
+        if w == 'comp':
+            comp = event.comp
+            mem = MEM_TYPE_IDS[str(comp.mem)]
+            if mem == MEM_NONE:
+                append((EV_COMP, mem, NO_SYNC, comp.iops, comp.flops, 0, 0, 0, 0, 0, (0, 0)))
+            else:
+                append((EV_COMP, mem, NO_SYNC, comp.iops, comp.flops, 0, 0, 0,
+                        comp.startAddr, comp.endAddr, (0, 0)))
+        elif w == 'comm':
+            comm = event.comm
+            append((EV_COMM, MEM_NONE, NO_SYNC, 0, 0, 0, comm.producerThread, comm.producerEvent,
+                    comm.startAddr, comm.endAddr, (0, 0)))
+        elif w == 'sync':
+            sync = event.sync
+            args = list(sync.args)
+            assert(len(args) < 3)
+            append((EV_SYNC, MEM_NONE, SYNC_TYPE_IDS[str(sync.type)], 0, 0, 0, 0, 0, 0, 0,
+                    tuple((args + [0, 0])[:2])))
+        elif w == 'marker':
+            append((EV_MARKER, MEM_NONE, NO_SYNC, 0, 0, event.marker.count, 0, 0, 0, 0, (0, 0)))
+        else:
+            raise Exception('unhandled event')
+    return np.array(records, dtype=UNCOMPRESSED_DTYPE)
+
+
+def parse_stgen_trace_uncompressed_records(f):
+    """
+    Yield one structured array of UNCOMPRESSED_DTYPE per message of the trace.
+    """
+    for stream in (STEventTraceUncompressed_capnp.EventStreamUncompressed
+                   .read_multiple_packed(f, traversal_limit_in_words=2**63)):
+        yield decode_uncompressed_records(stream)
+
+
+def save_records(record_blocks, npy_path):
+    """
+    Stream record blocks into a single .npy file without holding the whole
+    trace in memory: the records go to a scratch file first, then the .npy
+    header (which needs the final length) and the data are written out.
+    Returns the number of records.
+    """
+    tmp_path = npy_path + '.tmp'
+    count = 0
+    with open(tmp_path + '.data', 'wb') as data:
+        for block in record_blocks:
+            block.tofile(data)
+            count += len(block)
+    with open(tmp_path, 'wb') as out, open(tmp_path + '.data', 'rb') as data:
+        np.lib.format.write_array_header_1_0(out, {
+            'descr': np.lib.format.dtype_to_descr(UNCOMPRESSED_DTYPE),
+            'fortran_order': False,
+            'shape': (count,)})
+        shutil.copyfileobj(data, out, 16 << 20)
+    os.remove(tmp_path + '.data')
+    os.replace(tmp_path, npy_path)
+    return count
+
+
+def load_records(tracepath, npy_path=None):
+    """
+    Return all records of a trace as a memory-mapped structured array.
+    The decoded records are cached next to the trace as <trace>.npy and
+    reused as long as the cache is newer than the trace.
+    """
+    npy_path = npy_path or tracepath + '.npy'
+    if not (os.path.exists(npy_path) and
+            os.path.getmtime(npy_path) >= os.path.getmtime(tracepath)):
+        with open_trace(tracepath) as f:
+            save_records(parse_stgen_trace_uncompressed_records(f), npy_path)
+    return np.load(npy_path, mmap_mode='r')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=('Sample script to parse '
                                                   'SynchroTraceGen traces'))
     parser.add_argument('tracepath')
+    parser.add_argument('--npy', action='store_true',
+                        help=('decode into a structured numpy array, cached as '
+                              '<tracepath>.npy, and print event counts'))
     args = parser.parse_args()
 
     tracepath = args.tracepath
-    name, ext = os.path.splitext(tracepath)
-
-    # https://github.com/jparyani/pycapnp/issues/80
-    f = os.popen('cat ' + tracepath + ' | gzip -d') if ext == '.gz' \
-        else open(tracepath, 'r') if ext == '.bin' \
-        else None
-
-    if not f:
-        raise('Unknown file extension')
-
-    parse_stgen_trace_uncompressed(f)
+    if args.npy:
+        records = load_records(tracepath)
+        counts = np.bincount(records['kind'], minlength=4)
+        print('comp: %d comm: %d sync: %d marker: %d' % tuple(counts))
+    else:
+        with open_trace(tracepath) as f:
+            parse_stgen_trace_uncompressed(f)
@@ -0,0 +1,130 @@
+#!/bin/python
+
+# Definitions shared by the columnar (numpy) decoders of SynchroTraceGen traces
+
+import numpy as np
+
+# event kind column values
+EV_COMP = 0
+EV_COMM = 1
+EV_SYNC = 2
+EV_MARKER = 3
+
+EVENT_KINDS = {'comp': EV_COMP, 'comm': EV_COMM, 'sync': EV_SYNC, 'marker': EV_MARKER}
+
+# capnp SyncType enum, in schema order
+SYNC_TYPES = ('spawn', 'join', 'barrier', 'sync', 'lock', 'unlock',
+              'condWait', 'condSignal', 'condBroadcast', 'spinLock', 'spinUnlock')
+SYNC_TYPE_IDS = {name: i for i, name in enumerate(SYNC_TYPES)}
+
+# sync_type column value of events that are not sync events
+NO_SYNC = -1
+
+# sync type numbers of the text loggers ('^ <type>^...') to SyncType ids
+TEXT_SYNC_TYPES = {1: SYNC_TYPE_IDS['lock'], 2: SYNC_TYPE_IDS['unlock'],
+                   3: SYNC_TYPE_IDS['spawn'], 4: SYNC_TYPE_IDS['join'],
+                   5: SYNC_TYPE_IDS['barrier'], 6: SYNC_TYPE_IDS['condWait'],
+                   7: SYNC_TYPE_IDS['condSignal'], 8: SYNC_TYPE_IDS['condBroadcast'],
+                   9: SYNC_TYPE_IDS['spinLock'], 10: SYNC_TYPE_IDS['spinUnlock']}
+SYNC_TYPE_TEXT = {v: k for k, v in TEXT_SYNC_TYPES.items()}
+
+# capnp MemType enum of the uncompressed schema, in schema order
+MEM_NONE = 0
+MEM_READ = 1
+MEM_WRITE = 2
+MEM_TYPE_IDS = {'none': MEM_NONE, 'read': MEM_READ, 'write': MEM_WRITE}
+
+
+def which(event):
+    # pycapnp < 1.0 exposes which() as a method, newer versions as a property
+    w = event.which
+    return str(w() if callable(w) else w)
+
+
+def offsets(counts):
+    """
+    Turn per-event element counts into an offsets array of len(counts) + 1,
+    elements of event i live at [off[i], off[i+1]).
+    """
+    off = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=off[1:])
+    return off
+
+
+# dtypes of the CompressedColumns arrays, see CompressedColumns
+COMPRESSED_DTYPES = {
+    'kind': np.uint8,
+    'iops': np.uint16,
+    'flops': np.uint16,
+    'reads': np.uint16,
+    'writes': np.uint16,
+    'sync_type': np.int8,
+    'sync_args': np.uint64,
+    'marker_count': np.uint16,
+    'write_start': np.uint64,
+    'write_end': np.uint64,
+    'read_start': np.uint64,
+    'read_end': np.uint64,
+    'edge_thread': np.uint16,
+    'edge_event': np.uint32,
+    'edge_start': np.uint64,
+    'edge_end': np.uint64,
+}
+
+OFFSET_COLUMNS = ('write_off', 'read_off', 'edge_off', 'edge_addr_off')
+
+
+class CompressedColumns:
+    """
+    Compressed events (one EventStreamCompressed message, a trace file, ...)
+    decoded into flat numpy arrays.
+
+    Per event (length n): kind, iops, flops, reads, writes, sync_type
+    (NO_SYNC unless a sync event), sync_args (n x 2, unused args are 0) and
+    marker_count. Variable length fields are flattened, the ranges of event i
+    are at [off[i], off[i+1]) of their offsets array:
+      write_off -> write_start, write_end
+      read_off  -> read_start, read_end
+      edge_off  -> edge_thread, edge_event, edge_addr_off
+      edge_addr_off (per edge) -> edge_start, edge_end
+    """
+
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+    def __len__(self):
+        return len(self.kind)
+
+    def columns(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def empty(cls):
+        columns = {name: np.zeros(0, dtype=dtype) for name, dtype in COMPRESSED_DTYPES.items()}
+        columns['sync_args'] = columns['sync_args'].reshape(0, 2)
+        for name in OFFSET_COLUMNS:
+            columns[name] = offsets([])
+        return cls(**columns)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Join the columns of several parts (e.g. the messages of a trace
+        file), rebasing the offsets arrays.
+        """
+        parts = list(parts)
+        if not parts:
+            return cls.empty()
+        columns = {}
+        for name in parts[0].__dict__:
+            if name in OFFSET_COLUMNS:
+                rebased = [np.zeros(1, dtype=np.int64)]
+                base = 0
+                for p in parts:
+                    off = getattr(p, name)
+                    rebased.append(off[1:] + base)
+                    base += off[-1]
+                columns[name] = np.concatenate(rebased)
+            else:
+                columns[name] = np.concatenate([getattr(p, name) for p in parts])
+        return cls(**columns)
@@ -0,0 +1,347 @@
+#!/bin/python
+
+# Thread to thread communication of a SynchroTraceGen run, from comm edges
+#
+# Every comm event of a consumer thread names, per range it read, the
+# producer thread and event that last wrote those bytes. Per run this builds
+#   - the producer x consumer matrix in bytes and in edges, plus the same per
+#     node group (num_nodes x threads_per_node runs of run.py)
+#   - the sharing degree of memory blocks: how many threads communicate
+#     through each block of --granularity bytes
+#   - the distance from producer to consumer event ids, as a log2 histogram
+#
+# Each trace (text v1/v2, compressed or uncompressed capnp) is reduced to
+# numpy arrays by its own worker process and the results are merged.
+
+import os
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from stgen_columns import EV_COMM, EV_MARKER
+from stgen_events import trace_format, trace_thread, run_trace_paths
+from stgen_trace_input import iter_line_blocks, open_trace
+
+# '# <producer tid> <producer eid> <start> <end>', in text v1 and v2 comm lines
+EDGE_RE = re.compile(rb'# (\d+) (\d+) 0x([0-9a-fA-F]+) 0x([0-9a-fA-F]+)')
+
+NEWLINE = ord('\n')
+MARKER_CODE = ord('!')
+
+GRANULARITY = 64
+
+# log2 buckets of the producer -> consumer event distance
+DISTANCE_BUCKETS = 64
+
+
+def line_eids(block, first_eid):
+    """
+    Return the line starts of a block of whole text lines, the event id of
+    every line and the number of events in the block.
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    starts = np.flatnonzero(data == NEWLINE) + 1
+    starts = np.concatenate(([0], starts[starts < len(data)]))
+    # event ids count every line but markers
+    eids = first_eid + np.cumsum(data[starts] != MARKER_CODE) - 1
+    events = int(eids[-1] - first_eid + 1) if len(eids) else 0
+    return starts, eids, events
+
+
+def text_ranges(block, first_eid, lines=None):
+    """
+    Return the comm ranges of a block of whole text lines as (consumer eid,
+    producer thread, producer eid, start, end, new edge) arrays, plus the
+    number of events in the block. lines is the line_eids of the block if
+    the caller has it already.
+    """
+    starts, eids, events = lines or line_eids(block, first_eid)
+
+    matches = list(EDGE_RE.finditer(block))
+    if not matches:
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty, empty, empty.astype(np.uint64), empty.astype(np.uint64),
+                np.zeros(0, dtype=bool)), events
+    positions = np.array([m.start() for m in matches], dtype=np.int64)
+    lines = np.searchsorted(starts, positions, side='right') - 1
+    producer = np.array([int(m[1]) for m in matches], dtype=np.int64)
+    producer_eid = np.array([int(m[2]) for m in matches], dtype=np.int64)
+    start = np.array([int(m[3], 16) for m in matches], dtype=np.uint64)
+    end = np.array([int(m[4], 16) for m in matches], dtype=np.uint64)
+    # consecutive ranges of one line from the same producer event are one edge
+    new_edge = np.ones(len(matches), dtype=bool)
+    new_edge[1:] = ((lines[1:] != lines[:-1]) | (producer[1:] != producer[:-1])
+                    | (producer_eid[1:] != producer_eid[:-1]))
+    return (eids[lines], producer, producer_eid, start, end, new_edge), events
+
+
+def iter_text_ranges(tracepath):
+    eid = 0
+    for block in iter_line_blocks(tracepath):
+        ranges, events = text_ranges(block, eid)
+        eid += events
+        yield ranges
+
+
+def compressed_ranges(cols, eids):
+    # the comm ranges of CompressedColumns, eids: the event id of every event
+    # per edge: its comm event; per range: its edge
+    edge_events = np.repeat(np.arange(len(cols)), np.diff(cols.edge_off))
+    range_edges = np.repeat(np.arange(len(cols.edge_thread)), np.diff(cols.edge_addr_off))
+    new_edge = np.zeros(len(range_edges), dtype=bool)
+    new_edge[cols.edge_addr_off[:-1][np.diff(cols.edge_addr_off) > 0]] = True
+    return (eids[edge_events[range_edges]],
+            cols.edge_thread[range_edges].astype(np.int64),
+            cols.edge_event[range_edges].astype(np.int64),
+            cols.edge_start, cols.edge_end, new_edge)
+
+
+def uncompressed_ranges(records, eids):
+    # the comm ranges of uncompressed records, eids: the event id of every record
+    is_comm = records['kind'] == EV_COMM
+    comm = records[is_comm]
+    return (eids[is_comm],
+            comm['producer_thread'].astype(np.int64),
+            comm['producer_event'].astype(np.int64),
+            comm['start'], comm['end'], np.ones(len(comm), dtype=bool))
+
+
+def iter_compressed_ranges(tracepath):
+    from stgen_capnp_parser_compressed import parse_stgen_trace_compressed_columns
+    eid = 0
+    with open_trace(tracepath) as f:
+        for cols in parse_stgen_trace_compressed_columns(f):
+            eids = eid + np.cumsum(cols.kind != EV_MARKER) - 1
+            eid += int((cols.kind != EV_MARKER).sum())
+            yield compressed_ranges(cols, eids)
+
+
+def iter_uncompressed_ranges(tracepath):
+    from stgen_capnp_parser_uncompressed import parse_stgen_trace_uncompressed_records
+    eid = 0
+    with open_trace(tracepath) as f:
+        for records in parse_stgen_trace_uncompressed_records(f):
+            kind = records['kind']
+            eids = eid + np.cumsum(kind != EV_MARKER) - 1
+            eid += int((kind != EV_MARKER).sum())
+            yield uncompressed_ranges(records, eids)
+
+
+RANGE_READERS = {
+    'text': iter_text_ranges,
+    'compressed': iter_compressed_ranges,
+    'uncompressed': iter_uncompressed_ranges,
+}
+
+
+def block_pairs(blocks, threads, nbytes):
+    """
+    Unique (block, thread) pairs with their bytes.
+    """
+    if not len(blocks):
+        return blocks, threads, nbytes
+    order = np.lexsort((threads, blocks))
+    blocks, threads, nbytes = blocks[order], threads[order], nbytes[order]
+    first = np.ones(len(blocks), dtype=bool)
+    first[1:] = (blocks[1:] != blocks[:-1]) | (threads[1:] != threads[:-1])
+    idx = np.flatnonzero(first)
+    return blocks[idx], threads[idx], np.add.reduceat(nbytes, idx)
+
+
+class CommStats:
+    """
+    Communication of one consumer thread, or of a whole run once merged.
+    matrix_bytes/matrix_edges are indexed [producer, consumer].
+    """
+
+    def __init__(self, num_threads=0):
+        self.matrix_bytes = np.zeros((num_threads, num_threads), dtype=np.int64)
+        self.matrix_edges = np.zeros((num_threads, num_threads), dtype=np.int64)
+        self.distance = np.zeros(DISTANCE_BUCKETS, dtype=np.int64)
+        self.backwards = 0
+        self.blocks = np.zeros(0, dtype=np.uint64)
+        self.block_threads = np.zeros(0, dtype=np.int64)
+        self.block_bytes = np.zeros(0, dtype=np.int64)
+
+    def resize(self, num_threads):
+        if num_threads > len(self.matrix_bytes):
+            for name in ('matrix_bytes', 'matrix_edges'):
+                old = getattr(self, name)
+                new = np.zeros((num_threads, num_threads), dtype=np.int64)
+                new[:len(old), :len(old)] = old
+                setattr(self, name, new)
+
+    def add_blocks(self, blocks, threads, nbytes):
+        self.blocks, self.block_threads, self.block_bytes = block_pairs(
+            np.concatenate((self.blocks, blocks)),
+            np.concatenate((self.block_threads, threads)),
+            np.concatenate((self.block_bytes, nbytes)))
+
+    def add_ranges(self, consumer, ranges, shift):
+        eids, producer, producer_eid, start, end, new_edge = ranges
+        if not len(eids):
+            return
+        self.resize(max(consumer, int(producer.max())) + 1)
+        nbytes = (end - start).astype(np.int64) + 1
+        self.matrix_bytes[:, consumer] += np.bincount(producer, weights=nbytes,
+                                                      minlength=len(self.matrix_bytes)).astype(np.int64)
+        self.matrix_edges[:, consumer] += np.bincount(producer[new_edge],
+                                                      minlength=len(self.matrix_edges))
+
+        distance = eids[new_edge] - producer_eid[new_edge]
+        self.backwards += int((distance < 0).sum())
+        distance = distance[distance >= 0]
+        buckets = np.zeros(len(distance), dtype=np.int64)
+        nonzero = distance > 0
+        buckets[nonzero] = np.floor(np.log2(distance[nonzero])).astype(np.int64) + 1
+        self.distance += np.bincount(buckets, minlength=DISTANCE_BUCKETS)[:DISTANCE_BUCKETS]
+
+        # every block of a range is touched by the producer and the consumer
+        first = start >> np.uint64(shift)
+        count = ((end >> np.uint64(shift)) - first).astype(np.int64) + 1
+        blocks = np.repeat(first, count) + (np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)).astype(np.uint64)
+        per_block = np.repeat(nbytes, count) // np.repeat(count, count)
+        threads = np.repeat(producer, count)
+        self.add_blocks(np.concatenate((blocks, blocks)),
+                        np.concatenate((threads, np.full(len(blocks), consumer, dtype=np.int64))),
+                        np.concatenate((per_block, per_block)))
+
+    def merge(self, other):
+        self.resize(len(other.matrix_bytes))
+        n = len(other.matrix_bytes)
+        self.matrix_bytes[:n, :n] += other.matrix_bytes
+        self.matrix_edges[:n, :n] += other.matrix_edges
+        self.distance += other.distance
+        self.backwards += other.backwards
+        self.add_blocks(other.blocks, other.block_threads, other.block_bytes)
+        return self
+
+    def sharing(self):
+        """
+        Return (blocks, degree, bytes): every block with the number of
+        threads communicating through it and the bytes read or written.
+        Bytes are counted once for the producer and once for the consumer.
+        """
+        if not len(self.blocks):
+            return self.blocks, self.block_threads, self.block_bytes
+        first = np.ones(len(self.blocks), dtype=bool)
+        first[1:] = self.blocks[1:] != self.blocks[:-1]
+        idx = np.flatnonzero(first)
+        degree = np.diff(np.append(idx, len(self.blocks)))
+        return self.blocks[idx], degree, np.add.reduceat(self.block_bytes, idx)
+
+
+def trace_comm(tracepath, granularity=GRANULARITY):
+    stats = CommStats()
+    consumer = trace_thread(tracepath)
+    shift = int(granularity).bit_length() - 1
+    for ranges in RANGE_READERS[trace_format(tracepath)](tracepath):
+        stats.add_ranges(consumer, ranges, shift)
+    return stats
+
+
+def directory_comm(directory, max_workers=None, granularity=GRANULARITY):
+    """
+    Return the merged CommStats of all traces of a run directory.
+    """
+    # largest traces first so a big thread doesn't start last
+    paths = sorted(run_trace_paths(directory), key=os.path.getsize, reverse=True)
+    merged = CommStats()
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        for stats in pool.map(trace_comm, paths, [granularity] * len(paths)):
+            merged.merge(stats)
+    return merged
+
+
+def run_shape(directory):
+    """
+    (num_nodes, threads_per_node) from a '<app>_<workload>_<lock>_<nodes>_<threads>'
+    run directory name, or None.
+    """
+    parts = os.path.basename(os.path.normpath(directory)).split('_')
+    if len(parts) >= 2 and parts[-1].isdigit() and parts[-2].isdigit():
+        return int(parts[-2]), int(parts[-1])
+    return None
+
+
+def node_matrix(matrix, threads_per_node, first_thread=1):
+    """
+    Sum a thread x thread matrix into node groups of threads_per_node
+    consecutive threads starting at first_thread; lower threads are dropped.
+    """
+    tids = np.arange(len(matrix))
+    nodes = np.where(tids >= first_thread, (tids - first_thread) // threads_per_node, -1)
+    num_nodes = int(nodes.max()) + 1 if len(nodes) and nodes.max() >= 0 else 0
+    out = np.zeros((num_nodes, num_nodes), dtype=np.int64)
+    keep = nodes >= 0
+    np.add.at(out, (nodes[keep][:, None], nodes[keep][None, :]), matrix[np.ix_(keep, keep)])
+    return out
+
+
+def print_matrix(title, matrix, first=0):
+    print(title)
+    rows = range(first, len(matrix))
+    width = max(8, len(str(int(matrix.max()))) + 1 if matrix.size else 8)
+    print('%8s' % 'p\\c' + ''.join('%*d' % (width, c) for c in rows))
+    for p in rows:
+        print('%8d' % p + ''.join('%*d' % (width, matrix[p, c]) for c in rows))
+
+
+def print_comm(stats, granularity, threads_per_node=None, first_thread=1, top=10):
+    total_bytes = int(stats.matrix_bytes.sum())
+    total_edges = int(stats.matrix_edges.sum())
+    print('%d bytes over %d edges' % (total_bytes, total_edges))
+    print_matrix('bytes (producer x consumer):', stats.matrix_bytes, first_thread)
+    print_matrix('edges (producer x consumer):', stats.matrix_edges, first_thread)
+    if threads_per_node:
+        nodes = node_matrix(stats.matrix_bytes, threads_per_node, first_thread)
+        print_matrix('bytes per node group of %d threads:' % threads_per_node, nodes)
+        if nodes.sum():
+            print('inter-node bytes: %.1f%%' % (100.0 * (nodes.sum() - np.trace(nodes)) / nodes.sum()))
+
+    blocks, degree, nbytes = stats.sharing()
+    print('sharing degree of %d byte blocks:' % granularity)
+    for d, n in zip(*np.unique(degree, return_counts=True)):
+        print('  %3d threads: %d blocks' % (d, n))
+    order = np.lexsort((-nbytes, -degree))[:top]
+    for i in order.tolist():
+        print('  %#x: %d threads, %d bytes' % (int(blocks[i]) * granularity, degree[i], nbytes[i]))
+
+    print('producer -> consumer event distance:')
+    for b in np.flatnonzero(stats.distance).tolist():
+        low = 0 if b == 0 else 1 << (b - 1)
+        print('  [%d, %d]: %d' % (low, (1 << b) - 1 if b else 0, stats.distance[b]))
+    if stats.backwards:
+        print('  negative: %d' % stats.backwards)
+
+
+def save_comm(path, stats, granularity):
+    blocks, degree, nbytes = stats.sharing()
+    np.savez(path, matrix_bytes=stats.matrix_bytes, matrix_edges=stats.matrix_edges,
+             distance=stats.distance, backwards=stats.backwards, granularity=granularity,
+             blocks=blocks, degree=degree, block_bytes=nbytes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Communication matrix and sharing of the '
+                                                  'SynchroTraceGen traces of a run'))
+    parser.add_argument('directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes')
+    parser.add_argument('-g', '--granularity', type=int, default=GRANULARITY,
+                        help='block size in bytes for the sharing degree, a power of 2')
+    parser.add_argument('--threads-per-node', type=int, default=None,
+                        help='node group size, default: from the run directory name')
+    parser.add_argument('--first-thread', type=int, default=1,
+                        help='first thread of node 0, lower threads are left out of the node groups')
+    parser.add_argument('--top', type=int, default=10, help='most shared blocks listed')
+    parser.add_argument('--save', help='also save the results to this .npz file')
+    args = parser.parse_args()
+
+    stats = directory_comm(args.directory, args.jobs, args.granularity)
+    shape = run_shape(args.directory)
+    threads_per_node = args.threads_per_node or (shape[1] if shape else None)
+    print_comm(stats, args.granularity, threads_per_node, args.first_thread, args.top)
+    if args.save:
+        save_comm(args.save, stats, args.granularity)
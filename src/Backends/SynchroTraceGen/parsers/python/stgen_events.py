@@ -0,0 +1,425 @@
+#!/bin/python
+
+# One lazy event iterator over all SynchroTraceGen trace formats
+#
+#   text v1       (-l text)    'eid,tid,iops,flops,reads,writes $ .. * ..', 'eid,tid # ..',
+#                              'eid,tid,pth_ty:type^0x..&0x..', '! N'
+#   text v2       (-l textv2)  '@ ..', '# ..', '^ ..', '! N'
+#   capnp         (-l capnp)   *.compressed.capn*.bin[.gz] and *.uncompressed.capn*.bin[.gz]
+#
+# iter_events() yields small __slots__ views over the raw line or capnp
+# reader; fields such as address ranges are only decoded when accessed.
+# Filters are pushed down as far as the format allows: event kinds are
+# checked on the first byte of a line or on the capnp union tag, threads by
+# file name, barrier windows count barrier records only (and seek through a
+# stgen_trace_index index when one exists), address ranges decode the ranges
+# of memory events only.
+#
+# Events are numbered per thread like the parsers see them: every line of a
+# text trace, every event (markers included) of a capnp trace, from 0. Views
+# also carry the event id the comm edges of other threads refer to, which
+# counts every event but markers (None after seeking through an index).
+
+import os
+import re
+import argparse
+
+from stgen_columns import (EV_COMP, EV_COMM, EV_SYNC, EV_MARKER, EVENT_KINDS,
+                           SYNC_TYPE_IDS, TEXT_SYNC_TYPES, which)
+from stgen_trace_input import iter_line_blocks, open_trace
+
+TRACE_RE = re.compile(r'sigil\.events\.out-(\d+)\.')
+
+COMP_CODE = ord('@')
+COMM_CODE = ord('#')
+SYNC_CODE = ord('^')
+MARKER_CODE = ord('!')
+
+SYNC_BARRIER = SYNC_TYPE_IDS['barrier']
+
+
+def trace_thread(tracepath):
+    m = TRACE_RE.search(os.path.basename(tracepath))
+    return int(m.group(1)) if m else None
+
+
+def trace_format(tracepath):
+    """
+    'compressed' or 'uncompressed' for capnp traces, 'text' otherwise;
+    text v1 and v2 are told apart per line.
+    """
+    name = os.path.basename(tracepath)
+    if '.capn' not in name:
+        return 'text'
+    return 'uncompressed' if 'uncompressed' in name else 'compressed'
+
+
+def text_kind(line):
+    """
+    Event kind of a text v1 or v2 line from its first bytes.
+    """
+    code = line[0]
+    if code == COMP_CODE:
+        return EV_COMP
+    if code == COMM_CODE:
+        return EV_COMM
+    if code == SYNC_CODE:
+        return EV_SYNC
+    if code == MARKER_CODE:
+        return EV_MARKER
+    # v1: 'eid,tid...'
+    if b'pth_ty' in line:
+        return EV_SYNC
+    if b' # ' in line:
+        return EV_COMM
+    return EV_COMP
+
+
+def is_text_barrier(line):
+    return line.startswith(b'^ 5^') or (b'pth_ty:5^' in line and line[0] != SYNC_CODE)
+
+
+class TextEvent:
+    """
+    View of one text v1 or v2 line.
+    """
+
+    __slots__ = ('kind', 'thread', 'index', 'eid', 'line')
+
+    def __init__(self, kind, thread, index, eid, line):
+        self.kind = kind
+        self.thread = thread
+        self.index = index
+        self.eid = eid
+        self.line = line
+
+    def _parts(self):
+        parts = self.line.split()
+        if self.line[0] in (COMP_CODE, COMM_CODE):
+            return parts[1:]
+        # v1: the first token holds 'eid,tid[,...]'
+        return parts
+
+    @property
+    def counters(self):
+        """
+        (iops, flops, reads, writes) of a comp event.
+        """
+        head = self._parts()[0].split(b',')
+        if self.line[0] != COMP_CODE:
+            head = head[2:]
+        return tuple(int(c) for c in head)
+
+    def _ranges(self, tag):
+        parts = self._parts()
+        return [(int(parts[i + 1], 16), int(parts[i + 2], 16))
+                for i in range(len(parts)) if parts[i] == tag]
+
+    @property
+    def write_ranges(self):
+        return self._ranges(b'$') if self.kind == EV_COMP else []
+
+    @property
+    def read_ranges(self):
+        return self._ranges(b'*') if self.kind == EV_COMP else []
+
+    @property
+    def edges(self):
+        """
+        (producer thread, producer event, start, end) of a comm event.
+        """
+        if self.kind != EV_COMM:
+            return []
+        parts = self.line.split()
+        return [(int(parts[i + 1]), int(parts[i + 2]), int(parts[i + 3], 16), int(parts[i + 4], 16))
+                for i in range(len(parts)) if parts[i] == b'#']
+
+    def ranges(self):
+        """
+        All address ranges of a memory event.
+        """
+        if self.kind == EV_COMP:
+            parts = self._parts()
+            return [(int(parts[i + 1], 16), int(parts[i + 2], 16))
+                    for i in range(len(parts)) if parts[i] in (b'$', b'*')]
+        return [(e[2], e[3]) for e in self.edges]
+
+    def _sync(self):
+        body = self.line[2:] if self.line[0] == SYNC_CODE else self.line.split(b'pth_ty:')[1]
+        ty, args = body.split(b'^')
+        return TEXT_SYNC_TYPES[int(ty)], [int(a, 16) for a in args.split(b'&')]
+
+    @property
+    def sync_type(self):
+        return self._sync()[0] if self.kind == EV_SYNC else None
+
+    @property
+    def sync_args(self):
+        return self._sync()[1] if self.kind == EV_SYNC else []
+
+    @property
+    def marker_count(self):
+        return int(self.line.split()[1]) if self.kind == EV_MARKER else 0
+
+    def __repr__(self):
+        return 'TextEvent(%d:%d %r)' % (self.thread or 0, self.index, self.line)
+
+
+class CapnpEvent:
+    """
+    View of one capnp event reader, compressed or uncompressed schema.
+    """
+
+    __slots__ = ('kind', 'thread', 'index', 'eid', 'event', 'compressed')
+
+    def __init__(self, kind, thread, index, eid, event, compressed):
+        self.kind = kind
+        self.thread = thread
+        self.index = index
+        self.eid = eid
+        self.event = event
+        self.compressed = compressed
+
+    @property
+    def counters(self):
+        if self.kind != EV_COMP:
+            return None
+        comp = self.event.comp
+        if self.compressed:
+            return (comp.iops, comp.flops, comp.reads, comp.writes)
+        mem = str(comp.mem)
+        return (comp.iops, comp.flops, int(mem == 'read'), int(mem == 'write'))
+
+    def _mem_ranges(self, mem, field):
+        if self.kind != EV_COMP:
+            return []
+        comp = self.event.comp
+        if self.compressed:
+            return [(r.start, r.end) for r in getattr(comp, field)]
+        if str(comp.mem) == mem:
+            return [(comp.startAddr, comp.endAddr)]
+        return []
+
+    @property
+    def write_ranges(self):
+        return self._mem_ranges('write', 'writeAddrs')
+
+    @property
+    def read_ranges(self):
+        return self._mem_ranges('read', 'readAddrs')
+
+    @property
+    def edges(self):
+        if self.kind != EV_COMM:
+            return []
+        comm = self.event.comm
+        if self.compressed:
+            return [(e.producerThread, e.producerEvent, r.start, r.end)
+                    for e in comm.edges for r in e.addrs]
+        return [(comm.producerThread, comm.producerEvent, comm.startAddr, comm.endAddr)]
+
+    def ranges(self):
+        if self.kind == EV_COMP:
+            return self.write_ranges + self.read_ranges
+        return [(e[2], e[3]) for e in self.edges]
+
+    @property
+    def sync_type(self):
+        return SYNC_TYPE_IDS[str(self.event.sync.type)] if self.kind == EV_SYNC else None
+
+    @property
+    def sync_args(self):
+        return list(self.event.sync.args) if self.kind == EV_SYNC else []
+
+    @property
+    def marker_count(self):
+        return self.event.marker.count if self.kind == EV_MARKER else 0
+
+    def __repr__(self):
+        return 'CapnpEvent(%d:%d %s)' % (self.thread or 0, self.index, which(self.event))
+
+
+class EventFilter:
+    """
+    Push-down filters of iter_events:
+      kinds       event kinds (EV_* or 'comp', 'comm', 'sync', 'marker') to keep
+      threads     thread ids to keep, matched on the trace file name
+      addr_range  (lo, hi) inclusive; memory events are kept if one of their
+                  ranges overlaps it, events without addresses are kept
+      barriers    (first, stop): events from the first-th barrier of the
+                  thread (counting from 0, the barrier included) up to the
+                  stop-th one; stop None runs to the end
+    """
+
+    def __init__(self, kinds=None, threads=None, addr_range=None, barriers=None):
+        self.kinds = None if kinds is None else frozenset(
+            EVENT_KINDS.get(k, k) for k in kinds)
+        self.threads = None if threads is None else frozenset(threads)
+        self.addr_range = addr_range
+        self.barriers = barriers
+
+    def keeps_thread(self, thread):
+        return self.threads is None or thread in self.threads
+
+    def keeps_kind(self, kind):
+        return self.kinds is None or kind in self.kinds
+
+    def keeps_addrs(self, view):
+        if self.addr_range is None or view.kind not in (EV_COMP, EV_COMM):
+            return True
+        lo, hi = self.addr_range
+        return any(start <= hi and end >= lo for start, end in view.ranges())
+
+
+def iter_text_records(tracepath, first_barrier):
+    """
+    Yield (index, line) of a text trace, starting at the first_barrier-th
+    barrier through the trace's index when there is one. Returns the number
+    of barriers skipped that way as the first item.
+    """
+    if first_barrier:
+        from stgen_trace_index import load_index, iter_text_lines
+        index = load_index(tracepath) if tracepath.endswith('.gz') else None
+        if index is not None and first_barrier < len(index.barrier_event):
+            yield first_barrier
+            start = int(index.barrier_event[first_barrier])
+            for i, line in enumerate(iter_text_lines(tracepath, start, index=index), start):
+                yield i, line
+            return
+    yield 0
+    i = 0
+    for block in iter_line_blocks(tracepath):
+        for line in block.splitlines():
+            yield i, line
+            i += 1
+
+
+def iter_capnp_records(tracepath, fmt, first_barrier):
+    from stgen_trace_index import capnp_stream
+    if first_barrier:
+        from stgen_trace_index import load_index, iter_capnp_events
+        index = load_index(tracepath) if tracepath.endswith('.gz') else None
+        if index is not None and first_barrier < len(index.barrier_event):
+            yield first_barrier
+            start = int(index.barrier_event[first_barrier])
+            for i, event in enumerate(iter_capnp_events(tracepath, start, index=index), start):
+                yield i, event
+            return
+    yield 0
+    i = 0
+    with open_trace(tracepath) as f:
+        for message in capnp_stream(tracepath).read_multiple_packed(
+                f, traversal_limit_in_words=2**63):
+            for event in message.events:
+                yield i, event
+                i += 1
+
+
+def iter_events(tracepath, kinds=None, threads=None, addr_range=None, barriers=None,
+                filter=None):
+    """
+    Yield TextEvent or CapnpEvent views of one trace that pass the filters,
+    see EventFilter.
+    """
+    filter = filter or EventFilter(kinds, threads, addr_range, barriers)
+    thread = trace_thread(tracepath)
+    if not filter.keeps_thread(thread):
+        return
+    first, stop = filter.barriers or (0, None)
+    fmt = trace_format(tracepath)
+
+    if fmt == 'text':
+        records = iter_text_records(tracepath, first)
+        seen = next(records)
+        eid = None if seen else 0
+        for i, line in records:
+            if not line:
+                continue
+            kind = text_kind(line)
+            view_eid = eid
+            if eid is not None and kind != EV_MARKER:
+                eid += 1
+            if filter.barriers is not None and is_text_barrier(line):
+                if seen == stop:
+                    return
+                seen += 1
+            if filter.barriers is not None and seen <= first:
+                continue
+            if not filter.keeps_kind(kind):
+                continue
+            view = TextEvent(kind, thread, i, view_eid, line)
+            if filter.keeps_addrs(view):
+                yield view
+    else:
+        compressed = fmt == 'compressed'
+        records = iter_capnp_records(tracepath, fmt, first)
+        seen = next(records)
+        eid = None if seen else 0
+        for i, event in records:
+            kind = EVENT_KINDS[which(event)]
+            view_eid = eid
+            if eid is not None and kind != EV_MARKER:
+                eid += 1
+            if (filter.barriers is not None and kind == EV_SYNC
+                    and SYNC_TYPE_IDS[str(event.sync.type)] == SYNC_BARRIER):
+                if seen == stop:
+                    return
+                seen += 1
+            if filter.barriers is not None and seen <= first:
+                continue
+            if not filter.keeps_kind(kind):
+                continue
+            view = CapnpEvent(kind, thread, i, view_eid, event, compressed)
+            if filter.keeps_addrs(view):
+                yield view
+
+
+def run_trace_paths(directory):
+    """
+    Event traces of a run directory ordered by thread id.
+    """
+    paths = [os.path.join(directory, f) for f in os.listdir(directory)
+             if trace_thread(f) is not None and not f.endswith(('.npz', '.npy', '.tmp'))]
+    return sorted(paths, key=lambda p: trace_thread(p))
+
+
+def iter_run_events(directory, **filters):
+    """
+    Yield the filtered events of every thread of a run, thread by thread.
+    """
+    filter = EventFilter(**filters)
+    for tracepath in run_trace_paths(directory):
+        if filter.keeps_thread(trace_thread(tracepath)):
+            for view in iter_events(tracepath, filter=filter):
+                yield view
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Print the events of SynchroTraceGen '
+                                                  'traces, filtered'))
+    parser.add_argument('paths', nargs='+', help='trace files or run directories')
+    parser.add_argument('--kinds', nargs='+', choices=sorted(EVENT_KINDS))
+    parser.add_argument('--threads', nargs='+', type=int)
+    parser.add_argument('--addr-range', nargs=2, type=lambda x: int(x, 0), metavar=('LO', 'HI'))
+    parser.add_argument('--barriers', nargs=2, type=int, metavar=('FIRST', 'STOP'),
+                        help='barrier window, STOP < 0 runs to the end')
+    parser.add_argument('--count', action='store_true', help='only count events per kind')
+    args = parser.parse_args()
+
+    barriers = None
+    if args.barriers:
+        barriers = (args.barriers[0], args.barriers[1] if args.barriers[1] >= 0 else None)
+    filters = dict(kinds=args.kinds, threads=args.threads, addr_range=args.addr_range,
+                   barriers=barriers)
+    counts = dict.fromkeys(EVENT_KINDS, 0)
+    names = {v: k for k, v in EVENT_KINDS.items()}
+    for path in args.paths:
+        views = (iter_run_events(path, **filters) if os.path.isdir(path)
+                 else iter_events(path, **filters))
+        for view in views:
+            if args.count:
+                counts[names[view.kind]] += 1
+            else:
+                print(view)
+    if args.count:
+        print(' '.join('%s: %d' % kv for kv in counts.items()))
@@ -0,0 +1,348 @@
+#!/bin/python
+
+# Memory access metrics of a directory of traces, a port of the rust
+# print_memory_metrics binary
+#
+# Every thread trace is reduced to (address, times accessed) histograms in a
+# worker process with np.unique, the partial histograms are merged and the
+# metrics are computed over whole arrays. Metrics can be reported at coarser
+# granularities (cache line, page, ...) derived from the byte histograms.
+#
+# For traces whose footprint doesn't fit in memory, --sketch replaces the
+# exact histograms with fixed-size mergeable sketches (stgen_sketches.py).
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from stgen_columns import EV_COMP, EV_COMM, MEM_READ, MEM_WRITE
+from stgen_trace_input import open_trace
+from stgen_text_parser import parse_text_trace_addresses
+from stgen_sketches import AddressSketch, save_sketches, load_sketches
+
+TRACE_EXTENSIONS = ('.gz', '.zst', '.bin')
+COMPRESSED_EXTENSIONS = ('.gz', '.zst')
+
+# addresses buffered per trace before they are folded into its histograms
+COMPACT_SIZE = 1 << 22
+
+# the rust tool's local entropy crops the 10 least significant address bits
+LOCAL_SHIFT = 10
+
+# extra granularities reported by default, in bytes
+GRANULARITIES = (64, 1024, 4096)
+
+# HyperLogLog precision and heavy hitters kept by --sketch
+SKETCH_P = 14
+SKETCH_K = 1 << 16
+
+
+def fold(addrs, counts):
+    """
+    Sum the counts of equal addresses, returns sorted unique addresses.
+    """
+    uniq, inverse = np.unique(addrs, return_inverse=True)
+    return uniq, np.bincount(inverse, weights=counts, minlength=len(uniq)).astype(np.int64)
+
+
+def merge_histograms(parts):
+    """
+    Merge (addrs, counts) histograms into one with sorted unique addresses.
+    """
+    parts = [p for p in parts if len(p[0])]
+    if not parts:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    if len(parts) == 1:
+        return parts[0]
+    return fold(np.concatenate([a for a, c in parts]),
+                np.concatenate([c for a, c in parts]))
+
+
+def histogram(addrs):
+    uniq, counts = np.unique(addrs, return_counts=True)
+    return uniq, counts.astype(np.int64)
+
+
+def coarsen(hist, shift):
+    """
+    Histogram of hist at a granularity of 2**shift bytes.
+    """
+    addrs, counts = hist
+    if shift == 0:
+        return hist
+    return fold(addrs >> np.uint64(shift), counts)
+
+
+def trace_format(tracepath):
+    name = os.path.basename(tracepath)
+    if '.capn' not in name:
+        return 'text'
+    return 'uncompressed' if 'uncompressed' in name else 'compressed'
+
+
+def record_addresses(records):
+    kind = records['kind']
+    mem = records['mem']
+    # all comms are treated as reads
+    reads = ((kind == EV_COMP) & (mem == MEM_READ)) | (kind == EV_COMM)
+    writes = (kind == EV_COMP) & (mem == MEM_WRITE)
+    return records['start'][reads], records['start'][writes]
+
+
+def trace_addresses(tracepath, use_cache=False):
+    """
+    Yield (reads, writes) address arrays of a trace of any format. Each
+    range of a compressed capnp or text trace counts as an access of its
+    start address. use_cache decodes uncompressed capnp traces through the
+    <trace>.npy cache of load_records.
+    """
+    fmt = trace_format(tracepath)
+    if fmt == 'text':
+        for addrs in parse_text_trace_addresses(tracepath):
+            yield addrs
+    elif use_cache and fmt == 'uncompressed':
+        from stgen_capnp_parser_uncompressed import load_records
+        records = load_records(tracepath)
+        for i in range(0, len(records), COMPACT_SIZE):
+            yield record_addresses(records[i:i + COMPACT_SIZE])
+    elif fmt == 'uncompressed':
+        from stgen_capnp_parser_uncompressed import parse_stgen_trace_uncompressed_records
+        with open_trace(tracepath) as f:
+            for records in parse_stgen_trace_uncompressed_records(f):
+                yield record_addresses(records)
+    else:
+        from stgen_capnp_parser_compressed import parse_stgen_trace_compressed_columns
+        with open_trace(tracepath) as f:
+            for cols in parse_stgen_trace_compressed_columns(f):
+                yield (np.concatenate((cols.read_start, cols.edge_start)),
+                       cols.write_start)
+
+
+class HistogramBuilder:
+    """
+    Accumulate read and write addresses of one trace and fold them into
+    histograms every COMPACT_SIZE addresses to bound memory.
+    """
+
+    def __init__(self):
+        self.pending = {'reads': [], 'writes': []}
+        self.pending_size = 0
+        self.hists = {'reads': [], 'writes': []}
+
+    def add(self, reads, writes):
+        self.pending['reads'].append(reads)
+        self.pending['writes'].append(writes)
+        self.pending_size += len(reads) + len(writes)
+        if self.pending_size >= COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        for key, arrays in self.pending.items():
+            if arrays:
+                hist = histogram(np.concatenate(arrays))
+                self.hists[key] = [merge_histograms(self.hists[key] + [hist])]
+            self.pending[key] = []
+        self.pending_size = 0
+
+    def result(self):
+        self.compact()
+        return (merge_histograms(self.hists['reads']),
+                merge_histograms(self.hists['writes']))
+
+
+def trace_histograms(tracepath, use_cache=False):
+    """
+    Return the (reads, writes) address histograms of one trace.
+    """
+    builder = HistogramBuilder()
+    for reads, writes in trace_addresses(tracepath, use_cache):
+        builder.add(reads, writes)
+    return builder.result()
+
+
+def trace_sketches(tracepath, use_cache=False, p=SKETCH_P, k=SKETCH_K):
+    """
+    Return the {'reads', 'writes'} AddressSketch of one trace.
+    """
+    sketches = {'reads': AddressSketch(p, k), 'writes': AddressSketch(p, k)}
+    for reads, writes in trace_addresses(tracepath, use_cache):
+        sketches['reads'].add(reads)
+        sketches['writes'].add(writes)
+    return sketches
+
+
+def trace_paths(directory):
+    """
+    One path per trace of a directory: a decompressed copy next to the
+    original (x.bin beside x.bin.gz) is read instead of it, so the thread
+    isn't counted twice.
+    """
+    by_stem = {}
+    for f in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(f)
+        if ext not in TRACE_EXTENSIONS:
+            continue
+        if ext in COMPRESSED_EXTENSIONS:
+            by_stem.setdefault(stem, f)
+        else:
+            by_stem[f] = f
+    paths = [os.path.join(directory, f) for f in by_stem.values()]
+    # largest traces first so a big thread doesn't start last
+    return sorted(paths, key=os.path.getsize, reverse=True)
+
+
+def directory_histograms(directory, max_workers=None, use_cache=False):
+    """
+    Return the merged (reads, writes) histograms of all traces of a directory,
+    one worker process per trace.
+    """
+    paths = trace_paths(directory)
+    reads, writes = [], []
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        for r, w in pool.map(trace_histograms, paths, [use_cache] * len(paths)):
+            reads.append(r)
+            writes.append(w)
+    return merge_histograms(reads), merge_histograms(writes)
+
+
+def directory_sketches(directory, max_workers=None, use_cache=False):
+    """
+    Return the merged {'reads', 'writes'} sketches of all traces of a directory.
+    """
+    paths = trace_paths(directory)
+    merged = None
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        for sketches in pool.map(trace_sketches, paths, [use_cache] * len(paths)):
+            merged = merge_sketches(merged, sketches)
+    return merged
+
+
+def merge_sketches(merged, sketches):
+    if merged is None:
+        return sketches
+    for name in merged:
+        merged[name].merge(sketches[name])
+    return merged
+
+
+def ninety_perc(counts, total):
+    """
+    How many unique addresses make up the top 90% of all accesses.
+    """
+    running = np.cumsum(np.sort(counts)[::-1])
+    return int(np.searchsorted(running, int(0.9 * total), side='right'))
+
+
+def entropy(counts, total):
+    if total == 0:
+        return 0.0
+    prob = counts / total
+    return float(-(prob * np.log2(prob)).sum())
+
+
+def memory_metrics(hist, shift=0):
+    """
+    total, unique, 90% unique and entropy of a histogram at a granularity
+    of 2**shift bytes; 'local_entropy' is measured LOCAL_SHIFT bits coarser.
+    """
+    addrs, counts = coarsen(hist, shift)
+    total = int(counts.sum())
+    return {
+        'total': total,
+        'unique': len(addrs),
+        'ninety': ninety_perc(counts, total),
+        'entropy': entropy(counts, total),
+        'local_entropy': entropy(coarsen((addrs, counts), LOCAL_SHIFT)[1], total),
+    }
+
+
+def granularity_shift(size):
+    if size <= 0 or size & (size - 1):
+        raise ValueError('granularity must be a power of two: %d' % size)
+    return size.bit_length() - 1
+
+
+def print_metrics(reads, writes):
+    r = memory_metrics(reads)
+    w = memory_metrics(writes)
+    print('Total Num.  Reads : %d' % r['total'])
+    print('Total Uniq. Reads : %d' % r['unique'])
+    print('90%%   Uniq. Reads : %d' % r['ninety'])
+    print('Glob  Ent.  Reads : %s' % r['entropy'])
+    print('Local Ent.  Reads : %s' % r['local_entropy'])
+    print('Total Num.  Writes: %d' % w['total'])
+    print('Total Uniq. Writes: %d' % w['unique'])
+    print('90%%   Uniq. Writes: %d' % w['ninety'])
+    print('Glob  Ent.  Writes: %s' % w['entropy'])
+    print('Local Ent.  Writes: %s' % w['local_entropy'])
+
+
+def print_sketch_metrics(sketches):
+    r = sketches['reads'].metrics()
+    w = sketches['writes'].metrics()
+    print('Total Num.  Reads : %d' % r['total'])
+    print('~Uniq.      Reads : %d' % r['unique'])
+    print('~90%%  Uniq. Reads : %d' % r['ninety'])
+    print('Max Count Err Rd  : %d' % r['error'])
+    print('Total Num.  Writes: %d' % w['total'])
+    print('~Uniq.      Writes: %d' % w['unique'])
+    print('~90%%  Uniq. Writes: %d' % w['ninety'])
+    print('Max Count Err Wr  : %d' % w['error'])
+
+
+def print_granularities(reads, writes, sizes):
+    print('%-6s %-6s %12s %12s %12s %10s' % ('gran', 'access', 'total', 'unique', '90% uniq', 'entropy'))
+    for size in sizes:
+        shift = granularity_shift(size)
+        for name, hist in (('reads', reads), ('writes', writes)):
+            m = memory_metrics(hist, shift)
+            print('%-6d %-6s %12d %12d %12d %10.4f'
+                  % (size, name, m['total'], m['unique'], m['ninety'], m['entropy']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Print memory access metrics of '
+                                                  'directories of SynchroTraceGen traces'))
+    parser.add_argument('paths', nargs='+',
+                        help='trace directories, or .npz files saved with --save-sketch')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: CPU count)')
+    parser.add_argument('-g', '--granularity', type=int, nargs='*', default=list(GRANULARITIES),
+                        help='extra granularities in bytes, powers of two (default: 64 1024 4096)')
+    parser.add_argument('--cache', action='store_true',
+                        help='decode through cached <trace>.npy record files')
+    parser.add_argument('--sketch', action='store_true',
+                        help=('approximate unique and 90%% counts with fixed-size '
+                              'sketches instead of exact histograms'))
+    parser.add_argument('--save-sketch', metavar='NPZ',
+                        help='save the merged sketches for a later merge (implies --sketch)')
+    args = parser.parse_args()
+
+    sketch = args.sketch or args.save_sketch or any(p.endswith('.npz') for p in args.paths)
+    for size in args.granularity:
+        granularity_shift(size)
+
+    if sketch:
+        merged = None
+        for path in args.paths:
+            if path.endswith('.npz'):
+                merged = merge_sketches(merged, load_sketches(path))
+            else:
+                print('Parsing dir: %s' % path)
+                merged = merge_sketches(merged, directory_sketches(path, args.jobs, args.cache))
+        if args.save_sketch:
+            save_sketches(args.save_sketch, merged)
+        print_sketch_metrics(merged)
+    else:
+        reads, writes = [], []
+        for path in args.paths:
+            print('Parsing capnp dir: %s' % path)
+            r, w = directory_histograms(path, args.jobs, args.cache)
+            reads.append(r)
+            writes.append(w)
+        reads, writes = merge_histograms(reads), merge_histograms(writes)
+        print_metrics(reads, writes)
+        if args.granularity:
+            print_granularities(reads, writes, args.granularity)
@@ -0,0 +1,333 @@
+#!/bin/python
+
+# Merge the per-thread traces of a run into one globally ordered event stream
+#
+# Threads only order each other implicitly, so the merge picks, among the
+# threads whose next event may go, the one that retired the fewest
+# instructions so far (from the '! N' markers), and holds a thread back while
+#   - it was spawned ('##' lines of sigil.pthread.out) and its parent's spawn
+#     event has not been emitted yet
+#   - its next event is a comm event whose producer events have not been
+#     emitted yet
+#   - it passed a barrier whose other participants ('**' lines of
+#     sigil.pthread.out) have not all reached it yet
+#   - its next event joins a thread that still has events left
+#   - its next event takes a lock another thread holds
+#
+# pthread locks are keyed by their address. Spin locks are not: the argument
+# of their records is the code address of a lock indicator. As in
+# post_process and lock_stats, every lock operation is four spinlock records
+# (lock begin, lock end, unlock begin, unlock end) whose lock is the
+# operation's entry of lock_acc_addr/<tid>, read through lock_addrs from
+# GCP_scripts. A spin lock is held from lock end to unlock end, read locks
+# included. Spin records of a thread without a lock_acc_addr file are not
+# ordered.
+# Whoever releases a thread also pushes its instruction clock forward. If
+# every thread is held back (a lock order the heuristic got wrong, an
+# inconsistent trace) one goes anyway, preferably one waiting on a lock, so
+# that only mutual exclusion gets broken; these are counted in
+# TraceMerger.forced.
+#
+# Each thread is read through stgen_events with at most read_ahead events
+# buffered, so memory stays bounded however large the traces are.
+
+import os
+import heapq
+import argparse
+import itertools
+import collections
+
+from stgen_columns import EV_COMM, EV_SYNC, EV_MARKER, EVENT_KINDS, SYNC_TYPE_IDS
+from stgen_events import iter_events, run_trace_paths, trace_thread
+
+READ_AHEAD = 1024
+
+PTHREAD_FILE = 'sigil.pthread.out'
+
+SYNC_SPAWN = SYNC_TYPE_IDS['spawn']
+SYNC_JOIN = SYNC_TYPE_IDS['join']
+SYNC_BARRIER = SYNC_TYPE_IDS['barrier']
+SYNC_LOCK = SYNC_TYPE_IDS['lock']
+SYNC_UNLOCK = SYNC_TYPE_IDS['unlock']
+SYNC_SPINLOCK = SYNC_TYPE_IDS['spinLock']
+SYNC_SPINUNLOCK = SYNC_TYPE_IDS['spinUnlock']
+
+LOCK_ACC_ADDR_DIR = 'lock_acc_addr'
+
+# records of a spin lock operation that take and release its lock
+SPIN_LOCK_END = 1
+SPIN_UNLOCK_END = 3
+
+
+def read_pthread(path):
+    """
+    Parse sigil.pthread.out into ({pthread_t: spawned thread},
+    {barrier address: participant threads}). Both are empty if it is missing.
+    """
+    spawns, barriers = {}, {}
+    if not os.path.exists(path):
+        return spawns, barriers
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('##'):
+                addr, tid = line[2:].split(',')
+                spawns[int(addr)] = int(tid)
+            elif line.startswith('**'):
+                fields = line[2:].split(',')
+                barriers[int(fields[0])] = frozenset(int(t) for t in fields[1:])
+    return spawns, barriers
+
+
+class ThreadCursor:
+    """
+    Next events of one thread and where it stands in the merge.
+    """
+
+    def __init__(self, tracepath, read_ahead):
+        self.thread = trace_thread(tracepath)
+        self.events = iter_events(tracepath)
+        self.read_ahead = read_ahead
+        self.ahead = collections.deque()
+        self.emitted = 0      # events emitted, markers excluded
+        self.clock = 0        # instructions retired, pushed forward by releases
+        self.barriers = collections.Counter()
+        self.release = None   # (barrier address, instance) waited on
+        self.forced = False
+        self.lock_addrs = None    # lock_addrs.LockAddrCursor of its spin records
+        self.spin_started = False
+
+    def spin_record(self, view):
+        """
+        (lock key, record of its lock operation) of a spinlock record, None
+        for other events and for spin records that are not ordered.
+        """
+        if (self.lock_addrs is None or view.kind != EV_SYNC
+                or view.sync_type not in (SYNC_SPINLOCK, SYNC_SPINUNLOCK)):
+            return None
+        if view.sync_type == SYNC_SPINUNLOCK and not self.spin_started:
+            # like post_process, unlocks before the first lock are not lock operations
+            return None
+        lock, record = self.lock_addrs.peek()
+        return ('spin', lock), record
+
+    def head(self):
+        if not self.ahead:
+            self.ahead.extend(itertools.islice(self.events, self.read_ahead))
+        return self.ahead[0] if self.ahead else None
+
+
+class TraceMerger:
+    """
+    Iterate over the events of all threads of a run in one causally
+    consistent order.
+    """
+
+    def __init__(self, directory, read_ahead=READ_AHEAD, pthread_path=None):
+        self.cursors = {}
+        for tracepath in run_trace_paths(directory):
+            cursor = ThreadCursor(tracepath, read_ahead)
+            self.cursors[cursor.thread] = cursor
+        if os.path.isdir(os.path.join(directory, LOCK_ACC_ADDR_DIR)):
+            from lock_addrs import load_lock_acc_addrs, LockAddrCursor
+            for cursor in self.cursors.values():
+                addrs = load_lock_acc_addrs(directory, cursor.thread)
+                if addrs is not None:
+                    cursor.lock_addrs = LockAddrCursor(addrs, 'thread %d' % cursor.thread)
+        self.spawns, barriers = read_pthread(pthread_path or os.path.join(directory, PTHREAD_FILE))
+        self.participants = {addr: tids & self.cursors.keys() for addr, tids in barriers.items()}
+        self.unstarted = set(self.spawns.values()) & self.cursors.keys()
+        self.arrivals = collections.Counter()
+        self.arrival_clock = {}
+        self.locks = {}
+        self.exited = set()
+        self.ready = []
+        self.blocked = {}
+        self.waiters = collections.defaultdict(list)
+        self.forced = 0
+
+    def blocker(self, cursor, view):
+        """
+        What holds the thread's next event back, or None if it may go.
+        """
+        if cursor.forced:
+            return None
+        if cursor.release is not None:
+            return ('barrier',) + cursor.release
+        t = cursor.thread
+        if t in self.unstarted:
+            return ('spawn', t)
+        if view.kind == EV_COMM:
+            for producer, event, _, _ in view.edges:
+                other = self.cursors.get(producer)
+                if other is not None and producer != t and producer not in self.exited \
+                        and other.emitted <= event:
+                    return ('event', producer)
+        elif view.kind == EV_SYNC:
+            sync_type = view.sync_type
+            spin = cursor.spin_record(view)
+            if spin is not None:
+                lock, record = spin
+                if record == SPIN_LOCK_END and self.locks.get(lock, t) != t:
+                    return ('lock', lock)
+            elif sync_type == SYNC_LOCK:
+                addr = view.sync_args[0]
+                if self.locks.get(addr, t) != t:
+                    return ('lock', addr)
+            elif sync_type == SYNC_JOIN:
+                child = self.spawns.get(view.sync_args[0])
+                if child in self.cursors and child not in self.exited:
+                    return ('exit', child)
+        return None
+
+    def schedule(self, cursor):
+        view = cursor.head()
+        if view is None:
+            self.exited.add(cursor.thread)
+            self.wake(('exit', cursor.thread), cursor.clock)
+            self.wake(('event', cursor.thread), cursor.clock)
+            return
+        key = self.blocker(cursor, view)
+        if key is None:
+            if view.kind == EV_COMM:
+                for producer, _, _, _ in view.edges:
+                    if producer in self.cursors:
+                        cursor.clock = max(cursor.clock, self.cursors[producer].clock)
+            heapq.heappush(self.ready, (cursor.clock, cursor.thread))
+        else:
+            self.blocked[cursor.thread] = key
+            self.waiters[key].append(cursor.thread)
+
+    def wake(self, key, clock):
+        for t in self.waiters.pop(key, ()):
+            if self.blocked.get(t) == key:
+                del self.blocked[t]
+                cursor = self.cursors[t]
+                cursor.clock = max(cursor.clock, clock)
+                if key[0] == 'barrier':
+                    cursor.release = None
+                self.schedule(cursor)
+
+    def force(self):
+        # break a lock before a data or barrier dependence
+        t = min(self.blocked, key=lambda t: (self.blocked[t][0] != 'lock',
+                                             self.cursors[t].clock, t))
+        key = self.blocked.pop(t)
+        self.waiters[key].remove(t)
+        cursor = self.cursors[t]
+        cursor.release = None
+        cursor.forced = True
+        self.unstarted.discard(t)
+        self.forced += 1
+        heapq.heappush(self.ready, (cursor.clock, t))
+
+    def emit(self, cursor, view):
+        t = cursor.thread
+        cursor.forced = False
+        if view.kind == EV_MARKER:
+            cursor.clock += view.marker_count
+            return
+        cursor.emitted += 1
+        self.wake(('event', t), cursor.clock)
+        if view.kind != EV_SYNC:
+            return
+        sync_type = view.sync_type
+        addr = view.sync_args[0]
+        spin = cursor.spin_record(view)
+        if spin is not None:
+            cursor.lock_addrs.skip()
+            cursor.spin_started = True
+            lock, record = spin
+            if record == SPIN_LOCK_END:
+                self.locks[lock] = t
+            elif record == SPIN_UNLOCK_END:
+                self.release_lock(t, lock, cursor.clock)
+        elif sync_type == SYNC_BARRIER and addr in self.participants:
+            instance = cursor.barriers[addr]
+            cursor.barriers[addr] += 1
+            key = (addr, instance)
+            self.arrivals[key] += 1
+            # the clock of the latest arrival releases everyone
+            self.arrival_clock[key] = max(self.arrival_clock.get(key, 0), cursor.clock)
+            if self.arrivals[key] < len(self.participants[addr]):
+                cursor.release = key
+            else:
+                clock = self.arrival_clock.pop(key)
+                del self.arrivals[key]
+                cursor.clock = clock
+                self.wake(('barrier',) + key, clock)
+        elif sync_type == SYNC_SPAWN:
+            child = self.spawns.get(addr)
+            if child in self.unstarted:
+                self.unstarted.discard(child)
+                self.cursors[child].clock = max(self.cursors[child].clock, cursor.clock)
+                self.wake(('spawn', child), cursor.clock)
+        elif sync_type == SYNC_LOCK:
+            self.locks[addr] = t
+        elif sync_type == SYNC_UNLOCK:
+            self.release_lock(t, addr, cursor.clock)
+        elif sync_type == SYNC_JOIN:
+            child = self.spawns.get(addr)
+            if child in self.cursors:
+                cursor.clock = max(cursor.clock, self.cursors[child].clock)
+
+    def release_lock(self, t, lock, clock):
+        if self.locks.get(lock) == t:
+            del self.locks[lock]
+        self.wake(('lock', lock), clock)
+
+    def __iter__(self):
+        for cursor in self.cursors.values():
+            self.schedule(cursor)
+        while self.ready or self.blocked:
+            if not self.ready:
+                self.force()
+            _, t = heapq.heappop(self.ready)
+            cursor = self.cursors[t]
+            key = self.blocker(cursor, cursor.ahead[0])
+            if key is not None:
+                # a lock taken since the thread was found ready
+                self.blocked[t] = key
+                self.waiters[key].append(t)
+                continue
+            view = cursor.ahead.popleft()
+            self.emit(cursor, view)
+            yield view
+            self.schedule(cursor)
+
+
+def iter_merged_events(directory, kinds=None, read_ahead=READ_AHEAD):
+    """
+    Yield the events of every thread of a run in one global order, keeping
+    only the given event kinds.
+    """
+    kinds = None if kinds is None else frozenset(EVENT_KINDS.get(k, k) for k in kinds)
+    for view in TraceMerger(directory, read_ahead):
+        if kinds is None or view.kind in kinds:
+            yield view
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Merge the per-thread SynchroTraceGen traces '
+                                                  'of a run into one global event stream'))
+    parser.add_argument('directory')
+    parser.add_argument('--kinds', nargs='+', choices=sorted(EVENT_KINDS))
+    parser.add_argument('--read-ahead', type=int, default=READ_AHEAD,
+                        help='events buffered per thread')
+    parser.add_argument('--count', action='store_true', help='only count events per thread')
+    args = parser.parse_args()
+
+    kinds = None if args.kinds is None else frozenset(EVENT_KINDS[k] for k in args.kinds)
+    merger = TraceMerger(args.directory, args.read_ahead)
+    counts = collections.Counter()
+    for view in merger:
+        if kinds is not None and view.kind not in kinds:
+            continue
+        if args.count:
+            counts[view.thread] += 1
+        else:
+            print(view)
+    if args.count:
+        print(' '.join('%d: %d' % kv for kv in sorted(counts.items())))
+    if merger.forced:
+        print('forced %d events past their constraints' % merger.forced)
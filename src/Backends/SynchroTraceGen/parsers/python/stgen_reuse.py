@@ -0,0 +1,424 @@
+#!/bin/python
+
+# Reuse distance (LRU stack distance) histograms of SynchroTraceGen runs
+#
+# The '$' and '*' ranges of every comp event are expanded to blocks of
+# --granularity bytes. The reuse distance of an access is the number of
+# distinct other blocks accessed since the previous access to its block; a
+# fully associative LRU cache of C blocks hits exactly the accesses at a
+# distance below C, so one histogram gives the miss ratio of every size.
+#
+# Histograms are taken per thread, each by its own worker process, and
+# globally over the accesses of all threads interleaved by event id, as in
+# stgen_cache. They share one log-linear bucket layout and merge by adding,
+# across threads, runs or saved .npz files.
+#
+# --rate samples blocks by a hash of their address (SHARDS, fixed rate): the
+# distances of the sampled blocks are measured among themselves and scaled
+# by 1 / rate, which keeps the miss ratio curve of multi-billion access
+# traces at a fraction of the time and memory.
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from stgen_cache import BLOCK_READERS, expand_lines, parse_size
+from stgen_events import trace_format, trace_thread, run_trace_paths
+
+GRANULARITY = 64
+
+# distances below SUB_BUCKETS are exact, above it each power of 2 is split
+# into SUB_BUCKETS buckets
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+NUM_BUCKETS = (64 - SUB_BITS) * SUB_BUCKETS
+
+# accesses ReuseEngine handles per step, bounds the memory of a step
+CHUNK = 1 << 20
+
+# SHARDS: a block is sampled if the top 24 bits of its hash are below rate * 2^24
+SAMPLE_BITS = 24
+
+# cache sizes of the miss ratio curve, default: 1KB to 1GB
+MRC_SIZES = [1 << b for b in range(10, 31)]
+
+
+def bucket_of(distances):
+    """
+    Bucket index of every non-negative distance.
+    """
+    distances = np.asarray(distances, dtype=np.int64)
+    exponent = np.frexp(np.maximum(distances, 1).astype(np.float64))[1] - 1
+    shift = np.maximum(exponent - SUB_BITS, 0)
+    return np.where(distances < SUB_BUCKETS, distances,
+                    (shift + 1) * SUB_BUCKETS + (distances >> shift) - SUB_BUCKETS)
+
+
+def bucket_low(buckets):
+    """
+    Smallest distance of every bucket.
+    """
+    buckets = np.asarray(buckets, dtype=np.int64)
+    shift = np.maximum(buckets // SUB_BUCKETS - 1, 0)
+    return np.where(buckets < 2 * SUB_BUCKETS, buckets,
+                    (buckets % SUB_BUCKETS + SUB_BUCKETS) << shift)
+
+
+def sample_mask(blocks, rate):
+    # splitmix64 finalizer of the block number
+    x = blocks.astype(np.uint64)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return (x >> np.uint64(64 - SAMPLE_BITS)) < np.uint64(int(rate * (1 << SAMPLE_BITS)))
+
+
+def dominance_counts(px, py, qx, qy):
+    """
+    For every query (qx, qy), the number of points with px < qx and
+    py > qy. Points are sorted by px and the prefix of each query is split
+    into aligned power of 2 runs, one per set bit of its length; per level,
+    all runs are sorted by py at once and counted with one searchsorted.
+    """
+    counts = np.zeros(len(qx), dtype=np.int64)
+    n = len(px)
+    if not n or not len(qx):
+        return counts
+    order = np.argsort(px, kind='stable')
+    prefix = np.searchsorted(px[order], qx, side='left')
+    values = np.unique(py)
+    rank = np.searchsorted(values, py[order])
+    # py > qy is rank >= threshold
+    threshold = np.searchsorted(values, qy, side='right')
+    width = len(values) + 1
+    run = np.arange(n, dtype=np.int64)
+    level = 0
+    while (1 << level) <= n:
+        has = ((prefix >> level) & 1).astype(bool)
+        if has.any():
+            keys = np.sort((run >> level) * width + rank)
+            block = (prefix[has] >> level) - 1
+            counts[has] += ((block + 1) << level) - np.searchsorted(keys, block * width + threshold[has])
+        level += 1
+    return counts
+
+
+class ReuseEngine:
+    """
+    Reuse distances of a stream of blocks, a chunk at a time, -1 for the
+    first access to a block.
+
+    Inside a chunk, the distance of a reuse at k of the access at p is the
+    number of accesses in (p, k) that are the last one to their block
+    before k, a dominance count over (position, next position) pairs.
+    Across chunks, the last access time of every block seen so far is kept
+    in a sorted array, counting the live ones after p is a binary search.
+    """
+
+    def __init__(self):
+        self.time = 0
+        self.blocks = np.zeros(0, dtype=np.int64)  # sorted, every block seen
+        self.last = np.zeros(0, dtype=np.int64)  # per block: its last access time
+        self.marks = np.zeros(0, dtype=np.int64)  # self.last, sorted
+
+    def distances(self, blocks):
+        blocks = np.asarray(blocks, dtype=np.int64)
+        n = len(blocks)
+        distance = np.full(n, -1, dtype=np.int64)
+        if not n:
+            return distance
+        order = np.argsort(blocks, kind='stable')
+        same = blocks[order[1:]] == blocks[order[:-1]]
+        prev = np.full(n, -1, dtype=np.int64)
+        prev[order[1:][same]] = order[:-1][same]
+        nxt = np.full(n, n, dtype=np.int64)
+        nxt[order[:-1][same]] = order[1:][same]
+        first = prev < 0
+        # distinct blocks accessed before each position of the chunk
+        distinct = np.cumsum(first) - first
+
+        # reuses within the chunk
+        k = np.flatnonzero(~first)
+        distance[k] = distinct[k] - 1 - dominance_counts(np.arange(n), nxt, prev[k] + 1, k)
+
+        # first accesses of the chunk to blocks seen before
+        f = np.flatnonzero(first)
+        pos = np.searchsorted(self.blocks, blocks[f])
+        seen = pos < len(self.blocks)
+        seen[seen] = self.blocks[pos[seen]] == blocks[f[seen]]
+        k, last = f[seen], self.last[pos[seen]]
+        # live marks after the previous access, but those of blocks the
+        # chunk accessed before k, which are counted in distinct instead
+        live_after = len(self.marks) - np.searchsorted(self.marks, last, side='right')
+        distance[k] = live_after - dominance_counts(k, last, k, last) + distinct[k]
+
+        # the last access of every block of the chunk becomes its mark
+        self.marks = np.delete(self.marks, np.searchsorted(self.marks, last))
+        ends = np.flatnonzero(nxt == n)
+        self.marks = np.concatenate((self.marks, ends + self.time))
+        end_blocks = blocks[ends]
+        pos = np.searchsorted(self.blocks, end_blocks)
+        seen = pos < len(self.blocks)
+        seen[seen] = self.blocks[pos[seen]] == end_blocks[seen]
+        self.last[pos[seen]] = ends[seen] + self.time
+        new = np.argsort(end_blocks[~seen])
+        insert = np.searchsorted(self.blocks, end_blocks[~seen][new])
+        self.blocks = np.insert(self.blocks, insert, end_blocks[~seen][new])
+        self.last = np.insert(self.last, insert, (ends[~seen] + self.time)[new])
+        self.time += n
+        return distance
+
+
+class ReuseHistogram:
+    """
+    Reuse distances in the buckets of bucket_of, and first accesses (cold)
+    apart. Distances are scaled by 1 / rate when sampled, counts are not.
+    """
+
+    def __init__(self, granularity=GRANULARITY, rate=1.0):
+        self.granularity = granularity
+        self.rate = rate
+        self.counts = np.zeros(NUM_BUCKETS, dtype=np.int64)
+        self.cold = 0
+
+    def add(self, distances):
+        cold = distances < 0
+        self.cold += int(cold.sum())
+        distances = distances[~cold]
+        if self.rate < 1:
+            distances = np.rint(distances / self.rate).astype(np.int64)
+        self.counts += np.bincount(bucket_of(distances), minlength=NUM_BUCKETS)
+
+    def merge(self, other):
+        if (self.granularity, self.rate) != (other.granularity, other.rate):
+            raise ValueError('cannot merge reuse histograms of granularity %d, rate %g and %d, %g'
+                             % (self.granularity, self.rate, other.granularity, other.rate))
+        self.counts += other.counts
+        self.cold += other.cold
+        return self
+
+    def accesses(self):
+        return int(self.counts.sum()) + self.cold
+
+    def miss_ratio(self, sizes):
+        """
+        Miss ratio of a fully associative LRU cache of every size in bytes,
+        exact for sizes on bucket bounds.
+        """
+        total = self.accesses()
+        lows = bucket_low(np.arange(NUM_BUCKETS))
+        # suffix sums: accesses at a distance of at least each bucket
+        beyond = np.cumsum(self.counts[::-1])[::-1]
+        blocks = np.asarray(sizes, dtype=np.int64) // self.granularity
+        idx = np.searchsorted(lows, blocks, side='left')
+        misses = self.cold + np.where(idx < NUM_BUCKETS, beyond[np.minimum(idx, NUM_BUCKETS - 1)], 0)
+        return misses / total if total else np.zeros(len(blocks))
+
+    def percentile(self, q):
+        # smallest bucket bound below which q of the reuses fall
+        if not self.counts.sum():
+            return 0
+        idx = np.searchsorted(np.cumsum(self.counts), q * self.counts.sum())
+        return int(bucket_low(idx))
+
+
+def iter_trace_blocks(tracepath, shift, rate=1.0):
+    """
+    Yield the (blocks, eids) of the comp accesses of a trace, sampled.
+    """
+    for (eids, start, end, _), _ in BLOCK_READERS[trace_format(tracepath)](tracepath, False):
+        blocks, eids = expand_lines(start, end, shift, eids)
+        if rate < 1:
+            keep = sample_mask(blocks, rate)
+            blocks, eids = blocks[keep], eids[keep]
+        yield blocks, eids
+
+
+def iter_chunks(arrays, size=CHUNK):
+    # regroup a stream of arrays into arrays of about size elements
+    parts = []
+    count = 0
+    for a in arrays:
+        parts.append(a)
+        count += len(a)
+        if count >= size:
+            yield np.concatenate(parts)
+            parts, count = [], 0
+    if parts:
+        yield np.concatenate(parts)
+
+
+def histogram_of(blocks, granularity, rate):
+    engine = ReuseEngine()
+    histogram = ReuseHistogram(granularity, rate)
+    for chunk in iter_chunks(blocks):
+        histogram.add(engine.distances(chunk))
+    return histogram
+
+
+def trace_reuse(tracepath, granularity=GRANULARITY, rate=1.0):
+    shift = int(granularity).bit_length() - 1
+    blocks = (b for b, _ in iter_trace_blocks(tracepath, shift, rate))
+    return trace_thread(tracepath), histogram_of(blocks, granularity, rate)
+
+
+def iter_interleaved(paths, shift, rate=1.0):
+    """
+    Yield the blocks of all traces in event id order, ties by thread,
+    holding one block of accesses per trace at a time.
+    """
+    streams = {trace_thread(p): iter_trace_blocks(p, shift, rate) for p in paths}
+    empty = np.zeros(0, dtype=np.int64)
+    buffers = dict.fromkeys(streams, (empty, empty))
+    while True:
+        for thread in list(streams):
+            while not len(buffers[thread][0]):
+                part = next(streams[thread], None)
+                if part is None:
+                    del streams[thread]
+                    break
+                buffers[thread] = part
+        if not any(len(b) for b, _ in buffers.values()):
+            return
+        # every access up to the smallest last eid a trace still reading has
+        # buffered can go, nothing read later comes before it
+        cutoff = min((int(buffers[t][1][-1]) for t in streams), default=None)
+        out, eids, threads = [], [], []
+        for thread, (b, e) in buffers.items():
+            n = len(e) if cutoff is None else int(np.searchsorted(e, cutoff, side='right'))
+            out.append(b[:n])
+            eids.append(e[:n])
+            threads.append(np.full(n, thread, dtype=np.int64))
+            buffers[thread] = (b[n:], e[n:])
+        order = np.lexsort((np.concatenate(threads), np.concatenate(eids)))
+        yield np.concatenate(out)[order]
+
+
+def global_reuse(paths, granularity=GRANULARITY, rate=1.0):
+    shift = int(granularity).bit_length() - 1
+    return histogram_of(iter_interleaved(paths, shift, rate), granularity, rate)
+
+
+class RunReuse:
+    """
+    Per thread and global ReuseHistograms of one or more runs.
+    """
+
+    def __init__(self, granularity=GRANULARITY, rate=1.0):
+        self.granularity = granularity
+        self.rate = rate
+        self.threads = {}
+        self.glob = ReuseHistogram(granularity, rate)
+
+    def add_thread(self, thread, histogram):
+        if thread in self.threads:
+            self.threads[thread].merge(histogram)
+        else:
+            self.threads[thread] = histogram
+
+    def merge(self, other):
+        for thread, histogram in other.threads.items():
+            self.add_thread(thread, histogram)
+        self.glob.merge(other.glob)
+        return self
+
+    def private(self):
+        # every thread on a cache of its own
+        merged = ReuseHistogram(self.granularity, self.rate)
+        for histogram in self.threads.values():
+            merged.merge(histogram)
+        return merged
+
+
+def directory_reuse(directory, max_workers=None, granularity=GRANULARITY, rate=1.0):
+    """
+    Return the RunReuse of all traces of a run directory.
+    """
+    # largest traces first so a big thread doesn't start last
+    paths = sorted(run_trace_paths(directory), key=os.path.getsize, reverse=True)
+    run = RunReuse(granularity, rate)
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        # the interleaved stream reads every trace, it goes first
+        glob = pool.submit(global_reuse, paths, granularity, rate)
+        n = len(paths)
+        for thread, histogram in pool.map(trace_reuse, paths, [granularity] * n, [rate] * n):
+            run.add_thread(thread, histogram)
+        run.glob = glob.result()
+    return run
+
+
+def save_reuse(path, run):
+    threads = sorted(run.threads)
+    np.savez(path, granularity=run.granularity, rate=run.rate,
+             threads=np.array(threads, dtype=np.int64),
+             counts=np.array([run.threads[t].counts for t in threads], dtype=np.int64).reshape(-1, NUM_BUCKETS),
+             cold=np.array([run.threads[t].cold for t in threads], dtype=np.int64),
+             global_counts=run.glob.counts, global_cold=run.glob.cold)
+
+
+def load_reuse(path):
+    data = np.load(path)
+    granularity, rate = int(data['granularity']), float(data['rate'])
+    run = RunReuse(granularity, rate)
+    for thread, counts, cold in zip(data['threads'].tolist(), data['counts'], data['cold'].tolist()):
+        histogram = ReuseHistogram(granularity, rate)
+        histogram.counts += counts
+        histogram.cold = cold
+        run.add_thread(thread, histogram)
+    run.glob.counts += data['global_counts']
+    run.glob.cold = int(data['global_cold'])
+    return run
+
+
+def print_reuse(run, sizes=MRC_SIZES):
+    scale = 1 / run.rate
+    sampled = ' (sampled at %g, counts scaled)' % run.rate if run.rate < 1 else ''
+    print('reuse distances of %d byte blocks%s' % (run.granularity, sampled))
+    print('%8s %14s %14s %10s %10s %10s' % ('thread', 'accesses', 'cold', 'p50', 'p90', 'p99'))
+    rows = [(t, run.threads[t]) for t in sorted(run.threads)]
+    rows += [('private', run.private()), ('global', run.glob)]
+    for name, h in rows:
+        print('%8s %14d %14d %10d %10d %10d' % (name, h.accesses() * scale, h.cold * scale,
+                                                  h.percentile(0.5), h.percentile(0.9), h.percentile(0.99)))
+    print('miss ratio of a fully associative LRU cache:')
+    print('%10s %10s %10s' % ('size', 'private', 'shared'))
+    for size, private, shared in zip(sizes, run.private().miss_ratio(sizes), run.glob.miss_ratio(sizes)):
+        print('%10s %9.2f%% %9.2f%%' % (format_size(size), 100 * private, 100 * shared))
+
+
+def format_size(size):
+    for unit, bits in (('G', 30), ('M', 20), ('K', 10)):
+        if size >= 1 << bits and size % (1 << bits) == 0:
+            return '%d%s' % (size >> bits, unit)
+    return str(size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Reuse distance histograms and miss ratio curves of '
+                                                  'the SynchroTraceGen traces of runs'))
+    parser.add_argument('runs', nargs='+',
+                        help='run directories, or .npz files of --save, merged into one result')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes')
+    parser.add_argument('-g', '--granularity', type=int, default=GRANULARITY,
+                        help='block size in bytes, a power of 2')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='SHARDS sampling rate of blocks, e.g. 0.01; default: every block')
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=MRC_SIZES,
+                        help='cache sizes of the miss ratio curve, e.g. 32K 1M')
+    parser.add_argument('--save', help='also save the histograms to this .npz file')
+    args = parser.parse_args()
+
+    run = None
+    for path in args.runs:
+        if path.endswith('.npz'):
+            part = load_reuse(path)
+        else:
+            part = directory_reuse(path, args.jobs, args.granularity, args.rate)
+        run = part if run is None else run.merge(part)
+    print_reuse(run, args.sizes)
+    if args.save:
+        save_reuse(args.save, run)
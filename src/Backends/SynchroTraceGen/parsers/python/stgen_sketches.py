@@ -0,0 +1,271 @@
+#!/bin/python
+
+# Mergeable fixed-size sketches of address streams
+#
+# HyperLogLog estimates the number of unique addresses, a Misra-Gries summary
+# keeps the most accessed ones and a distinct sample keeps exact counts of a
+# hash-selected fraction of all addresses. They take numpy arrays of
+# addresses, merge across threads and files, and save to .npz files, so
+# traces too large for the exact histograms of stgen_memory_metrics can
+# still be measured.
+
+import math
+
+import numpy as np
+
+U64 = np.uint64
+
+
+def hash64(x):
+    """
+    splitmix64 finalizer over an array of uint64, wraps modulo 2**64.
+    """
+    z = x.astype(U64) + U64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> U64(30))) * U64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> U64(27))) * U64(0x94D049BB133111EB)
+    return z ^ (z >> U64(31))
+
+
+def leading_zeros(x):
+    """
+    Count the leading zero bits of an array of uint64, 64 for zero.
+    """
+    x = x.copy()
+    n = np.zeros(len(x), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        empty = (x >> U64(64 - shift)) == 0
+        n[empty] += shift
+        x[empty] <<= U64(shift)
+    n[x == 0] = 64
+    return n
+
+
+class HyperLogLog:
+    """
+    Unique count estimate with 2**p registers, standard error ~1.04/sqrt(2**p).
+    """
+
+    def __init__(self, p=14):
+        assert(4 <= p <= 18)
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add(self, items):
+        if len(items) == 0:
+            return
+        h = hash64(items)
+        idx = (h >> U64(64 - self.p)).astype(np.intp)
+        rank = np.minimum(leading_zeros(h << U64(self.p)), 64 - self.p) + 1
+        np.maximum.at(self.registers, idx, rank.astype(np.uint8))
+
+    def merge(self, other):
+        assert(self.p == other.p)
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        zeros = int((self.registers == 0).sum())
+        if estimate <= 2.5 * m and zeros:
+            # small range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class HeavyHitters:
+    """
+    Mergeable Misra-Gries summary of at most k (address, count) pairs.
+    Counts are lower bounds and fall short of the true counts by at most
+    error <= total / (k + 1); every address accessed more than that is kept.
+    """
+
+    def __init__(self, k=1 << 16):
+        self.k = k
+        self.items = np.zeros(0, dtype=U64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.total = 0
+        self.error = 0
+
+    def add(self, items):
+        if len(items) == 0:
+            return
+        uniq, counts = np.unique(items, return_counts=True)
+        self.add_counts(uniq, counts.astype(np.int64))
+
+    def add_counts(self, items, counts):
+        self.total += int(counts.sum())
+        items = np.concatenate((self.items, items))
+        counts = np.concatenate((self.counts, counts))
+        uniq, inverse = np.unique(items, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(uniq)).astype(np.int64)
+        if len(uniq) > self.k:
+            # drop the (k+1)-th largest count from every counter
+            cut = int(np.partition(counts, len(counts) - self.k - 1)[len(counts) - self.k - 1])
+            counts -= cut
+            self.error += cut
+            keep = counts > 0
+            uniq, counts = uniq[keep], counts[keep]
+        self.items, self.counts = uniq, counts
+
+    def merge(self, other):
+        total = self.total + other.total
+        self.add_counts(other.items, other.counts)
+        self.total = total
+        self.error += other.error
+        return self
+
+    def top(self, n=None):
+        """
+        (items, counts) by decreasing count.
+        """
+        order = np.argsort(self.counts, kind='stable')[::-1][:n]
+        return self.items[order], self.counts[order]
+
+
+class DistinctSample:
+    """
+    Exact access counts of the addresses whose hash has at least `level`
+    leading zero bits, i.e. a uniform sample of 2**-level of the unique
+    addresses. The level goes up whenever more than `size` addresses are kept.
+    """
+
+    def __init__(self, size=1 << 16):
+        self.size = size
+        self.level = 0
+        self.items = np.zeros(0, dtype=U64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, items):
+        if len(items) == 0:
+            return
+        items = items[leading_zeros(hash64(items)) >= self.level]
+        uniq, counts = np.unique(items, return_counts=True)
+        self.add_counts(uniq, counts.astype(np.int64), self.level)
+
+    def add_counts(self, items, counts, level):
+        items = np.concatenate((self.items, items))
+        counts = np.concatenate((self.counts, counts))
+        self.level = max(self.level, level)
+        uniq, inverse = np.unique(items, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(uniq)).astype(np.int64)
+        zeros = leading_zeros(hash64(uniq))
+        while (zeros >= self.level).sum() > self.size:
+            self.level += 1
+        keep = zeros >= self.level
+        self.items, self.counts = uniq[keep], counts[keep]
+
+    def merge(self, other):
+        self.add_counts(other.items, other.counts, other.level)
+        return self
+
+
+class AddressSketch:
+    """
+    Approximate memory metrics of one access type (reads or writes).
+    """
+
+    def __init__(self, p=14, k=1 << 16):
+        self.hll = HyperLogLog(p)
+        self.hitters = HeavyHitters(k)
+        self.sample = DistinctSample(k)
+
+    @property
+    def total(self):
+        return self.hitters.total
+
+    def add(self, addrs):
+        self.hll.add(addrs)
+        self.hitters.add(addrs)
+        self.sample.add(addrs)
+
+    def merge(self, other):
+        self.hll.merge(other.hll)
+        self.hitters.merge(other.hitters)
+        self.sample.merge(other.sample)
+        return self
+
+    def ninety_perc(self, unique):
+        """
+        Estimate how many unique addresses make up the top 90% of all accesses.
+        The heavy hitters stand for themselves; every sampled address outside
+        of them stands for 2**level addresses with the same count. The top
+        90% is taken of the exact access count.
+        """
+        if self.total == 0:
+            return 0
+        hot, hot_counts = self.hitters.top()
+        cold = ~np.isin(self.sample.items, hot)
+        cold_counts = self.sample.counts[cold]
+        cold_weight = 2.0 ** self.sample.level
+        if len(hot_counts):
+            # the heavy hitter counts fall short by up to error each, spread
+            # the accesses neither summary accounts for over them
+            missing = self.total - hot_counts.sum() - cold_counts.sum() * cold_weight
+            hot_counts = hot_counts + min(max(missing / len(hot_counts), 0.0), self.hitters.error)
+        counts = np.concatenate((hot_counts, cold_counts))
+        weights = np.concatenate((np.ones(len(hot_counts)), np.full(len(cold_counts), cold_weight)))
+        order = np.argsort(counts, kind='stable')[::-1]
+        counts, weights = counts[order], weights[order]
+        mass = np.cumsum(counts * weights)
+        # 90% of the exact access count, the sampled mass is only an estimate
+        target = 0.9 * self.total
+        i = int(np.searchsorted(mass, target, side='right'))
+        if i == len(counts):
+            # the estimated mass falls short of the target
+            return min(int(weights.sum()), unique)
+        # whole groups before i, then as many of group i as needed
+        before = mass[i - 1] if i else 0.0
+        ninety = weights[:i].sum() + math.floor((target - before) / counts[i])
+        return min(int(ninety), unique)
+
+    def metrics(self):
+        unique = max(self.hll.count(), len(self.hitters.items))
+        return {
+            'total': self.total,
+            'unique': unique,
+            'ninety': self.ninety_perc(unique),
+            'error': self.hitters.error,
+        }
+
+    def state(self, prefix=''):
+        return {
+            prefix + 'registers': self.hll.registers,
+            prefix + 'items': self.hitters.items,
+            prefix + 'counts': self.hitters.counts,
+            prefix + 'sample_items': self.sample.items,
+            prefix + 'sample_counts': self.sample.counts,
+            prefix + 'stats': np.array([self.hll.p, self.hitters.k, self.hitters.total,
+                                        self.hitters.error, self.sample.level], dtype=np.int64),
+        }
+
+    @classmethod
+    def from_state(cls, state, prefix=''):
+        p, k, total, error, level = (int(v) for v in state[prefix + 'stats'])
+        sketch = cls(p, k)
+        sketch.hll.registers = np.array(state[prefix + 'registers'], dtype=np.uint8)
+        sketch.hitters.items = np.array(state[prefix + 'items'], dtype=U64)
+        sketch.hitters.counts = np.array(state[prefix + 'counts'], dtype=np.int64)
+        sketch.hitters.total = total
+        sketch.hitters.error = error
+        sketch.sample.items = np.array(state[prefix + 'sample_items'], dtype=U64)
+        sketch.sample.counts = np.array(state[prefix + 'sample_counts'], dtype=np.int64)
+        sketch.sample.level = level
+        return sketch
+
+
+def save_sketches(path, sketches):
+    """
+    Save a {name: AddressSketch} dict to an .npz file.
+    """
+    state = {}
+    for name, sketch in sketches.items():
+        state.update(sketch.state(name + '/'))
+    np.savez(path, **state)
+
+
+def load_sketches(path):
+    with np.load(path) as state:
+        names = sorted(set(key.split('/')[0] for key in state.files))
+        return {name: AddressSketch.from_state(state, name + '/') for name in names}
@@ -0,0 +1,58 @@
+#!/bin/python
+
+# Address extraction from TextLoggerV2 traces (sigil.events.out-#.gz)
+#
+#   @ iops,flops,reads,writes $ <start> <end> ... * <start> <end> ...
+#   # <producer tid> <producer eid> <start> <end> ...
+#   ^ <sync type>^<arg>&<arg>
+#   ! <instructions>
+#
+# '$' ranges are written, '*' ranges are read. Each range counts as one
+# access of its start address, like the comp and comm events of the
+# uncompressed capnp traces.
+
+import re
+import argparse
+
+import numpy as np
+
+from stgen_trace_input import iter_line_blocks
+
+WRITE_RE = re.compile(rb'\$ 0x([0-9a-fA-F]+)')
+READ_RE = re.compile(rb'\* 0x([0-9a-fA-F]+)')
+COMM_RE = re.compile(rb'# \d+ \d+ 0x([0-9a-fA-F]+)')
+
+
+def hex_array(matches):
+    return np.fromiter((int(m, 16) for m in matches), dtype=np.uint64)
+
+
+def block_addresses(block):
+    """
+    Return the (reads, writes) start addresses of a block of whole lines,
+    comm edges count as reads.
+    """
+    reads = hex_array(READ_RE.findall(block) + COMM_RE.findall(block))
+    writes = hex_array(WRITE_RE.findall(block))
+    return reads, writes
+
+
+def parse_text_trace_addresses(tracepath):
+    """
+    Yield (reads, writes) address arrays per block of the trace.
+    """
+    for block in iter_line_blocks(tracepath):
+        yield block_addresses(block)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Count the memory accesses of a '
+                                                  'SynchroTraceGen TextLoggerV2 trace'))
+    parser.add_argument('tracepath')
+    args = parser.parse_args()
+
+    reads = writes = 0
+    for r, w in parse_text_trace_addresses(args.tracepath):
+        reads += len(r)
+        writes += len(w)
+    print('reads: %d writes: %d' % (reads, writes))
@@ -0,0 +1,379 @@
+#!/bin/python
+
+# Binary columnar store for TextLoggerV2 traces
+#
+# A run directory of sigil.events.out-#.gz text traces is converted once into
+# one <trace>.stcol.npz per thread: a zip of numpy arrays holding the events
+# in chunks of CHUNK_EVENTS, each chunk laid out like CompressedColumns
+# (event kinds, counters, address ranges, comm edges and sync columns).
+# Analyses then load whole columns with np.load instead of parsing text, and
+# write_text_trace() turns a store back into the same TextLoggerV2 text for
+# gem5.
+#
+# Columns differ from the capnp decoder in a few places: the counters and
+# markers are wider since text has no field limits (post_process writes lock
+# addresses into markers), sync_type holds SyncType ids (text type numbers
+# are mapped with TEXT_SYNC_TYPES), sync_nargs keeps the argument count and
+# marker_width the digits of a marker, post_process markers like '! 001'
+# are zero padded.
+
+import os
+import gzip
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from stgen_columns import (EV_COMP, EV_COMM, EV_SYNC, EV_MARKER, NO_SYNC,
+                           TEXT_SYNC_TYPES, SYNC_TYPE_TEXT, COMPRESSED_DTYPES,
+                           CompressedColumns, offsets)
+from stgen_trace_input import iter_line_blocks
+
+# events per chunk of a store
+CHUNK_EVENTS = 1 << 20
+
+STORE_SUFFIX = '.stcol.npz'
+
+# text columns wider than the capnp ones
+TEXT_DTYPES = dict(COMPRESSED_DTYPES,
+                   iops=np.uint32, flops=np.uint32, reads=np.uint32, writes=np.uint32,
+                   marker_count=np.uint64, edge_event=np.uint64)
+
+COMP_CODE = ord('@')
+COMM_CODE = ord('#')
+SYNC_CODE = ord('^')
+MARKER_CODE = ord('!')
+
+
+def parse_text_lines(lines):
+    """
+    Parse TextLoggerV2 lines (bytes, without newlines) into CompressedColumns.
+    """
+    kind = []
+    counters = []
+    sync_type = []
+    sync_args = []
+    sync_nargs = []
+    marker_count = []
+    marker_width = []
+    write_counts = []
+    read_counts = []
+    edge_counts = []
+    edge_addr_counts = []
+    write_start = []
+    write_end = []
+    read_start = []
+    read_end = []
+    edge_thread = []
+    edge_event = []
+    edge_start = []
+    edge_end = []
+
+    for line in lines:
+        if not line:
+            continue
+        code = line[0]
+        nwrites = nreads = nedges = 0
+        parts = line.split()
+        if code == COMP_CODE:
+            kind.append(EV_COMP)
+            counters.append([int(c) for c in parts[1].split(b',')])
+            for i in range(2, len(parts), 3):
+                if parts[i] == b'$':
+                    write_start.append(int(parts[i + 1], 16))
+                    write_end.append(int(parts[i + 2], 16))
+                    nwrites += 1
+                else:
+                    read_start.append(int(parts[i + 1], 16))
+                    read_end.append(int(parts[i + 2], 16))
+                    nreads += 1
+            sync_type.append(NO_SYNC)
+            sync_args.append((0, 0))
+            sync_nargs.append(0)
+            marker_count.append(0)
+            marker_width.append(0)
+        else:
+            counters.append((0, 0, 0, 0))
+            if code == COMM_CODE:
+                kind.append(EV_COMM)
+                last = None
+                for i in range(0, len(parts), 5):
+                    edge = (int(parts[i + 1]), int(parts[i + 2]))
+                    if edge != last:
+                        # consecutive ranges of one producer event form one edge
+                        edge_thread.append(edge[0])
+                        edge_event.append(edge[1])
+                        edge_addr_counts.append(0)
+                        nedges += 1
+                        last = edge
+                    edge_start.append(int(parts[i + 3], 16))
+                    edge_end.append(int(parts[i + 4], 16))
+                    edge_addr_counts[-1] += 1
+                sync_type.append(NO_SYNC)
+                sync_args.append((0, 0))
+                sync_nargs.append(0)
+                marker_count.append(0)
+                marker_width.append(0)
+            elif code == SYNC_CODE:
+                ty, args = line[2:].split(b'^')
+                args = [int(a, 16) for a in args.split(b'&')]
+                assert(len(args) < 3)
+                kind.append(EV_SYNC)
+                sync_type.append(TEXT_SYNC_TYPES[int(ty)])
+                sync_args.append((args + [0, 0])[:2])
+                sync_nargs.append(len(args))
+                marker_count.append(0)
+                marker_width.append(0)
+            elif code == MARKER_CODE:
+                kind.append(EV_MARKER)
+                sync_type.append(NO_SYNC)
+                sync_args.append((0, 0))
+                sync_nargs.append(0)
+                marker_count.append(int(parts[1]))
+                marker_width.append(len(parts[1]))
+            else:
+                raise ValueError('unhandled trace line: %r' % line)
+        write_counts.append(nwrites)
+        read_counts.append(nreads)
+        edge_counts.append(nedges)
+
+    counters = np.array(counters, dtype=TEXT_DTYPES['iops']).reshape(-1, 4)
+    return CompressedColumns(
+        kind=np.array(kind, dtype=TEXT_DTYPES['kind']),
+        iops=counters[:, 0].copy(),
+        flops=counters[:, 1].copy(),
+        reads=counters[:, 2].copy(),
+        writes=counters[:, 3].copy(),
+        sync_type=np.array(sync_type, dtype=TEXT_DTYPES['sync_type']),
+        sync_args=np.array(sync_args, dtype=TEXT_DTYPES['sync_args']).reshape(-1, 2),
+        sync_nargs=np.array(sync_nargs, dtype=np.uint8),
+        marker_count=np.array(marker_count, dtype=TEXT_DTYPES['marker_count']),
+        marker_width=np.array(marker_width, dtype=np.uint8),
+        write_off=offsets(write_counts),
+        write_start=np.array(write_start, dtype=TEXT_DTYPES['write_start']),
+        write_end=np.array(write_end, dtype=TEXT_DTYPES['write_end']),
+        read_off=offsets(read_counts),
+        read_start=np.array(read_start, dtype=TEXT_DTYPES['read_start']),
+        read_end=np.array(read_end, dtype=TEXT_DTYPES['read_end']),
+        edge_off=offsets(edge_counts),
+        edge_thread=np.array(edge_thread, dtype=TEXT_DTYPES['edge_thread']),
+        edge_event=np.array(edge_event, dtype=TEXT_DTYPES['edge_event']),
+        edge_addr_off=offsets(edge_addr_counts),
+        edge_start=np.array(edge_start, dtype=TEXT_DTYPES['edge_start']),
+        edge_end=np.array(edge_end, dtype=TEXT_DTYPES['edge_end']))
+
+
+def iter_text_chunks(tracepath, chunk_events=CHUNK_EVENTS):
+    """
+    Yield the events of a text trace as CompressedColumns of at most
+    chunk_events events.
+    """
+    pending = []
+    for block in iter_line_blocks(tracepath):
+        pending += block.splitlines()
+        while len(pending) >= chunk_events:
+            yield parse_text_lines(pending[:chunk_events])
+            del pending[:chunk_events]
+    if pending:
+        yield parse_text_lines(pending)
+
+
+def is_uncompressed_style(lines):
+    # the uncompressed logger leaves no trailing space after '@ i,f,0,0'
+    for line in lines:
+        if line[:1] == b'@' and b'$' not in line and b'*' not in line:
+            return not line.endswith(b' ')
+    return False
+
+
+class StoreWriter:
+    """
+    Append chunks of columns to a store, one .npy member per column.
+    """
+
+    def __init__(self, path, compress=True):
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED if compress
+                                   else zipfile.ZIP_STORED)
+        self.chunks = 0
+
+    def write_array(self, name, array):
+        with self.zip.open(name + '.npy', 'w', force_zip64=True) as fp:
+            np.lib.format.write_array(fp, np.asarray(array), allow_pickle=False)
+
+    def write_chunk(self, cols):
+        for name, array in cols.columns().items():
+            self.write_array('chunk%06d/%s' % (self.chunks, name), array)
+        self.chunks += 1
+
+    def close(self, **meta):
+        for name, value in meta.items():
+            self.write_array('meta/' + name, np.asarray(value))
+        self.write_array('meta/chunks', np.asarray(self.chunks))
+        self.zip.close()
+
+
+def convert_text_trace(tracepath, store_path, chunk_events=CHUNK_EVENTS, compress=True):
+    """
+    Convert one text trace into a store. Returns the number of events.
+    """
+    blocks = iter_line_blocks(tracepath)
+    uncompressed = is_uncompressed_style(next(blocks, b'').splitlines())
+    blocks.close()
+
+    writer = StoreWriter(store_path + '.tmp', compress)
+    events = 0
+    for cols in iter_text_chunks(tracepath, chunk_events):
+        writer.write_chunk(cols)
+        events += len(cols)
+    writer.close(events=events, uncompressed=uncompressed)
+    os.replace(store_path + '.tmp', store_path)
+    return events
+
+
+class TextStore:
+    """
+    Read access to one thread's store. Columns are only decompressed when
+    a chunk is loaded.
+    """
+
+    def __init__(self, path):
+        self.npz = np.load(path)
+        self.chunks = int(self.npz['meta/chunks'])
+        self.events = int(self.npz['meta/events'])
+        self.uncompressed = bool(self.npz['meta/uncompressed'])
+
+    def chunk(self, i, names=None):
+        prefix = 'chunk%06d/' % i
+        names = names or [k[len(prefix):] for k in self.npz.files if k.startswith(prefix)]
+        return CompressedColumns(**{name: self.npz[prefix + name] for name in names})
+
+    def __iter__(self):
+        for i in range(self.chunks):
+            yield self.chunk(i)
+
+    def load(self):
+        return CompressedColumns.concatenate(self)
+
+    def close(self):
+        self.npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def text_lines(cols, uncompressed=False):
+    """
+    Format CompressedColumns back into TextLoggerV2 lines (bytes).
+    """
+    kind = cols.kind.tolist()
+    counters = np.stack((cols.iops, cols.flops, cols.reads, cols.writes), axis=1).tolist()
+    sync_type = cols.sync_type.tolist()
+    sync_args = cols.sync_args.tolist()
+    sync_nargs = cols.sync_nargs.tolist()
+    marker_count = cols.marker_count.tolist()
+    marker_width = cols.marker_width.tolist()
+    write_off = cols.write_off.tolist()
+    read_off = cols.read_off.tolist()
+    edge_off = cols.edge_off.tolist()
+    edge_addr_off = cols.edge_addr_off.tolist()
+    write_start, write_end = cols.write_start.tolist(), cols.write_end.tolist()
+    read_start, read_end = cols.read_start.tolist(), cols.read_end.tolist()
+    edge_thread, edge_event = cols.edge_thread.tolist(), cols.edge_event.tolist()
+    edge_start, edge_end = cols.edge_start.tolist(), cols.edge_end.tolist()
+
+    lines = []
+    for i, k in enumerate(kind):
+        if k == EV_COMP:
+            line = '@ %d,%d,%d,%d' % tuple(counters[i])
+            ranges = ''.join('$ %#x %#x ' % (write_start[j], write_end[j])
+                             for j in range(write_off[i], write_off[i + 1]))
+            ranges += ''.join('* %#x %#x ' % (read_start[j], read_end[j])
+                              for j in range(read_off[i], read_off[i + 1]))
+            if ranges or not uncompressed:
+                line += ' ' + ranges
+        elif k == EV_COMM:
+            line = ''.join('# %d %d %#x %#x ' % (edge_thread[e], edge_event[e], edge_start[j], edge_end[j])
+                           for e in range(edge_off[i], edge_off[i + 1])
+                           for j in range(edge_addr_off[e], edge_addr_off[e + 1]))
+        elif k == EV_SYNC:
+            args = sync_args[i][:sync_nargs[i]]
+            line = '^ %d^' % SYNC_TYPE_TEXT[sync_type[i]] + '&'.join('%#x' % a for a in args)
+        else:
+            line = '! %0*d' % (marker_width[i], marker_count[i])
+        lines.append(line.encode())
+    return lines
+
+
+def write_text_trace(store_path, tracepath, level=6):
+    """
+    Write a store back out as a gzipped TextLoggerV2 trace.
+    """
+    with TextStore(store_path) as store, gzip.open(tracepath, 'wb', compresslevel=level) as out:
+        for cols in store:
+            lines = text_lines(cols, store.uncompressed)
+            if lines:
+                out.write(b'\n'.join(lines) + b'\n')
+
+
+def text_trace_paths(directory):
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                  if f.startswith('sigil.events.out-') and f.endswith('.gz') and '.capn' not in f)
+
+
+def store_path_of(tracepath, out_dir):
+    return os.path.join(out_dir, os.path.basename(tracepath) + STORE_SUFFIX)
+
+
+def convert_run(directory, out_dir=None, max_workers=None, chunk_events=CHUNK_EVENTS,
+                compress=True):
+    """
+    Convert every text trace of a run directory, one worker process per
+    thread. Stores go to out_dir, by default <directory>/columnar.
+    """
+    out_dir = out_dir or os.path.join(directory, 'columnar')
+    os.makedirs(out_dir, exist_ok=True)
+    paths = sorted(text_trace_paths(directory), key=os.path.getsize, reverse=True)
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        futures = [pool.submit(convert_text_trace, path, store_path_of(path, out_dir),
+                               chunk_events, compress) for path in paths]
+        for path, fut in zip(paths, futures):
+            print('%s: %d events' % (path, fut.result()))
+    return out_dir
+
+
+def load_run(store_dir):
+    """
+    Return {trace file name: CompressedColumns} of a converted run.
+    """
+    run = {}
+    for f in sorted(os.listdir(store_dir)):
+        if f.endswith(STORE_SUFFIX):
+            with TextStore(os.path.join(store_dir, f)) as store:
+                run[f[:-len(STORE_SUFFIX)]] = store.load()
+    return run
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Convert TextLoggerV2 traces to a binary '
+                                                  'columnar store and back'))
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    conv = sub.add_parser('convert', help='convert the text traces of a run directory')
+    conv.add_argument('dir')
+    conv.add_argument('-o', '--out', help='store directory (default: <dir>/columnar)')
+    conv.add_argument('-j', '--jobs', type=int, default=None)
+    conv.add_argument('--chunk-events', type=int, default=CHUNK_EVENTS)
+    conv.add_argument('--stored', action='store_true',
+                      help='do not deflate the columns, faster to load but larger')
+    text = sub.add_parser('text', help='write a store back as a TextLoggerV2 trace')
+    text.add_argument('store')
+    text.add_argument('tracepath')
+    args = parser.parse_args()
+
+    if args.cmd == 'convert':
+        convert_run(args.dir, args.out, args.jobs, args.chunk_events, not args.stored)
+    else:
+        write_text_trace(args.store, args.tracepath)
@@ -0,0 +1,456 @@
+#!/bin/python
+
+# Random access into gzipped SynchroTraceGen traces
+#
+# A gzip file made of independent members can be decompressed from the start
+# of any member. The indexer makes sure a trace is split into members of
+# about MEMBER_SIZE uncompressed bytes that start on a line (TextLoggerV2) or
+# message (capnp) boundary, and records per member its compressed offset,
+# uncompressed offset and first event, plus the barriers of the trace, in a
+# <trace>.idx.npz sidecar. Readers then seek to event N or barrier K and only
+# decompress from the member that holds it; without a saved index they read
+# the trace from its start.
+#
+# Traces already written as line aligned members (post_process and
+# gen_gcp_trace output) or as members of whole capnp messages (an earlier
+# rewrite) are indexed in place. Others are rewritten once into members when
+# indexed from the command line, never by the readers; the decompressed
+# contents stay the same. Checkpoints inside a single deflate stream (zran)
+# would need inflatePrime(), which Python's zlib doesn't expose.
+#
+# Events are counted like the parsers see them: every line of a text trace,
+# every event (markers included) of a capnp trace, starting from 0.
+
+import os
+import gzip
+import zlib
+import shutil
+import argparse
+import tempfile
+
+import capnp
+import numpy as np
+
+from stgen_columns import which
+from stgen_trace_input import gzip_chunks, PipeReader, READ_SIZE
+
+# uncompressed bytes per member of rewritten traces
+MEMBER_SIZE = 4 << 20
+
+# traces with larger members are rewritten before indexing
+MAX_MEMBER_SIZE = 4 * MEMBER_SIZE
+
+INDEX_SUFFIX = '.idx.npz'
+
+# '^ 5^' barrier records of a text trace
+TEXT_BARRIER = b'^ 5^'
+
+
+def is_capnp(tracepath):
+    return '.capn' in os.path.basename(tracepath)
+
+
+def is_capnp_barrier(event):
+    return which(event) == 'sync' and str(event.sync.type) == 'barrier'
+
+
+def capnp_stream(tracepath):
+    """
+    The capnp message struct of a trace, by file name.
+    """
+    if 'uncompressed' in os.path.basename(tracepath):
+        import STEventTraceUncompressed_capnp
+        return STEventTraceUncompressed_capnp.EventStreamUncompressed
+    import STEventTraceCompressed_capnp
+    return STEventTraceCompressed_capnp.EventStreamCompressed
+
+
+class TraceIndex:
+    """
+    Per member (sorted): comp_offset, uncomp_offset, first_event.
+    Per barrier: barrier_event and, for text traces, barrier_offset, the
+    uncompressed offset of its line. num_events and trace_size describe the
+    whole trace; the index is stale once the trace size changes.
+    """
+
+    FIELDS = ('comp_offset', 'uncomp_offset', 'first_event',
+              'barrier_event', 'barrier_offset')
+
+    def __init__(self, comp_offset, uncomp_offset, first_event,
+                 barrier_event, barrier_offset, num_events, trace_size):
+        self.comp_offset = np.asarray(comp_offset, dtype=np.uint64)
+        self.uncomp_offset = np.asarray(uncomp_offset, dtype=np.uint64)
+        self.first_event = np.asarray(first_event, dtype=np.uint64)
+        self.barrier_event = np.asarray(barrier_event, dtype=np.uint64)
+        self.barrier_offset = np.asarray(barrier_offset, dtype=np.uint64)
+        self.num_events = int(num_events)
+        self.trace_size = int(trace_size)
+
+    def __len__(self):
+        return len(self.comp_offset)
+
+    def member_of_event(self, event):
+        if not 0 <= event < self.num_events:
+            raise IndexError('event %d out of range (%d events)' % (event, self.num_events))
+        return int(np.searchsorted(self.first_event, event, side='right')) - 1
+
+    def save(self, path):
+        np.savez(path, num_events=self.num_events, trace_size=self.trace_size,
+                 **{name: getattr(self, name) for name in self.FIELDS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            return cls(*(state[name] for name in cls.FIELDS),
+                       num_events=state['num_events'], trace_size=state['trace_size'])
+
+
+class MemberWriter:
+    """
+    Write blocks as gzip members and record where each one starts.
+    """
+
+    def __init__(self, path, level=6):
+        self.file = open(path, 'wb')
+        self.level = level
+        self.comp_offset = []
+        self.uncomp_offset = []
+        self.first_event = []
+        self.comp_size = 0
+        self.uncomp_size = 0
+
+    def write_member(self, block, first_event):
+        self.comp_offset.append(self.comp_size)
+        self.uncomp_offset.append(self.uncomp_size)
+        self.first_event.append(first_event)
+        data = gzip.compress(block, self.level, mtime=0)
+        self.file.write(data)
+        self.comp_size += len(data)
+        self.uncomp_size += len(block)
+
+    def close(self):
+        self.file.close()
+
+
+def text_block_stats(block, first_event, base_offset, barrier_event, barrier_offset):
+    """
+    Count the lines of a block of whole lines and record its barriers.
+    """
+    pos = block.find(TEXT_BARRIER)
+    while pos != -1:
+        if pos == 0 or block[pos - 1] == ord('\n'):
+            barrier_event.append(first_event + block.count(b'\n', 0, pos))
+            barrier_offset.append(base_offset + pos)
+        pos = block.find(TEXT_BARRIER, pos + 1)
+    return block.count(b'\n')
+
+
+def gzip_members(tracepath):
+    """
+    Yield (compressed offset, uncompressed bytes) of every member of a gzip
+    trace, stopping at a member larger than MAX_MEMBER_SIZE with None bytes.
+    """
+    with open(tracepath, 'rb') as f:
+        data = b''
+        consumed = 0  # compressed bytes before data
+        while True:
+            if not data:
+                data = f.read(READ_SIZE)
+                if not data:
+                    return
+            # one member: decompress until eof
+            offset = consumed
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            member = bytearray()
+            while True:
+                member += d.decompress(data, MAX_MEMBER_SIZE + 1 - len(member))
+                if len(member) > MAX_MEMBER_SIZE:
+                    yield offset, None
+                    return
+                if d.eof:
+                    consumed += len(data) - len(d.unused_data)
+                    data = d.unused_data or f.read(READ_SIZE)
+                    break
+                consumed += len(data) - len(d.unconsumed_tail)
+                data = d.unconsumed_tail or f.read(READ_SIZE)
+                if not data:
+                    raise EOFError('truncated gzip trace %s' % tracepath)
+            yield offset, member
+
+
+def scan_text_members(tracepath):
+    """
+    Index a text trace in place if its members are line aligned and no
+    larger than MAX_MEMBER_SIZE. Returns None otherwise.
+    """
+    comp_offset, uncomp_offset, first_event = [], [], []
+    barrier_event, barrier_offset = [], []
+    events = 0
+    uncomp = 0
+    last = b''  # the last non-empty member
+    for offset, member in gzip_members(tracepath):
+        if member is None:
+            return None
+        if last and not last.endswith(b'\n'):
+            # a line continues in the next member
+            return None
+        comp_offset.append(offset)
+        uncomp_offset.append(uncomp)
+        first_event.append(events)
+        events += text_block_stats(member, events, uncomp, barrier_event, barrier_offset)
+        uncomp += len(member)
+        last = member or last
+    if uncomp and not last.endswith(b'\n'):
+        # unterminated last line
+        events += 1
+    return TraceIndex(comp_offset, uncomp_offset, first_event, barrier_event,
+                      barrier_offset, events, os.path.getsize(tracepath))
+
+
+def scan_capnp_members(tracepath):
+    """
+    Index a capnp trace in place if its members are no larger than
+    MAX_MEMBER_SIZE and hold whole messages, as rewrite_capnp writes them.
+    The messages are packed again to find where they end, so a trace packed
+    differently is rewritten as well. Returns None otherwise.
+    """
+    comp_offset, uncomp_offset = [], []
+    uncomp = 0
+    for offset, member in gzip_members(tracepath):
+        if member is None:
+            return None
+        comp_offset.append(offset)
+        uncomp_offset.append(uncomp)
+        uncomp += len(member)
+
+    first_event, barrier_event = [], []
+    events = 0
+    pos = 0
+    with open(tracepath, 'rb') as f:
+        reader = PipeReader(gzip_chunks(f), tracepath)
+    with reader:
+        for message in (capnp_stream(tracepath)
+                        .read_multiple_packed(reader, traversal_limit_in_words=2**63)):
+            if len(first_event) < len(uncomp_offset) and uncomp_offset[len(first_event)] < pos:
+                # the member starts inside the last message
+                return None
+            while len(first_event) < len(uncomp_offset) and uncomp_offset[len(first_event)] == pos:
+                first_event.append(events)
+            for event in message.events:
+                if is_capnp_barrier(event):
+                    barrier_event.append(events)
+                events += 1
+            pos += len(message.as_builder().to_bytes_packed())
+    while len(first_event) < len(uncomp_offset) and uncomp_offset[len(first_event)] == pos:
+        first_event.append(events)
+    if pos != uncomp or len(first_event) != len(uncomp_offset):
+        return None
+    return TraceIndex(comp_offset, uncomp_offset, first_event, barrier_event,
+                      [], events, os.path.getsize(tracepath))
+
+
+def rewrite_text(tracepath, tmp_path, member_size):
+    out = MemberWriter(tmp_path)
+    barrier_event, barrier_offset = [], []
+    events = 0
+    pending = bytearray()
+    with open(tracepath, 'rb') as f:
+        for chunk in gzip_chunks(f):
+            pending += chunk
+            while len(pending) >= member_size:
+                end = pending.rfind(b'\n', 0, member_size) + 1 or pending.find(b'\n', member_size) + 1
+                if end == 0:
+                    break
+                block = bytes(pending[:end])
+                del pending[:end]
+                first = events
+                events += text_block_stats(block, first, out.uncomp_size, barrier_event, barrier_offset)
+                out.write_member(block, first)
+    if pending or not out.comp_offset:
+        block = bytes(pending)
+        first = events
+        events += text_block_stats(block, first, out.uncomp_size, barrier_event, barrier_offset)
+        if block and not block.endswith(b'\n'):
+            # unterminated last line
+            events += 1
+        out.write_member(block, first)
+    out.close()
+    return out, barrier_event, barrier_offset, events
+
+
+def rewrite_capnp(tracepath, tmp_path, member_size):
+    stream = capnp_stream(tracepath)
+    out = MemberWriter(tmp_path)
+    barrier_event = []
+    events = 0
+    first = 0
+    block = bytearray()
+    with open(tracepath, 'rb') as f:
+        reader = PipeReader(gzip_chunks(f), tracepath)
+    with reader:
+        for message in stream.read_multiple_packed(reader, traversal_limit_in_words=2**63):
+            for event in message.events:
+                if is_capnp_barrier(event):
+                    barrier_event.append(events)
+                events += 1
+            block += message.as_builder().to_bytes_packed()
+            if len(block) >= member_size:
+                out.write_member(bytes(block), first)
+                block = bytearray()
+                first = events
+    if block or not out.comp_offset:
+        out.write_member(bytes(block), first)
+    out.close()
+    return out, barrier_event, [], events
+
+
+def build_index(tracepath, member_size=MEMBER_SIZE):
+    """
+    Index a gzipped trace, rewriting it into members first if needed, and
+    save the index next to it. Returns the TraceIndex.
+    """
+    index = scan_capnp_members(tracepath) if is_capnp(tracepath) else scan_text_members(tracepath)
+    if index is None:
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(tracepath) + '.',
+                                        dir=os.path.dirname(tracepath) or '.')
+        os.close(fd)
+        rewrite = rewrite_capnp if is_capnp(tracepath) else rewrite_text
+        try:
+            out, barrier_event, barrier_offset, events = rewrite(tracepath, tmp_path, member_size)
+            # mkstemp creates the file private to the user
+            shutil.copymode(tracepath, tmp_path)
+            os.replace(tmp_path, tracepath)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        index = TraceIndex(out.comp_offset, out.uncomp_offset, out.first_event,
+                           barrier_event, barrier_offset, events, os.path.getsize(tracepath))
+    index.save(tracepath + INDEX_SUFFIX)
+    return index
+
+
+def load_index(tracepath):
+    """
+    The saved index of a trace, or None if it is missing or stale.
+    """
+    path = tracepath + INDEX_SUFFIX
+    if not os.path.exists(path):
+        return None
+    index = TraceIndex.load(path)
+    if index.trace_size != os.path.getsize(tracepath):
+        return None
+    return index
+
+
+def start_event(index, event=0, barrier=None):
+    if barrier is None:
+        return event
+    if not 0 <= barrier < len(index.barrier_event):
+        raise IndexError('barrier %d out of range (%d barriers)'
+                         % (barrier, len(index.barrier_event)))
+    return int(index.barrier_event[barrier])
+
+
+def skip_events(event_lists, skip):
+    for events in event_lists:
+        if skip >= len(events):
+            skip -= len(events)
+            continue
+        for i in range(skip, len(events)):
+            yield events[i]
+        skip = 0
+
+
+def from_barrier(event_lists, barrier, is_barrier):
+    # an unindexed trace, its barriers are counted from the start
+    seen = 0
+    started = False
+    for events in event_lists:
+        i = 0
+        while not started and i < len(events):
+            if is_barrier(events[i]):
+                if seen == barrier:
+                    started = True
+                    break
+                seen += 1
+            i += 1
+        if started:
+            for j in range(i, len(events)):
+                yield events[j]
+    if not started:
+        raise IndexError('barrier %d out of range (%d barriers)' % (barrier, seen))
+
+
+def seek_events(event_lists, event, barrier, index, is_barrier):
+    """
+    The events from event N or from the K-th barrier, out of event_lists(offset)
+    read from the member that holds it, or from the start without an index.
+    """
+    if index is None:
+        if barrier is None:
+            return skip_events(event_lists(0), event)
+        return from_barrier(event_lists(0), barrier, is_barrier)
+    event = start_event(index, event, barrier)
+    if event >= index.num_events:
+        return iter(())
+    member = index.member_of_event(event)
+    return skip_events(event_lists(int(index.comp_offset[member])),
+                       event - int(index.first_event[member]))
+
+
+def text_line_lists(tracepath, offset):
+    # the lines of each decompressed chunk from a compressed offset
+    tail = b''
+    with open(tracepath, 'rb') as f:
+        f.seek(offset)
+        for chunk in gzip_chunks(f):
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+            yield lines
+    if tail:
+        yield [tail]
+
+
+def capnp_event_lists(tracepath, offset):
+    # the events of each message from a compressed offset
+    with open(tracepath, 'rb') as f:
+        f.seek(offset)
+        reader = PipeReader(gzip_chunks(f), tracepath)
+    with reader:
+        for message in (capnp_stream(tracepath)
+                        .read_multiple_packed(reader, traversal_limit_in_words=2**63)):
+            yield message.events
+
+
+def iter_text_lines(tracepath, event=0, barrier=None, index=None):
+    """
+    Yield the lines of a text trace from event N, or from the K-th barrier.
+    Without a saved index the trace is read from its start.
+    """
+    index = index or load_index(tracepath)
+    yield from seek_events(lambda offset: text_line_lists(tracepath, offset),
+                           event, barrier, index, lambda line: line.startswith(TEXT_BARRIER))
+
+
+def iter_capnp_events(tracepath, event=0, barrier=None, index=None):
+    """
+    Yield the events of a capnp trace from event N, or from the K-th barrier.
+    Without a saved index the trace is read from its start.
+    """
+    index = index or load_index(tracepath)
+    yield from seek_events(lambda offset: capnp_event_lists(tracepath, offset),
+                           event, barrier, index, is_capnp_barrier)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Index gzipped SynchroTraceGen traces '
+                                                  'for random access'))
+    parser.add_argument('tracepaths', nargs='+')
+    parser.add_argument('--member-size', type=int, default=MEMBER_SIZE,
+                        help='uncompressed bytes per member of rewritten traces')
+    args = parser.parse_args()
+
+    for tracepath in args.tracepaths:
+        index = load_index(tracepath) or build_index(tracepath, args.member_size)
+        print('%s: %d events, %d members, %d barriers'
+              % (tracepath, index.num_events, len(index), len(index.barrier_event)))
@@ -0,0 +1,178 @@
+#!/bin/python
+
+# Streaming input for packed capnproto traces output by SynchroTraceGen
+#
+# pycapnp's read_multiple_packed() reads from a file descriptor
+# (https://github.com/jparyani/pycapnp/issues/80), so compressed traces are
+# decompressed by a forked copy of this interpreter that feeds one end of a
+# pipe while the capnp reader consumes the other end. A thread would not do:
+# pycapnp blocks on the pipe without releasing the GIL.
+
+import os
+import sys
+import traceback
+import zlib
+
+# bytes read from the compressed trace per call, the input buffer is reused
+READ_SIZE = 4 << 20
+
+# upper bound of the decompressed bytes produced per zlib call
+CHUNK_SIZE = 4 << 20
+
+
+def gzip_chunks(f, read_size=READ_SIZE):
+    """
+    Yield the decompressed contents of a gzip file in chunks. Concatenated
+    gzip members, as written by pigz or trace_io.ParallelGzipWriter, are
+    decoded as one stream like `gzip -d` does.
+    """
+    buf = bytearray(read_size)
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    in_member = False
+    while True:
+        n = f.readinto(buf)
+        if n == 0:
+            break
+        data = memoryview(buf)[:n]
+        while data:
+            in_member = True
+            out = d.decompress(data, CHUNK_SIZE)
+            if out:
+                yield out
+            if d.eof:
+                # the next member starts right after this one
+                data = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                in_member = False
+            else:
+                data = d.unconsumed_tail
+    # drain output held back by max_length
+    while in_member and not d.eof:
+        out = d.decompress(b'', CHUNK_SIZE)
+        if not out:
+            raise EOFError('truncated gzip trace')
+        yield out
+
+
+def zstd_chunks(f, read_size=READ_SIZE):
+    """
+    Yield the decompressed contents of a zstd file in chunks, all frames
+    of the file included. Requires the zstandard package.
+    """
+    import zstandard
+    with zstandard.ZstdDecompressor().stream_reader(f, read_size=read_size,
+                                                    read_across_frames=True) as reader:
+        while True:
+            out = reader.read(CHUNK_SIZE)
+            if not out:
+                break
+            yield out
+
+
+def file_chunks(f, read_size=READ_SIZE):
+    """
+    Yield the contents of an uncompressed file in chunks.
+    """
+    while True:
+        out = f.read(read_size)
+        if not out:
+            break
+        yield out
+
+
+# decompressors by trace file extension
+CHUNKERS = {'.gz': gzip_chunks, '.zst': zstd_chunks}
+
+
+def iter_line_blocks(tracepath, read_size=READ_SIZE):
+    """
+    Yield the decompressed contents of a text trace in blocks of whole lines.
+    """
+    name, ext = os.path.splitext(tracepath)
+    chunks = CHUNKERS.get(ext, file_chunks)
+    tail = b''
+    with open(tracepath, 'rb') as f:
+        for chunk in chunks(f, read_size):
+            end = chunk.rfind(b'\n') + 1
+            if end == 0:
+                tail += chunk
+                continue
+            yield tail + chunk[:end] if tail else chunk[:end]
+            tail = chunk[end:]
+    if tail:
+        yield tail
+
+
+class PipeReader:
+    """
+    The read end of a pipe filled from an iterator of bytes chunks by a
+    forked child, so decompression runs in parallel with capnp decoding.
+    close() raises if the child failed.
+    """
+
+    def __init__(self, chunks, name):
+        self.name = name
+        r, w = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(r)
+            os._exit(self.feed(chunks, w))
+        os.close(w)
+        self.file = os.fdopen(r, 'rb')
+
+    @staticmethod
+    def feed(chunks, fd):
+        status = 0
+        try:
+            for chunk in chunks:
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(fd, view):]
+        except BrokenPipeError:
+            # the reader stopped early
+            pass
+        except BaseException:
+            traceback.print_exc()
+            sys.stderr.flush()
+            status = 1
+        os.close(fd)
+        return status
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        if self.pid is None:
+            return
+        self.file.close()
+        _, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        if status != 0:
+            raise RuntimeError('failed decompressing %s' % self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_trace(tracepath, read_size=READ_SIZE):
+    """
+    Open a trace for read_multiple_packed(). .gz and .zst traces are
+    decompressed (zlib, zstandard) in a forked PipeReader child that feeds
+    the pipe capnp reads, .bin traces are read directly by capnp.
+    """
+    name, ext = os.path.splitext(tracepath)
+    if ext == '.bin':
+        return open(tracepath, 'rb')
+    if ext not in CHUNKERS:
+        raise ValueError('Unknown file extension: %s' % tracepath)
+    chunks = CHUNKERS[ext]
+
+    # opened before the fork, so a missing trace raises here
+    with open(tracepath, 'rb') as f:
+        return PipeReader(chunks(f, read_size), tracepath)